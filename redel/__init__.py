@@ -1,9 +1,14 @@
 from . import events
 from ._version import __version__
 from .app import ReDel
+from .budget import Budget, BudgetExceeded
+from .completion_cache import CacheMode, CachedEngine
 from .config import DEFAULT_LOG_DIR
 from .delegation import DelegationBase
 from .events import BaseEvent
+from .listeners import BackpressurePolicy
+from .mock_engine import MockEngine
+from .scheduler import RequestScheduler, ScheduledEngine
 from .tool_config import ToolConfig
 from .tools import ToolBase
 from .utils import AUTOGENERATE_TITLE
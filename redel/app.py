@@ -5,7 +5,7 @@ import time
 import uuid
 from collections.abc import AsyncIterable
 from pathlib import Path
-from typing import Any, Awaitable, Callable
+from typing import Collection
 from weakref import WeakValueDictionary
 
 import kani.exceptions
@@ -14,9 +14,13 @@ from kani.engines import BaseEngine
 
 from . import events
 from .base_kani import BaseKani
-from .delegation.delegate_and_wait import DelegateWait
-from .eventlogger import EventLogger
-from .kanis import DEFAULT_DELEGATE_PROMPT, DEFAULT_ROOT_PROMPT, create_root_kani
+from .budget import DEFAULT_WRAP_UP_THRESHOLD, Budget, BudgetTracker
+from .delegation.delegate_and_wait import DelegateWait, HelperSlots
+from .eventlogger import EventLogger, LogDurability, LogFormat
+from .kanis import DEFAULT_DELEGATE_PROMPT, DEFAULT_ROOT_PROMPT, ReDelKani, create_root_kani
+from .listeners import DEFAULT_LISTENER_QUEUE_SIZE, BackpressurePolicy, Listener, ListenerCallback
+from .scheduler import RequestScheduler, ScheduledEngine
+from .state import KaniState
 from .tool_config import ToolConfigType, validate_tool_configs
 from .utils import AUTOGENERATE_TITLE, AutogenerateTitle, generate_conversation_title
 
@@ -55,6 +59,7 @@ class ReDel:
         # engines
         root_engine: BaseEngine = None,
         delegate_engine: BaseEngine = None,
+        request_scheduler: RequestScheduler = None,
         # prompt/kani
         root_system_prompt: str | None = DEFAULT_ROOT_PROMPT,
         root_kani_kwargs: dict = None,
@@ -65,10 +70,23 @@ class ReDel:
         max_delegation_depth: int = 8,
         tool_configs: ToolConfigType = None,
         root_has_tools: bool = False,
+        max_helpers_per_kani: int = None,
+        max_running_helpers: int = None,
+        # budgets
+        budget: Budget = None,
+        depth_budgets: dict[int, Budget] = None,
+        token_costs: tuple[float, float] = None,
+        wrap_up_threshold: float = DEFAULT_WRAP_UP_THRESHOLD,
+        # events
+        stream_coalesce_window: float | None = None,
+        stream_coalesce_chars: int | None = None,
         # logging
         title: str | AutogenerateTitle | None = AUTOGENERATE_TITLE,
         log_dir: Path = None,
         clear_existing_log: bool = False,
+        log_format: LogFormat = "jsonl",
+        log_compression: bool = False,
+        log_durability: LogDurability = "flush",
         session_id: str = None,
     ):
         """
@@ -76,6 +94,9 @@ class ReDel:
             See :external+kani:doc:`engines` for a list of available engines and their capabilities.
         :param delegate_engine: The engine to use for each delegate kani. Requires function calling. (default: gpt-4o)
             See :external+kani:doc:`engines` for a list of available engines and their capabilities.
+        :param request_scheduler: If set, every request to the root and delegate engines is admitted through this
+            :class:`.RequestScheduler`, which enforces shared rate budgets and serves shallower kanis first. Share one
+            scheduler between sessions that use the same provider quota.
         :param root_system_prompt: The system prompt for the root kani. See ``redel.kanis`` for default.
         :param root_kani_kwargs: Additional keyword args to pass to :class:`kani.Kani`.
         :param delegate_system_prompt: The system prompt for the each delegate kani. See ``redel.kanis`` for default.
@@ -87,12 +108,45 @@ class ReDel:
         :param tool_configs: A mapping of tool mixin classes to their configurations (see :class:`.ToolConfig`).
         :param root_has_tools: Whether the root kani should have access to the configured tools (default
             False).
+        :param max_helpers_per_kani: If set, the maximum number of helpers each kani may have running at once. Helpers
+            delegated beyond this are queued until one of the kani's running helpers finishes. Enforced by
+            :class:`.DelegateWait`. (default: no limit)
+        :param max_running_helpers: If set, the maximum number of helpers that may be running at once in the whole
+            session. Helpers waiting on their own helpers don't count towards this. Enforced by :class:`.DelegateWait`.
+            (default: no limit)
+        :param budget: If set, the maximum tokens and/or cost (see :class:`.Budget`) the whole delegation tree may use.
+            Once the tree has used *wrap_up_threshold* of its budget, each kani is told to answer without calling any
+            more functions; once it is over budget, each kani may make one last request to give its answer, and any
+            requests after that raise :class:`.BudgetExceeded`.
+        :param depth_budgets: A mapping of depth to the :class:`.Budget` for the subtree rooted at each kani of that
+            depth (e.g. ``{1: Budget(max_tokens=50000)}`` limits each of the root's helpers, including everything they
+            delegate to). Usage is aggregated up the parent chain, so a kani's usage counts against every budget above
+            it.
+        :param token_costs: The cost of each (prompt token, completion token), e.g. ``(2.5e-6, 10e-6)``. Required to
+            use a budget with a ``max_cost``.
+        :param wrap_up_threshold: The fraction of a budget after which the kanis under it are told to wrap up (default
+            0.8).
+        :param stream_coalesce_window: If set, buffer each kani's streamed tokens and dispatch them as a single
+            :class:`.events.StreamDelta` at most once every *stream_coalesce_window* seconds, rather than once per
+            token. Any buffered tokens are always flushed when the stream finishes. (default: no coalescing)
+        :param stream_coalesce_chars: If set, buffer each kani's streamed tokens and dispatch them as a single
+            :class:`.events.StreamDelta` once at least this many characters are buffered. Can be combined with
+            ``stream_coalesce_window``; the buffer is flushed when either threshold is reached. (default: no coalescing)
         :param title: The title of this session. Set to ``redel.AUTOGENERATE_TITLE`` to automatically generate one
             (default), or ``None`` to disable title generation.
         :param log_dir: A path to a directory to save logs for this session. Defaults to
             ``$REDEL_HOME/instances/{session_id}/`` (default ``~/.redel/instances/{session_id}``).
         :param clear_existing_log: If the log directory has existing events, clear them before writing new events.
             Otherwise, append to existing events.
+        :param log_format: The format to write the event log in. ``"jsonl"`` (default) writes ``events.jsonl``, a
+            human-readable JSONL file. ``"binary"`` writes ``events.bin``, a compact msgpack-based format (requires
+            ``pip install "redel[binlog]"``). Binary logs can be read with :func:`.read_events` and exported to JSONL
+            with :func:`.binlog_to_jsonl`.
+        :param log_compression: If using the binary log format, compress the event log in blocks. Buffered events are
+            flushed to disk every round.
+        :param log_durability: Events are written to the log in batches by a background thread. This controls what
+            happens after each batch: ``"none"`` leaves them in the file buffer, ``"flush"`` (default) flushes them to
+            the OS, and ``"fsync"`` also forces them to disk. The log is always flushed when the state is saved.
         :param session_id: The ID of this session. Generally this should not be set manually; it is used for loading
             previous states.
         """
@@ -109,9 +163,14 @@ class ReDel:
 
         validate_tool_configs(tool_configs)
 
+        if request_scheduler is not None:
+            root_engine = _scheduled(root_engine, request_scheduler)
+            delegate_engine = _scheduled(delegate_engine, request_scheduler)
+
         # engines
         self.root_engine = root_engine
         self.delegate_engine = delegate_engine
+        self.request_scheduler = request_scheduler
         # prompt/kani
         self.root_system_prompt = root_system_prompt
         self.root_kani_kwargs = root_kani_kwargs
@@ -122,27 +181,53 @@ class ReDel:
         self.max_delegation_depth = max_delegation_depth
         self.tool_configs = tool_configs
         self.root_has_tools = root_has_tools
+        self.max_helpers_per_kani = max_helpers_per_kani
+        self.max_running_helpers = max_running_helpers
+        self.helper_slots = HelperSlots(max_running_helpers) if max_running_helpers else None
+        # budgets
+        self.budget_tracker = BudgetTracker(budget, depth_budgets, token_costs, wrap_up_threshold)
+        """Tracks the tokens used by each kani and its subtree, and enforces the budgets."""
+        # events
+        self.stream_coalesce_window = stream_coalesce_window
+        self.stream_coalesce_chars = stream_coalesce_chars
+        # logging
+        self.log_format = log_format
+        self.log_compression = log_compression
+        self.log_durability = log_durability
 
         # internals
         self._init_lock = asyncio.Lock()
 
         # events
-        self.listeners = []
+        self.listeners: list[Listener] = []
+        self._listener_index: dict[type[events.BaseEvent], list[Listener]] = {}  # event type -> listeners
         self.event_queue = asyncio.Queue()
         self.dispatch_task = None
         # state
         self.session_id = session_id or f"{int(time.time())}-{uuid.uuid4()}"
         if title is AUTOGENERATE_TITLE:
             self.title = None
-            self.add_listener(self.create_title_listener)
+            self.add_listener(self.create_title_listener, event_types=(events.RootMessage,))
         else:
             self.title = title
         # logging
-        self.logger = EventLogger(self, self.session_id, log_dir=log_dir, clear_existing_log=clear_existing_log)
-        self.add_listener(self.logger.log_event)
+        self.logger = EventLogger(
+            self,
+            self.session_id,
+            log_dir=log_dir,
+            clear_existing_log=clear_existing_log,
+            log_format=log_format,
+            log_compression=log_compression,
+            durability=log_durability,
+        )
+        self.add_listener(self.logger.log_event, loggable_only=True)
         # kanis
         self.kanis = WeakValueDictionary()
         self.root_kani = None
+        self.dormant_kanis: dict[str, KaniState] = {}
+        """The saved states of kanis restored by :meth:`load_state` that have not been hydrated yet, by ID."""
+        self._restored_kanis = []
+        self._hydrate_lock = asyncio.Lock()
 
     def get_config(self, **kwargs):
         """
@@ -157,6 +242,7 @@ class ReDel:
         config = {
             "root_engine": self.root_engine,
             "delegate_engine": self.delegate_engine,
+            "request_scheduler": self.request_scheduler,
             "root_system_prompt": self.root_system_prompt,
             "root_kani_kwargs": self.root_kani_kwargs,
             "delegate_system_prompt": self.delegate_system_prompt,
@@ -165,6 +251,17 @@ class ReDel:
             "max_delegation_depth": self.max_delegation_depth,
             "tool_configs": self.tool_configs,
             "root_has_tools": self.root_has_tools,
+            "max_helpers_per_kani": self.max_helpers_per_kani,
+            "max_running_helpers": self.max_running_helpers,
+            "budget": self.budget_tracker.budget,
+            "depth_budgets": self.budget_tracker.depth_budgets,
+            "token_costs": self.budget_tracker.token_costs,
+            "wrap_up_threshold": self.budget_tracker.wrap_up_threshold,
+            "stream_coalesce_window": self.stream_coalesce_window,
+            "stream_coalesce_chars": self.stream_coalesce_chars,
+            "log_format": self.log_format,
+            "log_compression": self.log_compression,
+            "log_durability": self.log_durability,
         }
         config.update(kwargs)
         return config
@@ -190,6 +287,78 @@ class ReDel:
                 self.dispatch_task = asyncio.create_task(
                     self._dispatch_task(), name=f"redel-dispatch-{self.session_id}"
                 )
+                for listener in self.listeners:
+                    listener.start()
+
+    async def load_state(self, kani_states: list[KaniState], lazy: bool = True):
+        """
+        Restore the kanis of a saved session (e.g., the ``state`` list of a ``state.json`` file) into this session, so
+        that it can continue where the save left off. Must be called before the session is used.
+
+        To continue logging to the same save, this session should be created with the saved session's ``session_id``
+        and ``log_dir``. Restored kanis do not dispatch :class:`.events.KaniSpawn` events, since they are already in
+        the saved event log.
+
+        :param kani_states: The saved state of each kani in the session.
+        :param lazy: If True (default), only the root kani is restored immediately. The other kanis are kept as
+            *dormant* saved states (see :attr:`dormant_kanis`), and are only rebuilt (with their tools) when they are
+            needed -- e.g., when their parent asks them a follow-up question -- or when :meth:`hydrate_kani` is called.
+            Dormant kanis are still included in the session's state. If False, every kani is restored immediately.
+        """
+        root_state = next((state for state in kani_states if state.parent is None), None)
+        if root_state is None:
+            raise ValueError("The saved state does not contain a root kani.")
+        async with self._init_lock:
+            if self.root_kani is not None:
+                raise RuntimeError("Cannot load a saved state into a session that has already started.")
+            self.dormant_kanis = {state.id: state for state in kani_states if state.parent is not None}
+            self.root_kani = await create_root_kani(
+                self.root_engine,
+                # create_root_kani args
+                app=self,
+                delegation_scheme=self.delegation_scheme,
+                tool_configs=self.tool_configs,
+                root_has_tools=self.root_has_tools,
+                dispatch_creation=False,
+                # BaseKani args
+                id=root_state.id,
+                name=root_state.name,
+                # Kani args
+                system_prompt=self.root_system_prompt,
+                chat_history=list(root_state.chat_history),
+                **self.root_kani_kwargs,
+            )
+            self.root_kani.restore_dormant_children(root_state)
+            if not lazy:
+                for state in kani_states:
+                    if state.id in self.dormant_kanis:
+                        await self._hydrate_kani(state.id)
+        # open the existing event log now, so that the event counts include the saved events
+        _ = self.logger.event_file
+
+    async def hydrate_kani(self, kani_id: str) -> ReDelKani:
+        """
+        Rebuild a dormant kani restored by :meth:`load_state` (and any dormant ancestors it has), and return it. If the
+        kani has already been hydrated, returns the live kani.
+
+        :raises KeyError: if there is no kani with the given ID in this session.
+        """
+        async with self._hydrate_lock:
+            return await self._hydrate_kani(kani_id)
+
+    async def _hydrate_kani(self, kani_id: str) -> ReDelKani:
+        if kani_id not in self.dormant_kanis:
+            return self.kanis[kani_id]
+        state = self.dormant_kanis[kani_id]
+        parent = await self._hydrate_kani(state.parent)
+        ai = await parent.restore_delegate_kani(state)
+        # the delegation scheme might not hold a reference to its delegates, but the restored state should be kept
+        self._restored_kanis.append(ai)
+        return ai
+
+    def get_state(self) -> list[KaniState]:
+        """Get the state of each kani in this session, including dormant kanis that have not been hydrated yet."""
+        return [ai.get_save_state() for ai in self.kanis.values()] + list(self.dormant_kanis.values())
 
     # === entrypoints ===
     async def chat_from_queue(self, q: asyncio.Queue):
@@ -232,7 +401,7 @@ class ReDel:
 
         # register a new listener which passes events into a local queue
         q = asyncio.Queue()
-        self.add_listener(q.put)
+        self.add_listener(q.put, loggable_only=True)
 
         # submit query to the kani to run in bg
         async def _task():
@@ -245,53 +414,143 @@ class ReDel:
 
         task = asyncio.create_task(_task())
 
-        # yield from the q until we get a RoundComplete
-        while True:
-            event = await q.get()
-            if event.__log_event__:
-                yield event
-            if event.type == "round_complete":
-                break
-
-        # ensure task is completed and cleanup
-        await task
-        self.remove_listener(q.put)
+        try:
+            # yield from the q until we get a RoundComplete
+            while True:
+                event = await q.get()
+                if event.__log_event__:
+                    yield event
+                if event.type == "round_complete":
+                    break
+
+            # ensure task is completed
+            await task
+        finally:
+            # if the caller stopped iterating early (e.g. timed out), stop the round too
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            self.remove_listener(q.put)
 
     # === events ===
-    def add_listener(self, callback: Callable[[events.BaseEvent], Awaitable[Any]]):
+    def add_listener(
+        self,
+        callback: ListenerCallback,
+        *,
+        event_types: Collection[type[events.BaseEvent]] = None,
+        kani_ids: Collection[str] = None,
+        loggable_only: bool = False,
+        max_queue_size: int = DEFAULT_LISTENER_QUEUE_SIZE,
+        policy: BackpressurePolicy = BackpressurePolicy.BLOCK,
+    ) -> Listener:
         """
         Add a listener which is called for every event dispatched by the system.
         The listener must be an asynchronous function that takes in an event in a single argument.
+
+        If any filters are passed, the listener will only be called for events matching all of them. Events of a type
+        that no listener subscribes to are never built or dispatched at all, so filtering your listeners can save a lot
+        of work (e.g. stream deltas are skipped entirely if no listener wants them).
+
+        Each listener receives events in order from its own queue, so a slow listener will not delay delivery to other
+        listeners unless its queue fills up and its policy is ``BackpressurePolicy.BLOCK``.
+
+        :param callback: The async function to call with each event.
+        :param event_types: If set, only call the listener for events that are instances of one of these types.
+        :param kani_ids: If set, only call the listener for events whose ``id`` is one of these kani IDs. Events
+            without an ``id`` (e.g. :class:`.events.RootMessage`) will not be delivered.
+        :param loggable_only: If true, only call the listener for events that are logged (i.e., not stream deltas).
+        :param max_queue_size: The maximum number of events to queue for this listener before applying the
+            backpressure policy. If this is 0, the queue is unbounded. (default 1024)
+        :param policy: What to do when an event is dispatched but the listener's queue is full (default
+            ``BackpressurePolicy.BLOCK``). See :class:`.BackpressurePolicy`.
+        :returns: The registered :class:`.Listener`, which can be used to inspect its queue depth.
         """
-        self.listeners.append(callback)
+        listener = Listener(
+            self,
+            callback,
+            event_types=event_types,
+            kani_ids=kani_ids,
+            loggable_only=loggable_only,
+            max_queue_size=max_queue_size,
+            policy=policy,
+        )
+        self.listeners.append(listener)
+        self._listener_index = {}
+        # if we are already dispatching, start delivering to the new listener now
+        if self.dispatch_task is not None:
+            listener.start()
+        return listener
 
     def remove_listener(self, callback):
         """Remove a listener added by :meth:`add_listener`."""
-        self.listeners.remove(callback)
+        listener = self.get_listener(callback)
+        if listener is None:
+            raise ValueError(f"{callback!r} is not a registered listener")
+        self.listeners.remove(listener)
+        self._listener_index = {}
+        listener.stop()
+
+    def get_listener(self, callback) -> Listener | None:
+        """Get the :class:`.Listener` registered with the given callback, or None if it is not registered."""
+        return next((listener for listener in self.listeners if listener.callback == callback), None)
+
+    def listener_queue_depths(self) -> dict[str, int]:
+        """Get a mapping of each listener's callback name to the number of events waiting in its queue."""
+        return {repr(listener.callback): listener.queue_depth for listener in self.listeners}
+
+    def wants_event(self, event_type: type[events.BaseEvent]) -> bool:
+        """
+        Whether any listener is subscribed to events of the given type.
+
+        Use this to skip building events that no one will receive. :meth:`dispatch` will also discard these events.
+        """
+        return bool(self._get_listeners_for(event_type))
+
+    def _get_listeners_for(self, event_type: type[events.BaseEvent]) -> list[Listener]:
+        """Get the listeners subscribed to the given event type, in registration order."""
+        try:
+            return self._listener_index[event_type]
+        except KeyError:
+            listeners = [listener for listener in self.listeners if listener.accepts_type(event_type)]
+            self._listener_index[event_type] = listeners
+            return listeners
 
     async def _dispatch_task(self):
         while True:
+            event = await self.event_queue.get()
             # noinspection PyBroadException
             try:
-                event = await self.event_queue.get()
-                # get listeners, call them
-                await asyncio.gather(*(callback(event) for callback in self.listeners), return_exceptions=True)
+                # fan out to each subscribed listener's queue
+                for listener in self._get_listeners_for(type(event)):
+                    if listener.accepts(event):
+                        await listener.put(event)
             except Exception:
                 log.exception("Exception when dispatching event:")
+            finally:
+                self.event_queue.task_done()
 
     def dispatch(self, event: events.BaseEvent):
         """Dispatch an event to all listeners.
         Technically this just adds it to a queue and then an async background task dispatches it."""
+        # no one is listening for this type of event, don't bother
+        if not self.wants_event(type(event)):
+            return
         self.event_queue.put_nowait(event)
 
+    async def _drain_events(self):
+        """Wait until all dispatched events have been delivered to each listener."""
+        await self.event_queue.join()
+        await asyncio.gather(*(listener.join() for listener in self.listeners))
+
     # --- kani lifecycle ---
-    def on_kani_creation(self, ai: BaseKani):
+    def on_kani_creation(self, ai: BaseKani, dispatch: bool = True):
         """Called by the redel kani constructor.
         Registers a new kani in the app, handles parent-child bookkeeping, and dispatches a KaniSpawn event."""
         self.kanis[ai.id] = ai
         if ai.parent:
             ai.parent.children[ai.id] = ai
-        self.dispatch(events.KaniSpawn.from_kani(ai))
+        if dispatch:
+            self.dispatch(events.KaniSpawn.from_kani(ai))
 
     # === resources + app lifecycle ===
     async def create_title_listener(self, event):
@@ -315,9 +574,25 @@ class ReDel:
     async def close(self):
         """Clean up all the app resources."""
         if self.dispatch_task is not None:
+            # give listeners a chance to finish handling any events that were already dispatched
+            try:
+                await asyncio.wait_for(self._drain_events(), timeout=10)
+            except asyncio.TimeoutError:
+                log.warning("Timed out waiting for listeners to finish handling events during close.")
             self.dispatch_task.cancel()
+            for listener in self.listeners:
+                listener.stop()
+        # the root kani is only created once the app is initialized
+        root_close = [self.root_kani.close()] if self.root_kani is not None else []
         await asyncio.gather(
             self.logger.close(),
-            self.root_kani.close(),
+            *root_close,
             *(child.close() for child in self.kanis.values()),
         )
+
+
+def _scheduled(engine: BaseEngine, scheduler: RequestScheduler) -> BaseEngine:
+    # engines copied from another session's config are already scheduled
+    if isinstance(engine, ScheduledEngine) and engine.scheduler is scheduler:
+        return engine
+    return ScheduledEngine(engine, scheduler)
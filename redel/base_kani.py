@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import contextmanager
 from typing import AsyncIterable, TYPE_CHECKING
 from weakref import WeakValueDictionary
@@ -8,8 +9,9 @@ from kani.engines.openai import OpenAIEngine
 from kani.streaming import StreamManager
 
 from . import events
+from .scheduler import current_kani
 from .state import KaniState, RunState
-from .utils import create_kani_id
+from .utils import create_kani_id, unwrap_engine
 
 if TYPE_CHECKING:
     from .app import ReDel
@@ -51,30 +53,62 @@ class BaseKani(Kani):
             self.depth = 0
         self.parent = parent
         self.children = WeakValueDictionary()
+        self.dormant_children: list[str] = []
+        """The IDs of this kani's children that were restored from a save but not hydrated yet."""
         # app management
         self.id = create_kani_id() if id is None else id
         self.name = self.id if name is None else name
         self.app = app
+        # stream delta coalescing
+        self._stream_buffer = []
+        self._stream_buffer_len = 0
+        self._stream_buffer_role = None
+        self._stream_flush_timer: asyncio.TimerHandle | None = None
         if dispatch_creation:
             app.on_kani_creation(self)
 
     # ==== overrides ====
     async def get_model_completion(self, include_functions: bool = True, **kwargs) -> BaseCompletion:
+        # refuse the request if we're over budget and have had our last request, or just answer if we're almost over
+        self.app.budget_tracker.check(self)
+        if self.app.budget_tracker.should_wrap_up(self):
+            include_functions = False
+
         # if include_functions is False but we have functions and are using an OpenAIEngine, we should set
         # tool_choice="none" instead -- this prevents the API from exploding if we set parallel_tool_calls
-        if self.functions and (not include_functions) and isinstance(self.engine, OpenAIEngine):
+        # (the engine may be wrapped, e.g. by a ScheduledEngine or CachedEngine, so check the engine it wraps)
+        if self.functions and (not include_functions) and isinstance(unwrap_engine(self.engine), OpenAIEngine):
             include_functions = True
             kwargs["tool_choice"] = "none"
 
-        return await super().get_model_completion(include_functions=include_functions, **kwargs)
+        # let scheduled engines know who is asking
+        token = current_kani.set(self)
+        try:
+            return await super().get_model_completion(include_functions=include_functions, **kwargs)
+        finally:
+            current_kani.reset(token)
 
     async def get_model_stream(self, include_functions: bool = True, **kwargs) -> AsyncIterable[str | BaseCompletion]:
         # same as above for streaming
-        if self.functions and (not include_functions) and isinstance(self.engine, OpenAIEngine):
+        self.app.budget_tracker.check(self)
+        if self.app.budget_tracker.should_wrap_up(self):
+            include_functions = False
+
+        if self.functions and (not include_functions) and isinstance(unwrap_engine(self.engine), OpenAIEngine):
             include_functions = True
             kwargs["tool_choice"] = "none"
 
-        async for elem in super().get_model_stream(include_functions=include_functions, **kwargs):
+        # the engine makes its request when the stream is first iterated, so the kani only needs to be set until then
+        stream = super().get_model_stream(include_functions=include_functions, **kwargs)
+        token = current_kani.set(self)
+        try:
+            elem = await anext(stream, None)
+        finally:
+            current_kani.reset(token)
+        if elem is None:
+            return
+        yield elem
+        async for elem in stream:
             yield elem
 
     async def chat_round(self, *args, **kwargs):
@@ -84,13 +118,10 @@ class BaseKani(Kani):
     def chat_round_stream(self, *args, **kwargs) -> StreamManager:
         stream = super().chat_round_stream(*args, **kwargs)
 
-        # consume from the inner StreamManager and re-yield with bookkeeping
         async def _impl():
             with self.run_state(RunState.RUNNING):
-                async for token in stream:
-                    yield token
-                    self.app.dispatch(events.StreamDelta(id=self.id, delta=token, role=stream.role))
-                yield await stream.completion()
+                async for elem in self._wrap_stream(stream):
+                    yield elem
 
         return StreamManager(_impl(), role=stream.role)
 
@@ -102,14 +133,7 @@ class BaseKani(Kani):
     async def full_round_stream(self, *args, **kwargs) -> AsyncIterable[StreamManager]:
         with self.run_state(RunState.RUNNING):
             async for stream in super().full_round_stream(*args, **kwargs):
-                # consume from the inner StreamManager and re-yield with bookkeeping
-                async def _impl():
-                    async for token in stream:
-                        yield token
-                        self.app.dispatch(events.StreamDelta(id=self.id, delta=token, role=stream.role))
-                    yield await stream.completion()
-
-                yield StreamManager(_impl(), role=stream.role)
+                yield StreamManager(self._wrap_stream(stream), role=stream.role)
 
     async def add_to_history(self, message: ChatMessage):
         await super().add_to_history(message)
@@ -124,6 +148,7 @@ class BaseKani(Kani):
                 id=self.id, prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens
             )
         )
+        self.app.budget_tracker.record_usage(self, completion.prompt_tokens or 0, completion.completion_tokens or 0)
         # HACK: sometimes openai's function calls are borked; we fix them here
         if message.tool_calls:
             for tc in message.tool_calls:
@@ -131,6 +156,60 @@ class BaseKani(Kani):
                     function_call.name = function_call.name.removeprefix("functions.")
         return message
 
+    # ==== streaming ====
+    async def _wrap_stream(self, stream: StreamManager) -> AsyncIterable[str | BaseCompletion]:
+        """Consume from an inner StreamManager and re-yield its elements, dispatching stream deltas along the way."""
+        try:
+            async for token in stream:
+                yield token
+                self._buffer_stream_delta(token, stream.role)
+        finally:
+            # always flush any remaining deltas once the stream finishes, before the message is added to history
+            self._flush_stream_deltas()
+        yield await stream.completion()
+
+    def _buffer_stream_delta(self, delta: str, role: ChatRole):
+        """
+        Dispatch a :class:`.events.StreamDelta` for the given token, or buffer it if the app is configured to coalesce
+        stream deltas. Buffered deltas are flushed once the app's time window has passed since the first of them was
+        buffered (even if no more tokens arrive), or once the size threshold is reached.
+        """
+        # if no one is listening for stream deltas, don't build them at all
+        if not self.app.wants_event(events.StreamDelta):
+            return
+        window = self.app.stream_coalesce_window
+        max_chars = self.app.stream_coalesce_chars
+        # no coalescing: one event per token
+        if window is None and max_chars is None:
+            self.app.dispatch(events.StreamDelta(id=self.id, delta=delta, role=role))
+            return
+
+        # don't mix roles in a single delta
+        if self._stream_buffer and role != self._stream_buffer_role:
+            self._flush_stream_deltas()
+        if not self._stream_buffer:
+            self._stream_buffer_role = role
+            # flush when the window closes, even if the model stalls before the next token
+            if window is not None:
+                self._stream_flush_timer = asyncio.get_running_loop().call_later(window, self._flush_stream_deltas)
+        self._stream_buffer.append(delta)
+        self._stream_buffer_len += len(delta)
+
+        if max_chars is not None and self._stream_buffer_len >= max_chars:
+            self._flush_stream_deltas()
+
+    def _flush_stream_deltas(self):
+        """Dispatch all buffered stream deltas as a single :class:`.events.StreamDelta`, if any are buffered."""
+        if self._stream_flush_timer is not None:
+            self._stream_flush_timer.cancel()
+            self._stream_flush_timer = None
+        if not self._stream_buffer:
+            return
+        delta = "".join(self._stream_buffer)
+        self._stream_buffer.clear()
+        self._stream_buffer_len = 0
+        self.app.dispatch(events.StreamDelta(id=self.id, delta=delta, role=self._stream_buffer_role))
+
     # ==== utils ====
     @property
     def last_user_message(self) -> ChatMessage | None:
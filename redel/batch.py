@@ -0,0 +1,336 @@
+"""
+Run a JSONL file of queries through a ReDel configuration, with bounded concurrency and resumable output.
+
+Each query is run in a fresh :class:`.ReDel` instance built from a prototype's configuration (see
+:meth:`.ReDel.get_config`), and logged to its own save directory. Results are appended to an output JSONL file as they
+finish, so an interrupted run can be resumed by running the same command again.
+
+Usage::
+
+    python -m redel.batch queries.jsonl results.jsonl --config my_experiment:proto --concurrency 8
+
+where ``my_experiment.proto`` is a ReDel instance (or a function returning one) to copy the configuration from, and
+each line of ``queries.jsonl`` is an object with an ``id`` and a ``query``.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import importlib
+import logging
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Iterable
+
+from kani import ChatRole
+from pydantic import BaseModel
+
+from . import events
+from .app import ReDel
+from .utils import read_jsonl
+
+log = logging.getLogger("redel.batch")
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PROGRESS_INTERVAL = 10
+
+_UNSAFE_PATH_CHARS = re.compile(r"[^\w.-]")
+
+
+class BatchResult(BaseModel):
+    """The result of a single query in a batch run. Written as one line of the output JSONL file."""
+
+    id: str
+    query: str
+    answer: str | None
+    """The content of the root's last assistant message, or None if the query errored."""
+    error: str | None = None
+    session_id: str | None
+    """The ID of the query's ReDel session, or None if the session could not be created."""
+    log_dir: Path
+    duration: float
+    """The wall time the query took to run, in seconds."""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class BatchStats(BaseModel):
+    """The progress of a batch run."""
+
+    total: int
+    """The number of queries in the batch, including ones completed in a previous run."""
+    skipped: int = 0
+    """The number of queries skipped because they were completed in a previous run."""
+    completed: int = 0
+    errored: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    elapsed: float = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.skipped - self.completed - self.errored
+
+    def summary(self) -> str:
+        finished = self.completed + self.errored
+        rate = finished / self.elapsed if self.elapsed else 0
+        tok_rate = (self.prompt_tokens + self.completion_tokens) / self.elapsed if self.elapsed else 0
+        eta = f"{self.remaining / rate:.0f}s" if rate else "?"
+        return (
+            f"[{finished + self.skipped}/{self.total}] {self.completed} ok, {self.errored} errored,"
+            f" {self.skipped} skipped | {rate:.2f} queries/s, {tok_rate:.0f} tokens/s | ETA {eta}"
+        )
+
+
+class BatchRunner:
+    """
+    Runs many queries through fresh copies of a ReDel configuration, at most *concurrency* at a time.
+
+    .. code-block:: python
+
+        runner = BatchRunner(proto, "results.jsonl", concurrency=8)
+        stats = await runner.run(read_jsonl("queries.jsonl"))
+    """
+
+    def __init__(
+        self,
+        redel_proto: ReDel,
+        output_fp: Path | str,
+        *,
+        log_dir: Path | str = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        timeout: float = None,
+        id_key: str = "id",
+        query_key: str = "query",
+        retry_errors: bool = True,
+        progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+        **redel_kwargs,
+    ):
+        """
+        :param redel_proto: The ReDel instance whose configuration each query's instance is built from.
+        :param output_fp: The JSONL file to append results to. If it already has results, the queries they are for are
+            skipped.
+        :param log_dir: The directory to save each query's logs in, in a subdirectory named after the query's ID (with
+            a short hash of the ID appended if it contains characters that aren't safe in a file name).
+            Defaults to a ``logs`` directory next to the output file.
+        :param concurrency: The maximum number of queries to run at once.
+        :param timeout: If set, the maximum time each query may run for, in seconds, before it is recorded as an error.
+        :param id_key: The key of each input object containing its unique ID.
+        :param query_key: The key of each input object containing the query to run.
+        :param retry_errors: Whether to rerun queries whose result in the output file is an error.
+        :param progress_interval: How often to log the batch progress, in seconds.
+        :param redel_kwargs: Additional configuration to override in each query's ReDel instance. By default, each
+            instance is titled with its query's ID, rather than asking the root engine to generate a title.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.redel_proto = redel_proto
+        self.output_fp = Path(output_fp)
+        self.log_dir = Path(log_dir) if log_dir is not None else self.output_fp.parent / "logs"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.id_key = id_key
+        self.query_key = query_key
+        self.retry_errors = retry_errors
+        self.progress_interval = progress_interval
+        self.redel_kwargs = redel_kwargs
+        self.stats = None
+
+    def get_completed_ids(self) -> set[str]:
+        """Get the IDs of the queries that already have a result in the output file."""
+        if not self.output_fp.exists():
+            return set()
+        completed = set()
+        for line in self.output_fp.read_text(encoding="utf-8").splitlines():
+            # a run killed mid-write may have left a partial line at the end
+            try:
+                result = BatchResult.model_validate_json(line)
+            except ValueError:
+                continue
+            if result.error is None or not self.retry_errors:
+                completed.add(result.id)
+            else:
+                completed.discard(result.id)
+        return completed
+
+    async def run(self, queries: Iterable[dict]) -> BatchStats:
+        """Run each of the given queries and write their results to the output file. Returns the final stats."""
+        queries = list(queries)
+        completed_ids = self.get_completed_ids()
+        todo = [q for q in queries if str(q[self.id_key]) not in completed_ids]
+        self.stats = stats = BatchStats(total=len(queries), skipped=len(queries) - len(todo))
+        log.info(
+            f"Running {len(todo)} queries ({stats.skipped} already completed) with concurrency {self.concurrency}."
+        )
+
+        self.output_fp.parent.mkdir(parents=True, exist_ok=True)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        start = time.monotonic()
+        pending = iter(todo)
+
+        with open(self.output_fp, "a", encoding="utf-8") as f:
+
+            async def worker():
+                for query in pending:
+                    result = await self.run_one(query)
+                    # one write per line, so a crash never interleaves two results
+                    f.write(result.model_dump_json() + "\n")
+                    f.flush()
+                    if result.error is None:
+                        stats.completed += 1
+                    else:
+                        stats.errored += 1
+                    stats.prompt_tokens += result.prompt_tokens
+                    stats.completion_tokens += result.completion_tokens
+
+            async def reporter():
+                while True:
+                    await asyncio.sleep(self.progress_interval)
+                    stats.elapsed = time.monotonic() - start
+                    log.info(stats.summary())
+
+            reporter_task = asyncio.create_task(reporter())
+            try:
+                await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(todo)))))
+            finally:
+                reporter_task.cancel()
+                stats.elapsed = time.monotonic() - start
+        log.info(f"Finished batch: {stats.summary()}")
+        return stats
+
+    async def run_one(self, query: dict) -> BatchResult:
+        """Run a single query in a fresh ReDel instance and return its result. Errors are recorded in the result."""
+        query_id = str(query[self.id_key])
+        log_dir = self.log_dir / query_log_dir_name(query_id)
+        ai = None
+        answer = None
+        error = None
+        prompt_tokens = completion_tokens = 0
+        start = time.monotonic()
+
+        async def _run():
+            nonlocal ai, answer, prompt_tokens, completion_tokens
+            # if we're retrying this query, overwrite the previous attempt's logs
+            # don't spend a root engine request per query on generating a title
+            config = {"title": query_id, **self.redel_kwargs}
+            ai = ReDel(**self.redel_proto.get_config(log_dir=log_dir, clear_existing_log=True, **config))
+            async for event in ai.query(query[self.query_key]):
+                if isinstance(event, events.RootMessage) and event.msg.role == ChatRole.ASSISTANT and event.msg.text:
+                    answer = event.msg.text
+                elif isinstance(event, events.TokensUsed):
+                    prompt_tokens += event.prompt_tokens
+                    completion_tokens += event.completion_tokens
+
+        try:
+            await asyncio.wait_for(_run(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            error = f"timed out after {self.timeout} seconds"
+        except Exception as e:
+            log.exception(f"Query {query_id} encountered an exception!")
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            if ai is not None:
+                await ai.close()
+        return BatchResult(
+            id=query_id,
+            query=query[self.query_key],
+            answer=answer if error is None else None,
+            error=error,
+            session_id=ai.session_id if ai is not None else None,
+            log_dir=log_dir,
+            duration=time.monotonic() - start,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+
+def query_log_dir_name(query_id: str) -> str:
+    """
+    Get the name of the directory to save a query's logs in. IDs with characters that aren't safe in a file name have
+    them replaced and a short hash of the ID appended, so that distinct IDs (e.g. ``a/b`` and ``a_b``) never share a
+    directory.
+    """
+    name = _UNSAFE_PATH_CHARS.sub("_", query_id)
+    if name != query_id:
+        name = f"{name}-{hashlib.sha256(query_id.encode()).hexdigest()[:8]}"
+    return name
+
+
+async def run_batch(redel_proto: ReDel, queries_fp: Path | str, output_fp: Path | str, **kwargs) -> BatchStats:
+    """
+    Run each query in the JSONL file at *queries_fp* and append the results to *output_fp*. Keyword arguments are
+    passed to :class:`BatchRunner`.
+    """
+    runner = BatchRunner(redel_proto, output_fp, **kwargs)
+    return await runner.run(read_jsonl(queries_fp))
+
+
+def load_config(spec: str) -> ReDel:
+    """
+    Load a ReDel prototype from a string in the form ``module:attribute``. The attribute may be a ReDel instance or a
+    function returning one.
+    """
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"Expected a config in the form 'module:attribute', got {spec!r}")
+    # allow loading configs from the working directory, like `python -m` does
+    sys.path.insert(0, os.getcwd())
+    proto = getattr(importlib.import_module(module_name), attr)
+    if callable(proto) and not isinstance(proto, ReDel):
+        proto = proto()
+    if not isinstance(proto, ReDel):
+        raise TypeError(f"{spec!r} is not a ReDel instance")
+    return proto
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of queries through a ReDel configuration.")
+    parser.add_argument("queries", type=Path, help="A JSONL file of queries to run.")
+    parser.add_argument("output", type=Path, help="The JSONL file to append results to.")
+    parser.add_argument(
+        "--config",
+        help=(
+            "The ReDel instance to copy the configuration from, as 'module:attribute'. Defaults to the default ReDel"
+            " configuration."
+        ),
+    )
+    parser.add_argument("--log-dir", type=Path, help="The directory to save each query's logs in.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="How many queries to run at once.")
+    parser.add_argument("--timeout", type=float, help="The maximum time each query may run for, in seconds.")
+    parser.add_argument("--id-key", default="id", help="The key of each query's unique ID.")
+    parser.add_argument("--query-key", default="query", help="The key of each query's text.")
+    parser.add_argument("--no-retry-errors", action="store_true", help="Don't rerun queries that errored previously.")
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=DEFAULT_PROGRESS_INTERVAL,
+        help="How often to print progress, in seconds.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    log.setLevel(logging.INFO)
+    proto = load_config(args.config) if args.config else ReDel()
+    stats = asyncio.run(
+        run_batch(
+            proto,
+            args.queries,
+            args.output,
+            log_dir=args.log_dir,
+            concurrency=args.concurrency,
+            timeout=args.timeout,
+            id_key=args.id_key,
+            query_key=args.query_key,
+            retry_errors=not args.no_retry_errors,
+            progress_interval=args.progress_interval,
+        )
+    )
+    if stats.errored:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Measure the overhead ReDel itself adds to each delegation, without calling an LLM.
+
+Every benchmark runs a ReDel system driven by a :class:`.MockEngine` with no latency, so the measured times are the
+framework's own costs: creating delegate kanis and their tools, the ``delegate()``/``wait()`` functions, dispatching
+events to listeners, and logging them to disk. Full delegation trees are run over a grid of fan-out widths and depths.
+
+Usage::
+
+    python -m redel.benchmark --widths 1 2 4 --depths 1 2 3 --repeat 5 --output bench.json
+
+The results are written as JSON (to stdout, or to the file passed as ``--output``), so they can be compared between
+commits to catch regressions in the framework's hot paths.
+"""
+
+import argparse
+import asyncio
+import datetime
+import gc
+import itertools
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated, Any
+
+from kani import AIParam, ChatMessage, ai_function
+from pydantic import BaseModel
+
+from . import events
+from ._version import __version__
+from .app import ReDel
+from .delegation.delegate_and_wait import DelegateWait
+from .kanis import ReDelKani
+from .mock_engine import MockEngine
+from .tools import ToolBase
+
+log = logging.getLogger("redel.benchmark")
+
+DEFAULT_WIDTHS = (1, 2, 4)
+DEFAULT_DEPTHS = (1, 2, 3)
+DEFAULT_REPEAT = 5
+DEFAULT_N = 100
+
+
+class BenchmarkResult(BaseModel):
+    """The timings of one benchmark at one set of parameters, in seconds."""
+
+    name: str
+    params: dict[str, Any] = {}
+    n_samples: int
+    mean: float
+    median: float
+    min: float
+    max: float
+    stdev: float
+    extra: dict[str, Any] = {}
+    """Other measurements of the benchmark (e.g. the number of events dispatched), averaged over each run."""
+
+    @classmethod
+    def from_samples(cls, name: str, samples: list[float], params: dict = None, **extra):
+        return cls(
+            name=name,
+            params=params or {},
+            n_samples=len(samples),
+            mean=statistics.fmean(samples),
+            median=statistics.median(samples),
+            min=min(samples),
+            max=max(samples),
+            stdev=statistics.stdev(samples) if len(samples) > 1 else 0,
+            extra=extra,
+        )
+
+    def summary(self) -> str:
+        params = ", ".join(f"{k}={v}" for k, v in self.params.items())
+        return (
+            f"{self.name}({params}): {_fmt_time(self.median)} median, {_fmt_time(self.mean)} mean"
+            f" (n={self.n_samples})"
+        )
+
+
+class BenchmarkReport(BaseModel):
+    """The output of a benchmark run."""
+
+    environment: dict[str, Any]
+    results: list[BenchmarkResult]
+
+
+class BenchmarkTool(ToolBase):
+    """A tool with a few cheap functions, so that tool setup costs show up in the benchmarks."""
+
+    @ai_function()
+    def lookup(self, query: Annotated[str, AIParam("What to look up.")]):
+        """Look something up."""
+        return query
+
+    @ai_function()
+    def calculate(self, expression: Annotated[str, AIParam("The expression to calculate.")], precision: int = 2):
+        """Calculate the value of an expression."""
+        return expression
+
+
+# ==== harness ====
+class _BenchmarkSystem:
+    """A ReDel system driven by a mock engine, logging to a temporary directory."""
+
+    def __init__(self, width: int = 1, depth: int = 0, **kwargs):
+        self.log_dir = tempfile.TemporaryDirectory(prefix="redel-bench-")
+        engine = MockEngine(width=width, depth=depth)
+        self.ai = ReDel(
+            root_engine=engine,
+            delegate_engine=engine,
+            delegation_scheme=DelegateWait,
+            tool_configs={BenchmarkTool: {"always_include": True}},
+            title=None,
+            log_dir=Path(self.log_dir.name),
+            **kwargs,
+        )
+
+    async def __aenter__(self) -> ReDel:
+        await self.ai.ensure_init()
+        return self.ai
+
+    async def __aexit__(self, *_):
+        await self.ai.close()
+        self.log_dir.cleanup()
+
+
+def _fmt_time(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds:.3f}s"
+
+
+# ==== benchmarks ====
+async def bench_create_delegate(n: int = DEFAULT_N, repeat: int = DEFAULT_REPEAT) -> BenchmarkResult:
+    """Time :meth:`.ReDelKani.create_delegate_kani`, including its tool setup and spawn event."""
+    samples = []
+    for _ in range(repeat):
+        async with _BenchmarkSystem() as ai:
+            for _ in range(n):
+                start = time.perf_counter()
+                await ai.root_kani.create_delegate_kani("benchmark")
+                samples.append(time.perf_counter() - start)
+    return BenchmarkResult.from_samples("create_delegate_kani", samples, {"n": n})
+
+
+async def bench_tool_setup(n: int = DEFAULT_N, repeat: int = DEFAULT_REPEAT) -> BenchmarkResult:
+    """Time constructing a delegate's delegation scheme and tools, registering their functions, and setting them up."""
+    samples = []
+    for _ in range(repeat):
+        async with _BenchmarkSystem() as ai:
+            for idx in range(n):
+                kani = ReDelKani(
+                    ai.delegate_engine, app=ai, parent=ai.root_kani, name=f"bench-{idx}", dispatch_creation=False
+                )
+                start = time.perf_counter()
+                delegator = ai.delegation_scheme(app=ai, kani=kani)
+                tools = [t(app=ai, kani=kani, **config.get("kwargs", {})) for t, config in ai.tool_configs.items()]
+                # noinspection PyProtectedMember
+                kani._register_tools(delegator=delegator, tools=tools)
+                await delegator.setup()
+                await asyncio.gather(*(t.setup() for t in tools))
+                samples.append(time.perf_counter() - start)
+    return BenchmarkResult.from_samples("tool_setup", samples, {"n": n})
+
+
+async def bench_delegate_wait(width: int, repeat: int = DEFAULT_REPEAT) -> list[BenchmarkResult]:
+    """
+    Time :meth:`.DelegateWait.delegate` (per call) and :meth:`.DelegateWait.wait` for all the helpers (per batch),
+    with helpers that answer immediately.
+    """
+    delegate_samples = []
+    wait_samples = []
+    for _ in range(repeat):
+        async with _BenchmarkSystem() as ai:
+            delegator = ai.root_kani.delegator
+            for idx in range(width):
+                start = time.perf_counter()
+                await delegator.delegate(instructions=f"benchmark task {idx}")
+                delegate_samples.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await delegator.wait(until="all")
+            wait_samples.append(time.perf_counter() - start)
+    return [
+        BenchmarkResult.from_samples("delegate", delegate_samples, {"width": width}),
+        BenchmarkResult.from_samples("wait_all", wait_samples, {"width": width}),
+    ]
+
+
+async def bench_dispatch(n: int = DEFAULT_N * 10, repeat: int = DEFAULT_REPEAT) -> list[BenchmarkResult]:
+    """
+    Time dispatching *n* message events and waiting for every listener (including the event logger) to handle them
+    (per event), then writing the session state, with those *n* messages in the root's chat history, to disk (per
+    write).
+    """
+    dispatch_samples = []
+    write_samples = []
+    for _ in range(repeat):
+        async with _BenchmarkSystem() as ai:
+            msg = ChatMessage.assistant("benchmark " * 20)
+            start = time.perf_counter()
+            for _ in range(n):
+                ai.dispatch(events.KaniMessage(id=ai.root_kani.id, msg=msg))
+            await ai._drain_events()
+            dispatch_samples.append((time.perf_counter() - start) / n)
+
+            # dispatching the events doesn't add them to the root's history, so do that for the state to be written
+            ai.root_kani.chat_history.extend(msg for _ in range(n))
+            start = time.perf_counter()
+            await ai.logger.write_state()
+            write_samples.append(time.perf_counter() - start)
+    return [
+        BenchmarkResult.from_samples("dispatch_event", dispatch_samples, {"n": n}),
+        BenchmarkResult.from_samples("write_state", write_samples, {"n_messages": n}),
+    ]
+
+
+async def bench_tree(width: int, depth: int, repeat: int = DEFAULT_REPEAT) -> BenchmarkResult:
+    """
+    Time a full query that builds a delegation tree of the given width and depth, until the round completes.
+
+    Also reports the number of delegate kanis spawned (not counting the root; ``width + width**2 + ...`` up to *depth*),
+    the time per delegation, and the number of events dispatched.
+    """
+    samples = []
+    n_spawned = []
+    n_events = []
+    for _ in range(repeat):
+        async with _BenchmarkSystem(width=width, depth=depth) as ai:
+            delegates = 0
+            count = 0
+            start = time.perf_counter()
+            async for event in ai.query("Run the benchmark."):
+                count += 1
+                # the root kani's spawn isn't a delegation
+                if isinstance(event, events.KaniSpawn) and event.id != ai.root_kani.id:
+                    delegates += 1
+            samples.append(time.perf_counter() - start)
+            n_spawned.append(delegates)
+            n_events.append(count)
+    n_delegates = statistics.fmean(n_spawned)
+    mean = statistics.fmean(samples)
+    return BenchmarkResult.from_samples(
+        "tree",
+        samples,
+        {"width": width, "depth": depth},
+        n_delegates=n_delegates,
+        n_events=statistics.fmean(n_events),
+        per_delegation=mean / n_delegates if n_delegates else None,
+        events_per_second=statistics.fmean(n_events) / mean,
+    )
+
+
+async def run_benchmarks(
+    widths=DEFAULT_WIDTHS, depths=DEFAULT_DEPTHS, repeat: int = DEFAULT_REPEAT, n: int = DEFAULT_N
+) -> list[BenchmarkResult]:
+    """Run every benchmark, with the delegation benchmarks over the grid of *widths* and *depths*."""
+    results = []
+
+    def _add(*new: BenchmarkResult):
+        for result in new:
+            log.info(result.summary())
+            results.append(result)
+
+    # don't let a collection triggered by an earlier benchmark land in a later one
+    gc.collect()
+    _add(await bench_create_delegate(n, repeat))
+    gc.collect()
+    _add(await bench_tool_setup(n, repeat))
+    gc.collect()
+    _add(*await bench_dispatch(n * 10, repeat))
+    for width in widths:
+        gc.collect()
+        _add(*await bench_delegate_wait(width, repeat))
+    for width, depth in itertools.product(widths, depths):
+        gc.collect()
+        _add(await bench_tree(width, depth, repeat))
+    return results
+
+
+def get_environment() -> dict:
+    """Information about the environment the benchmarks ran in, to include with the results."""
+    return {
+        "redel_version": __version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the overhead ReDel adds to each delegation, offline.")
+    parser.add_argument("--widths", type=int, nargs="+", default=DEFAULT_WIDTHS, help="The fan-out widths to run.")
+    parser.add_argument("--depths", type=int, nargs="+", default=DEFAULT_DEPTHS, help="The tree depths to run.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="How many times to run each benchmark.")
+    parser.add_argument(
+        "-n", type=int, default=DEFAULT_N, help="How many kanis to create in each run of the creation benchmarks."
+    )
+    parser.add_argument("--output", type=Path, help="The file to write the JSON results to (default: stdout).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    log.setLevel(logging.INFO)
+    results = asyncio.run(run_benchmarks(args.widths, args.depths, args.repeat, args.n))
+    output = BenchmarkReport(environment=get_environment(), results=results).model_dump_json(indent=2)
+    if args.output:
+        args.output.write_text(output, encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
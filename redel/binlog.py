@@ -0,0 +1,176 @@
+"""
+A compact binary format for ReDel event logs.
+
+A binary event log starts with the 4-byte magic string ``RDL1``, followed by a sequence of length-prefixed frames.
+Each frame has a 5-byte header (a 1-byte flags field and a 4-byte little-endian payload length) and a payload of one or
+more msgpack-encoded event dicts. If the ``FLAG_COMPRESSED`` bit is set, the payload is zlib-compressed.
+
+Uncompressed logs write one event per frame. Compressed logs buffer events into blocks of roughly ``block_size`` bytes
+and compress each block as a single frame, which is where most of the savings on repetitive events come from.
+
+To convert a binary log back to JSONL, use :func:`binlog_to_jsonl` or run ``python -m redel.binlog <src> <dst>``.
+"""
+
+import io
+import json
+import logging
+import struct
+import zlib
+from typing import BinaryIO, Iterable
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"RDL1"
+FRAME_HEADER = struct.Struct("<BI")
+FLAG_COMPRESSED = 0x01
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+def _ensure_msgpack():
+    if msgpack is None:
+        raise ImportError(
+            "You are missing required dependencies to use binary event logs. Please install ReDel using `pip install"
+            ' "redel[binlog]"`.'
+        )
+
+
+class BinaryLogWriter:
+    """Writes events to a binary event log. Not thread-safe."""
+
+    def __init__(self, f: BinaryIO, compression: bool = False, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        :param f: A file opened in binary write or append mode. If it is empty, the magic header will be written.
+        :param compression: Whether to buffer events into zlib-compressed blocks.
+        :param block_size: If compression is enabled, the uncompressed size of a block before it is written.
+        """
+        _ensure_msgpack()
+        self.f = f
+        self.compression = compression
+        self.block_size = block_size
+        self._packer = msgpack.Packer()
+        self._block = []
+        self._block_len = 0
+
+        self.position = self.f.seek(0, io.SEEK_END)
+        """The byte offset at which the next frame will be written."""
+        if self.position == 0:
+            self.f.write(MAGIC)
+            self.position = len(MAGIC)
+
+    def write(self, event: dict) -> int:
+        """
+        Write a single JSON-serializable event to the log.
+
+        Returns the byte offset of the frame containing the event. If compression is enabled, multiple events will
+        share the same frame offset.
+        """
+        data = self._packer.pack(event)
+        if not self.compression:
+            offset = self.position
+            self._write_frame(data, 0)
+            return offset
+        self._block.append(data)
+        self._block_len += len(data)
+        # this block will be written at the current position
+        offset = self.position
+        if self._block_len >= self.block_size:
+            self.flush_block()
+        return offset
+
+    def flush_block(self):
+        """Compress and write any buffered events as a single frame."""
+        if not self._block:
+            return
+        self._write_frame(zlib.compress(b"".join(self._block)), FLAG_COMPRESSED)
+        self._block.clear()
+        self._block_len = 0
+
+    def flush(self):
+        """Write any buffered events and flush the underlying file."""
+        self.flush_block()
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def _write_frame(self, payload: bytes, flags: int):
+        frame = FRAME_HEADER.pack(flags, len(payload)) + payload
+        self.f.write(frame)
+        self.position += len(frame)
+
+
+def iter_frames(f: BinaryIO) -> Iterable[tuple[int, int, bytes]]:
+    """
+    Yield (offset, flags, payload) tuples from a binary event log file opened in binary mode and positioned at the
+    start of a frame. Stops at the end of the file, or at a truncated frame (e.g. if the writer crashed mid-write).
+    """
+    offset = f.tell()
+    while header := f.read(FRAME_HEADER.size):
+        if len(header) < FRAME_HEADER.size:
+            log.warning(f"Binary event log {f.name} ends with a truncated frame header; ignoring it.")
+            return
+        flags, length = FRAME_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            log.warning(f"Binary event log {f.name} ends with a truncated frame; ignoring it.")
+            return
+        yield offset, flags, payload
+        offset += FRAME_HEADER.size + length
+
+
+def decode_frame(flags: int, payload: bytes) -> list[dict]:
+    """Decode all the events in a single frame's payload."""
+    _ensure_msgpack()
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(payload)
+    return list(unpacker)
+
+
+def read_binlog(fp, offset: int = 0) -> Iterable[dict]:
+    """
+    Yield events from the binary event log at the given path. The events are the same dicts that :func:`.read_jsonl`
+    yields for the equivalent JSONL log.
+
+    :param offset: If given, start reading from the frame starting at this byte offset rather than the start of the
+        file.
+    """
+    _ensure_msgpack()
+    with open(fp, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{fp} is not a ReDel binary event log")
+        if offset:
+            f.seek(offset)
+        for _, flags, payload in iter_frames(f):
+            yield from decode_frame(flags, payload)
+
+
+def binlog_to_jsonl(src, dst):
+    """Export the binary event log at *src* to a JSONL event log at *dst*. Returns the number of events exported."""
+    n = 0
+    with open(dst, "w", encoding="utf-8") as f:
+        for event in read_binlog(src):
+            f.write(json.dumps(event, separators=(",", ":"), ensure_ascii=False))
+            f.write("\n")
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export a ReDel binary event log to JSONL.")
+    parser.add_argument("src", help="The path to the binary event log (e.g. events.bin).")
+    parser.add_argument("dst", help="The path to write the JSONL event log to (e.g. events.jsonl).")
+    args = parser.parse_args()
+    print(f"Exported {binlog_to_jsonl(args.src, args.dst)} events to {args.dst}.")
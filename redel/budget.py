@@ -0,0 +1,231 @@
+"""
+Track the tokens (and cost) used by each kani, and enforce budgets on subtrees of the delegation tree.
+
+Each kani's usage counts against its own subtree and the subtree of every ancestor, so a budget on a kani bounds the
+total spend of everything it delegates to. Budgets are set on the whole tree (i.e. the root's subtree) and/or on each
+subtree rooted at a given depth. Once a subtree has used most of its budget, the kanis in it are told to wrap up and
+answer without calling any more functions; once it is over budget, each of them gets one last request (without
+functions) to give its final answer, and any requests after that are refused.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Iterable, TYPE_CHECKING
+
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    from .base_kani import BaseKani
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WRAP_UP_THRESHOLD = 0.8
+WRAP_UP_PROMPT = (
+    "You are about to run out of budget. Do not delegate or call any more functions; reply now with your best answer"
+    " based on what you have found so far."
+)
+
+
+@dataclass
+class Budget:
+    """A limit on the tokens and/or cost that a subtree of kanis may use."""
+
+    max_tokens: int | None = None
+    """The maximum number of prompt and completion tokens the subtree may use."""
+    max_cost: float | None = None
+    """The maximum cost the subtree may incur, according to the ReDel instance's ``token_costs``."""
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a kani tries to call its engine, but its subtree (or one of its ancestors') is over budget and it has
+    already made its final wrap-up request.
+    """
+
+    def __init__(self, kani: "BaseKani", scope: "BaseKani", reason: str):
+        self.kani = kani
+        self.scope = scope
+        self.reason = reason
+        if scope is kani:
+            msg = f"{kani.name} is over budget ({reason})."
+        else:
+            msg = f"{kani.name} cannot continue: the budget for {scope.name}'s delegation tree is exhausted ({reason})."
+        super().__init__(msg)
+
+
+class NodeSpend(BaseModel):
+    """The usage of a single kani and its subtree."""
+
+    id: str
+    name: str
+    parent: str | None
+    depth: int
+    prompt_tokens: int = 0
+    """The prompt tokens used by this kani's own requests."""
+    completion_tokens: int = 0
+    """The completion tokens used by this kani's own requests."""
+    cost: float = 0
+    subtree_prompt_tokens: int = 0
+    """The prompt tokens used by this kani and all of its descendants."""
+    subtree_completion_tokens: int = 0
+    """The completion tokens used by this kani and all of its descendants."""
+    subtree_cost: float = 0
+
+    @property
+    def subtree_tokens(self) -> int:
+        return self.subtree_prompt_tokens + self.subtree_completion_tokens
+
+
+class BudgetTracker:
+    """
+    Records the usage of each kani in a :class:`.ReDel` system, aggregated up the delegation tree, and checks it
+    against the configured budgets. Available as :attr:`.ReDel.budget_tracker`.
+    """
+
+    def __init__(
+        self,
+        budget: Budget = None,
+        depth_budgets: dict[int, Budget] = None,
+        token_costs: tuple[float, float] = None,
+        wrap_up_threshold: float = DEFAULT_WRAP_UP_THRESHOLD,
+    ):
+        """
+        :param budget: The budget for the whole delegation tree.
+        :param depth_budgets: A mapping of depth to the budget for each subtree rooted at a kani of that depth.
+        :param token_costs: The cost of each (prompt token, completion token), used to calculate cost budgets.
+        :param wrap_up_threshold: The fraction of a budget after which the kanis under it are told to wrap up.
+        """
+        if (budget and budget.max_cost is not None) or any(
+            b.max_cost is not None for b in (depth_budgets or {}).values()
+        ):
+            if token_costs is None:
+                raise ValueError("token_costs must be set to use a budget with a max_cost.")
+        self.budget = budget
+        self.depth_budgets = depth_budgets or {}
+        self.token_costs = token_costs
+        self.wrap_up_threshold = wrap_up_threshold
+        self.spend: dict[str, NodeSpend] = {}
+        """The usage of each kani that has used any tokens, by ID, in the order they first used them."""
+        self._exceeded = set()  # ids of kanis whose subtree has gone over budget, to only warn once
+        self._wrapped_up = set()  # ids of kanis that have made their final request while over budget
+
+    # ==== recording ====
+    def record_usage(self, kani: "BaseKani", prompt_tokens: int, completion_tokens: int):
+        """Record tokens used by a kani's request, against its own usage and the subtree usage of its ancestors."""
+        cost = self._cost(prompt_tokens, completion_tokens)
+        node = self._get_node(kani)
+        node.prompt_tokens += prompt_tokens
+        node.completion_tokens += completion_tokens
+        node.cost += cost
+        for ancestor in _ancestors(kani):
+            node = self._get_node(ancestor)
+            node.subtree_prompt_tokens += prompt_tokens
+            node.subtree_completion_tokens += completion_tokens
+            node.subtree_cost += cost
+            if ancestor.id not in self._exceeded and self._usage_fraction(ancestor) >= 1:
+                self._exceeded.add(ancestor.id)
+                log.warning(f"The delegation tree of {ancestor.name} has gone over budget.")
+
+    def _get_node(self, kani: "BaseKani") -> NodeSpend:
+        node = self.spend.get(kani.id)
+        if node is None:
+            node = self.spend[kani.id] = NodeSpend(
+                id=kani.id,
+                name=kani.name,
+                parent=kani.parent.id if kani.parent is not None else None,
+                depth=kani.depth,
+            )
+        return node
+
+    def _cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        if self.token_costs is None:
+            return 0
+        prompt_cost, completion_cost = self.token_costs
+        return prompt_tokens * prompt_cost + completion_tokens * completion_cost
+
+    # ==== checking ====
+    def get_budget(self, kani: "BaseKani") -> Budget | None:
+        """Get the budget for the subtree rooted at the given kani, if it has one."""
+        if kani.parent is None and self.budget is not None:
+            return self.budget
+        return self.depth_budgets.get(kani.depth)
+
+    def _usage_fraction(self, kani: "BaseKani") -> float:
+        """The fraction of its budget the subtree rooted at the given kani has used (0 if it has no budget)."""
+        budget = self.get_budget(kani)
+        node = self.spend.get(kani.id)
+        if budget is None or node is None:
+            return 0
+        fraction = 0
+        if budget.max_tokens is not None:
+            fraction = max(fraction, node.subtree_tokens / budget.max_tokens if budget.max_tokens else 1)
+        if budget.max_cost is not None:
+            fraction = max(fraction, node.subtree_cost / budget.max_cost if budget.max_cost else 1)
+        return fraction
+
+    def _most_constrained(self, kani: "BaseKani") -> tuple["BaseKani", float]:
+        """Get the kani (out of the given kani and its ancestors) whose subtree has used the most of its budget."""
+        return max(((k, self._usage_fraction(k)) for k in _ancestors(kani)), key=lambda pair: pair[1])
+
+    def should_wrap_up(self, kani: "BaseKani") -> bool:
+        """Whether the given kani should wrap up, because a subtree it is part of is almost or already out of budget."""
+        return self._most_constrained(kani)[1] >= min(self.wrap_up_threshold, 1)
+
+    def is_over_budget(self, kani: "BaseKani") -> bool:
+        """Whether a subtree the given kani is part of is over budget."""
+        return self._most_constrained(kani)[1] >= 1
+
+    def check(self, kani: "BaseKani"):
+        """
+        Check whether the given kani may make a request to its engine. Raise :class:`BudgetExceeded` if a subtree it is
+        part of is over budget, unless this is the kani's first request since then - each kani gets one last request
+        (which should not include any functions; see :meth:`should_wrap_up`) to give its final answer.
+        """
+        scope, fraction = self._most_constrained(kani)
+        if fraction < 1:
+            return
+        if kani.id not in self._wrapped_up:
+            self._wrapped_up.add(kani.id)
+            return
+        node = self.spend[scope.id]
+        budget = self.get_budget(scope)
+        if budget.max_tokens is not None and node.subtree_tokens >= budget.max_tokens:
+            reason = f"used {node.subtree_tokens} of {budget.max_tokens} tokens"
+        else:
+            reason = f"spent {node.subtree_cost:.4g} of {budget.max_cost:.4g}"
+        raise BudgetExceeded(kani, scope, reason)
+
+    # ==== reporting ====
+    def summary(self) -> list[NodeSpend]:
+        """Get the usage of each kani that has used any tokens, and of its subtree."""
+        return list(self.spend.values())
+
+    def format_summary(self) -> str:
+        """Get a human-readable table of the usage of each kani, in tree order."""
+        children: dict[str | None, list[NodeSpend]] = {}
+        for node in self.spend.values():
+            # a kani whose parent never used any tokens is listed at the top level
+            parent = node.parent if node.parent in self.spend else None
+            children.setdefault(parent, []).append(node)
+
+        def _walk(parent_id):
+            for child in children.get(parent_id, ()):
+                yield child
+                yield from _walk(child.id)
+
+        lines = []
+        for node in _walk(None):
+            label = "  " * node.depth + node.name
+            line = f"{label:<32} own: {node.prompt_tokens + node.completion_tokens:>8} tok"
+            line += f"  subtree: {node.subtree_tokens:>8} tok"
+            if self.token_costs is not None:
+                line += f"  cost: {node.cost:.4f} (subtree {node.subtree_cost:.4f})"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def _ancestors(kani: "BaseKani") -> Iterable["BaseKani"]:
+    """The given kani, then each of its ancestors up to the root."""
+    while kani is not None:
+        yield kani
+        kani = kani.parent
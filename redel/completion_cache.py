@@ -0,0 +1,230 @@
+"""
+Record LLM completions to disk and replay them, so that rerunning a configuration doesn't pay for every call again.
+
+A :class:`CachedEngine` wraps another engine and keys each completion on a hash of everything that determines it: the
+prompt, the functions the model can call, and the generation parameters. Recorded sessions can then be replayed
+deterministically at disk speed, e.g. to debug one kani deep in a tree without rerunning the calls that led up to it.
+"""
+
+import enum
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import AsyncIterable, Iterable
+
+from kani import AIFunction, ChatMessage
+from kani.engines.base import BaseCompletion, BaseEngine, Completion, WrapperEngine
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = config.REDEL_CACHE_DIR / "completions"
+# the current time, as formatted in the default system prompts (see kanis.get_system_prompt)
+SYSTEM_PROMPT_TIME_PATTERN = re.compile(r"\b\w{3} \d{2} \w{3} \d{4}, \d{2}:\d{2}[AP]M\b")
+
+_UNSAFE_PATH_CHARS = re.compile(r"[^\w.-]")
+
+
+class CacheMode(enum.Enum):
+    """
+    How a :class:`CachedEngine` uses its cache.
+
+    * ``CacheMode.READ_THROUGH``: Return the cached completion if there is one, otherwise call the wrapped engine and
+      cache its completion.
+    * ``CacheMode.RECORD``: Always call the wrapped engine, and cache (or overwrite) its completion.
+    * ``CacheMode.REPLAY``: Only return cached completions. A request that isn't in the cache raises a
+      :class:`CacheMissError` instead of calling the wrapped engine.
+    """
+
+    READ_THROUGH = "read_through"
+    RECORD = "record"
+    REPLAY = "replay"
+
+
+class CacheMissError(KeyError):
+    """Raised by a :class:`CachedEngine` in replay mode when a request has not been recorded."""
+
+    def __init__(self, key: str):
+        super().__init__(key)
+        self.key = key
+
+    def __str__(self):
+        return (
+            f"The completion for this request (key {self.key}) has not been recorded. If the prompt should be the same"
+            " as when it was recorded, check for values that change between runs (e.g. timestamps or random IDs) and"
+            " add them to the engine's ignore_patterns."
+        )
+
+
+class CachedEngine(WrapperEngine):
+    """
+    A wrapper engine that records the wrapped engine's completions to disk and replays them.
+
+    .. code-block:: python
+
+        engine = CachedEngine(OpenAIEngine(model="gpt-4o"), mode=CacheMode.READ_THROUGH)
+        ai = ReDel(root_engine=engine, delegate_engine=engine)
+
+    Completions are keyed on a hash of the engine's model, the chat messages, the functions (their names, descriptions,
+    and parameter schemas), and the generation parameters (both the engine's and the request's). Parts of the messages
+    that change between runs without changing the meaning of the prompt - by default, the current time in the default
+    system prompts - are masked out of the key by *ignore_patterns*.
+
+    Streamed requests are cached too: a cached completion is replayed as a single chunk of text.
+
+    This engine will pass-through attribute accesses to the wrapped engine.
+    """
+
+    def __init__(
+        self,
+        engine: BaseEngine,
+        cache_dir: Path | str = DEFAULT_CACHE_DIR,
+        mode: CacheMode | str = CacheMode.READ_THROUGH,
+        *args,
+        namespace: str = None,
+        ignore_patterns: Iterable[re.Pattern | str] = (SYSTEM_PROMPT_TIME_PATTERN,),
+        **kwargs,
+    ):
+        """
+        :param engine: The engine to wrap.
+        :param cache_dir: The directory to store completions in. Defaults to a directory in the ReDel cache (see
+            ``REDEL_CACHE_DIR``).
+        :param mode: How to use the cache (see :class:`CacheMode`).
+        :param namespace: A name for the wrapped engine's model, included in each completion's key so that different
+            models never share completions. Defaults to the engine's ``model`` attribute, or its class name.
+        :param ignore_patterns: Regular expressions matching parts of the message text to leave out of each completion's
+            key.
+        """
+        super().__init__(engine, *args, **kwargs)
+        self.cache_dir = Path(cache_dir)
+        self.mode = CacheMode(mode)
+        if namespace is None:
+            namespace = str(getattr(engine, "model", None) or type(engine).__name__)
+        self.namespace = namespace
+        self.ignore_patterns = [re.compile(p) for p in ignore_patterns]
+
+        self.n_hits = 0
+        """The number of requests served from the cache."""
+        self.n_misses = 0
+        """The number of requests sent to the wrapped engine."""
+
+    # ==== keys ====
+    def _canonical_text(self, text: str) -> str:
+        for pattern in self.ignore_patterns:
+            text = pattern.sub("<ignored>", text)
+        return text
+
+    def _canonical_message(self, message: ChatMessage) -> dict:
+        data = message.model_dump(mode="json")
+        if isinstance(data["content"], str):
+            data["content"] = self._canonical_text(data["content"])
+        elif data["content"] is not None:
+            # message parts - the text is all we can normalize
+            data["content"] = [
+                self._canonical_text(part) if isinstance(part, str) else part for part in data["content"]
+            ]
+        return data
+
+    def cache_key(self, messages: list[ChatMessage], functions: list[AIFunction] | None, **hyperparams) -> str:
+        """Get the key a request's completion is cached under: a hash of everything that determines the completion."""
+        request = {
+            "namespace": self.namespace,
+            "messages": [self._canonical_message(m) for m in messages],
+            "functions": [
+                {"name": f.name, "desc": f.desc, "parameters": f.json_schema}
+                for f in sorted(functions or (), key=lambda f: f.name)
+            ],
+            "hyperparams": {**getattr(self.engine, "hyperparams", {}), **hyperparams},
+        }
+        data = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=repr)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _cache_path(self, key: str) -> Path:
+        return self.cache_dir / _UNSAFE_PATH_CHARS.sub("_", self.namespace) / f"{key}.json"
+
+    # ==== storage ====
+    def get_cached(self, key: str) -> Completion | None:
+        """Get the completion cached under the given key, or None if there isn't one."""
+        fp = self._cache_path(key)
+        try:
+            data = json.loads(fp.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            log.warning(f"Could not read cached completion {fp}; ignoring it.")
+            return None
+        return Completion(
+            message=ChatMessage.model_validate(data["message"]),
+            prompt_tokens=data["prompt_tokens"],
+            completion_tokens=data["completion_tokens"],
+        )
+
+    def save_completion(self, key: str, completion: BaseCompletion):
+        """Cache a completion under the given key."""
+        fp = self._cache_path(key)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "key": key,
+            "namespace": self.namespace,
+            "timestamp": time.time(),
+            "message": completion.message.model_dump(mode="json"),
+            "prompt_tokens": completion.prompt_tokens,
+            "completion_tokens": completion.completion_tokens,
+        }
+        # write to a temp file and rename, so concurrent readers never see a partial completion
+        fd, tmp_path = tempfile.mkstemp(dir=fp.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, fp)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _lookup(self, key: str) -> Completion | None:
+        if self.mode == CacheMode.RECORD:
+            return None
+        completion = self.get_cached(key)
+        if completion is None and self.mode == CacheMode.REPLAY:
+            raise CacheMissError(key)
+        return completion
+
+    # ==== engine ====
+    async def predict(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> BaseCompletion:
+        key = self.cache_key(messages, functions, **hyperparams)
+        cached = self._lookup(key)
+        if cached is not None:
+            self.n_hits += 1
+            return cached
+        self.n_misses += 1
+        completion = await self.engine.predict(messages, functions, **hyperparams)
+        self.save_completion(key, completion)
+        return completion
+
+    async def stream(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> AsyncIterable[str | BaseCompletion]:
+        key = self.cache_key(messages, functions, **hyperparams)
+        cached = self._lookup(key)
+        if cached is not None:
+            self.n_hits += 1
+            if cached.message.text:
+                yield cached.message.text
+            yield cached
+            return
+        self.n_misses += 1
+        async for elem in self.engine.stream(messages, functions, **hyperparams):
+            if isinstance(elem, BaseCompletion):
+                self.save_completion(key, elem)
+            yield elem
+
+    def __repr__(self):
+        return f"{type(self).__name__}(engine={self.engine!r}, mode={self.mode})"
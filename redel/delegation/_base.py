@@ -4,6 +4,7 @@ from redel.tools import ToolBase
 
 if TYPE_CHECKING:
     from redel.kanis import ReDelKani
+    from redel.state import KaniState
 
 
 class DelegationBase(ToolBase):
@@ -13,10 +14,14 @@ class DelegationBase(ToolBase):
     It extends :class:`.ToolBase` with an interface for creating delegate kani instances.
     """
 
-    async def create_delegate_kani(self, instructions: str) -> "ReDelKani":
+    async def create_delegate_kani(self, instructions: str, name: str = None) -> "ReDelKani":
         r"""
         Call this method to get a fresh :class:`.ReDelKani` instance.
 
+        :param instructions: The instructions the delegate will be given.
+        :param name: The name of the delegate, if it was already reserved from the calling kani's ``namer``. Otherwise,
+            the next name is used.
+
         This method will handle setting up the new kani in the computation graph as well as its tools, engine, and
         always included prompt based on the app configuration. It will *not* launch the kani with the given
         instructions -- this must be done by the calling function.
@@ -28,4 +33,17 @@ class DelegationBase(ToolBase):
         * Buffering the delegate's response and returning it to the caller
         * Calling the appropriate cleanup methods of the delegate
         """
-        return await self.kani.create_delegate_kani(instructions)
+        return await self.kani.create_delegate_kani(instructions, name=name)
+
+    def restore_delegate(self, state: "KaniState"):
+        """
+        Called when a kani is restored from a saved session, with the saved state of each of its delegates. The
+        delegates are *dormant*: they are only rebuilt when :meth:`hydrate_delegate` is called.
+
+        Override this method to keep track of restored delegates (e.g., so that they can be asked follow-up questions).
+        """
+        pass
+
+    async def hydrate_delegate(self, state: "KaniState") -> "ReDelKani":
+        """Rebuild a dormant delegate passed to :meth:`restore_delegate` (or get it, if it was already rebuilt)."""
+        return await self.app.hydrate_kani(state.id)
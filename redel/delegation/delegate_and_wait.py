@@ -1,27 +1,95 @@
 import asyncio
+import contextlib
 import logging
 from typing import Annotated
 
 from kani import AIParam, ChatRole, ai_function
 from rapidfuzz import fuzz
 
-from redel.state import RunState
+from redel.budget import BudgetExceeded
+from redel.state import KaniState, RunState
 from ._base import DelegationBase
 
 log = logging.getLogger(__name__)
 
 
+class HelperSlots:
+    """
+    A session-wide cap on the number of helpers running at once (see ``max_running_helpers`` in :class:`.ReDel`).
+
+    Helpers waiting for a slot are admitted in the order they were delegated. A helper that is itself waiting on its
+    own helpers gives up its slot until they finish, so that nested delegation can't deadlock.
+    """
+
+    def __init__(self, max_running: int):
+        self.max_running = max_running
+        self.n_waiting = 0
+        """The number of helpers waiting for a slot."""
+        self._semaphore = asyncio.Semaphore(max_running)
+        self._holders = set()  # ids of the kanis holding a slot
+
+    @property
+    def is_full(self) -> bool:
+        """Whether a new helper would have to wait for a slot."""
+        return self._semaphore.locked()
+
+    async def acquire(self):
+        """Wait for a slot. The caller must :meth:`hold` it for a kani, or :meth:`release` it."""
+        self.n_waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.n_waiting -= 1
+
+    def hold(self, kani_id: str):
+        """Record that the given kani is running in an acquired slot."""
+        self._holders.add(kani_id)
+
+    def release(self, kani_id: str = None):
+        """Release the slot held by the given kani (if it holds one), or an acquired slot that was never held."""
+        if kani_id is not None:
+            if kani_id not in self._holders:
+                return
+            self._holders.discard(kani_id)
+        self._semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def yielded(self, kani_id: str):
+        """Give up the given kani's slot (if it holds one) for the duration of the block, e.g. while it waits."""
+        if kani_id not in self._holders:
+            yield
+            return
+        self.release(kani_id)
+        try:
+            yield
+        finally:
+            await self.acquire()
+            self.hold(kani_id)
+
+
 class DelegateWait(DelegationBase):
     """
     Does not immediately wait for a sub-agent after delegating a task; agents must be explicitly waited by using
     ``wait()`` instead. This lets models without the ability to perform parallel function calling spawn multiple agents
     in parallel by calling ``delegate()`` multiple times before calling ``wait()``.
+
+    If the app sets ``max_helpers_per_kani`` or ``max_running_helpers``, helpers delegated beyond those caps are queued
+    (and only created once they can run), and the model is told that its request was queued.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.helpers = {}  # name -> delegate
         self.helper_futures = {}  # name -> Future[tuple[str, str]]
+        # admission
+        max_helpers = self.app.max_helpers_per_kani
+        self.helper_slots = asyncio.Semaphore(max_helpers) if max_helpers else None
+        self.n_queued = 0
+        """The number of this kani's helpers waiting to be admitted."""
+
+    def restore_delegate(self, state):
+        # hydrated when they're asked a follow-up
+        self.helpers[state.name] = state
 
     @ai_function()
     async def delegate(
@@ -47,6 +115,9 @@ class DelegateWait(DelegationBase):
         If the user's query can be resolved in parallel, call this multiple times then use wait("all").
         """
         log.info(f"Delegated with instructions: {instructions}")
+        # don't spawn more work once we're over budget
+        if self.app.budget_tracker.is_over_budget(self.kani):
+            return "You are out of budget and cannot delegate any more. Reply now with your best answer."
         # if the instructions are >80% the same as the current goal, bonk
         if self.kani.last_user_message and fuzz.ratio(instructions, self.kani.last_user_message.content) > 80:
             return (
@@ -55,33 +126,116 @@ class DelegateWait(DelegationBase):
             )
 
         # find or set up the helper
+        if who and who in self.helper_futures:
+            return (
+                f"{who!r} is currently busy. You can leave `who` empty to find a new available helper or wait on"
+                f" {who!r} and retry."
+            )
         if who and who in self.helpers:
-            if who in self.helper_futures:
-                return (
-                    f"{who!r} is currently busy. You can leave `who` empty to find a new available helper or wait on"
-                    f" {who!r} and retry."
-                )
             helper = self.helpers[who]
+            if isinstance(helper, KaniState):
+                helper = self.helpers[who] = await self.hydrate_delegate(helper)
+                if who in self.helper_futures:
+                    return f"{who!r} is currently busy. You can leave `who` empty to find a new available helper."
+            name = helper.name
         else:
-            helper = await self.create_delegate_kani(instructions)
-            self.helpers[helper.name] = helper
+            helper = None
+            name = None
+
+        # if we're at a cap on running helpers, the helper waits in line - and isn't created until it can run
+        n_ahead = self._n_ahead()
+        if n_ahead is None:
+            # not at a cap: the slots are free, so this does not block
+            await self._acquire_slots()
+            if helper is None:
+                try:
+                    helper = await self.create_delegate_kani(instructions)
+                except BaseException:
+                    self._release_slots()
+                    raise
+                self.helpers[helper.name] = helper
+                name = helper.name
+            self._hold_slot(helper)
+        elif name is None:
+            name = self.kani.namer.get_name()
 
         async def _task():
+            nonlocal helper
             try:
-                result = []
-                async for stream in helper.full_round_stream(instructions):
-                    msg = await stream.message()
-                    log.info(f"{helper.name}-{helper.depth}: {msg}")
-                    if msg.role == ChatRole.ASSISTANT and msg.content:
-                        result.append(msg.content)
-                await helper.cleanup()
-                return "\n".join(result), helper.name
+                if n_ahead is not None:
+                    self.n_queued += 1
+                    try:
+                        await self._acquire_slots()
+                    finally:
+                        self.n_queued -= 1
+                    if helper is None:
+                        try:
+                            helper = await self.create_delegate_kani(instructions, name=name)
+                        except BaseException:
+                            self._release_slots()
+                            raise
+                        self.helpers[name] = helper
+                    self._hold_slot(helper)
+                try:
+                    result = []
+                    async for stream in helper.full_round_stream(instructions):
+                        msg = await stream.message()
+                        log.info(f"{helper.name}-{helper.depth}: {msg}")
+                        if msg.role == ChatRole.ASSISTANT and msg.content:
+                            result.append(msg.content)
+                    await helper.cleanup()
+                    return "\n".join(result), name
+                finally:
+                    self._release_slots(helper)
+            except BudgetExceeded as e:
+                # running out of budget is expected - report it like any other result
+                log.warning(f"{name}-{self.kani.depth + 1} stopped: {e}")
+                return str(e), name
             except Exception as e:
-                log.exception(f"{helper.name}-{helper.depth} encountered an exception!")
-                return f"encountered an exception: {e}", helper.name
+                log.exception(f"{name}-{self.kani.depth + 1} encountered an exception!")
+                return f"encountered an exception: {e}", name
+
+        self.helper_futures[name] = asyncio.create_task(_task())
+        if n_ahead is not None:
+            return (
+                f"{name!r} will help you with this request once one of the running helpers finishes, because too many"
+                f" helpers are running right now ({n_ahead} other request(s) are queued ahead of it). You can keep"
+                " working, or use wait() to get its result as usual."
+            )
+        return f"{name!r} is helping you with this request."
 
-        self.helper_futures[helper.name] = asyncio.create_task(_task())
-        return f"{helper.name!r} is helping you with this request."
+    # ==== admission ====
+    def _n_ahead(self) -> int | None:
+        """If a new helper would have to wait to be admitted, the number of helpers queued ahead of it."""
+        if self.helper_slots is not None and self.helper_slots.locked():
+            return self.n_queued
+        session_slots = self.app.helper_slots
+        if session_slots is not None and session_slots.is_full:
+            return self.n_queued + session_slots.n_waiting
+        return None
+
+    async def _acquire_slots(self):
+        # take our own slot first, so we don't hold a session slot while waiting on our siblings
+        if self.helper_slots is not None:
+            await self.helper_slots.acquire()
+        if self.app.helper_slots is not None:
+            try:
+                await self.app.helper_slots.acquire()
+            except BaseException:
+                if self.helper_slots is not None:
+                    self.helper_slots.release()
+                raise
+
+    def _hold_slot(self, helper):
+        if self.app.helper_slots is not None:
+            self.app.helper_slots.hold(helper.id)
+
+    def _release_slots(self, helper=None):
+        """Release the slots of a helper that has finished (or of a helper that was never created, if None)."""
+        if self.helper_slots is not None:
+            self.helper_slots.release()
+        if self.app.helper_slots is not None:
+            self.app.helper_slots.release(helper.id if helper is not None else None)
 
     @ai_function(auto_truncate=6000)
     async def wait(
@@ -97,8 +251,10 @@ class DelegateWait(DelegationBase):
 
         if until == "next":
             with self.kani.run_state(RunState.WAITING):
-                done, _ = await asyncio.wait(self.helper_futures.values(), return_when=asyncio.FIRST_COMPLETED)
-            future = done.pop()
+                async with self._waiting():
+                    done, _ = await asyncio.wait(self.helper_futures.values(), return_when=asyncio.FIRST_COMPLETED)
+            # if several finished at once, take the first delegated (sets of futures are in no particular order)
+            future = next(f for f in self.helper_futures.values() if f in done)
             # prompt with name
             result, helper_name = future.result()
             # cleanup from task list
@@ -106,10 +262,14 @@ class DelegateWait(DelegationBase):
             return f"{helper_name}:\n{result}"
         elif until == "all":
             with self.kani.run_state(RunState.WAITING):
-                done, _ = await asyncio.wait(self.helper_futures.values(), return_when=asyncio.ALL_COMPLETED)
-            # prompt with name
+                async with self._waiting():
+                    done, _ = await asyncio.wait(self.helper_futures.values(), return_when=asyncio.ALL_COMPLETED)
+            # prompt with name, in the order the helpers were delegated, so that the result (and so the next prompt) is
+            # the same on every run
             results = []
-            for future in done:
+            for future in self.helper_futures.values():
+                if future not in done:
+                    continue
                 result, helper_name = future.result()
                 results.append(f"{helper_name}:\n{result}")
             # cleanup from task list
@@ -118,5 +278,12 @@ class DelegateWait(DelegationBase):
         else:
             future = self.helper_futures.pop(until)
             with self.kani.run_state(RunState.WAITING):
-                result, _ = await future
+                async with self._waiting():
+                    result, _ = await future
             return f"{until}:\n{result}"
+
+    def _waiting(self):
+        # if this kani is a helper holding a session slot, let other helpers (e.g., its own) run while it waits
+        if self.app.helper_slots is None:
+            return contextlib.nullcontext()
+        return self.app.helper_slots.yielded(self.kani.id)
@@ -0,0 +1,274 @@
+"""
+Utilities for random access into saved event logs.
+
+As it writes events, the :class:`.EventLogger` maintains an offset index alongside the event log
+(e.g. ``events.jsonl.idx``). The index contains one fixed-width record per event: the byte offset of the event (or the
+frame containing it, for binary logs), a code for the event's type, and a code for the ID of the kani the event
+refers to. The tables mapping these codes back to strings are stored in the event log's metadata sidecar
+(e.g. ``events.jsonl.meta``).
+
+Use :class:`EventLogReader` to seek to a given event or iterate over the events of a single kani or type without
+reading the entire log.
+"""
+
+import array
+import bisect
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterable
+
+from .binlog import MAGIC, decode_frame, iter_frames
+
+log = logging.getLogger(__name__)
+
+INDEX_RECORD = struct.Struct("<QII")
+NO_KANI = 0xFFFFFFFF
+
+
+def scan_event_log(fp, offset: int = 0) -> Iterable[tuple[int, dict]]:
+    """
+    Yield (offset, event) pairs from the event log at the given path, starting at the given byte offset.
+    For binary logs, the offset is that of the frame containing the event.
+
+    Stops at a truncated event at the end of the log (e.g. if the writer crashed mid-write).
+    """
+    with open(fp, "rb") as f:
+        if str(fp).endswith(".bin"):
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{fp} is not a ReDel binary event log")
+            if offset:
+                f.seek(offset)
+            for frame_offset, flags, payload in iter_frames(f):
+                for event in decode_frame(flags, payload):
+                    yield frame_offset, event
+            return
+
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                log.warning(f"Event log {fp} ends with a truncated event; ignoring it.")
+                return
+            yield offset, json.loads(line)
+            offset += len(line)
+
+
+class EventIndexWriter:
+    """Appends records to an event log's offset index. Not thread-safe."""
+
+    def __init__(self, fp: Path, types: list[str] = None, kanis: list[str] = None, n_events: int = 0):
+        """
+        :param fp: The path to the index file.
+        :param types: The existing event type code table.
+        :param kanis: The existing kani ID code table.
+        :param n_events: The number of events already indexed. Any records in the index past this are discarded.
+        """
+        self.types = types or []
+        self.kanis = kanis or []
+        self._type_codes = {t: i for i, t in enumerate(self.types)}
+        self._kani_codes = {k: i for i, k in enumerate(self.kanis)}
+        self.f = open(fp, "r+b" if fp.exists() else "wb")
+        self.f.truncate(n_events * INDEX_RECORD.size)
+        self.f.seek(0, os.SEEK_END)
+
+    def add(self, offset: int, event_type: str, kani_id: str | None):
+        """Add the event at the given byte offset to the index."""
+        type_code = self._type_codes.get(event_type)
+        if type_code is None:
+            type_code = self._type_codes[event_type] = len(self.types)
+            self.types.append(event_type)
+        if kani_id is None:
+            kani_code = NO_KANI
+        elif (kani_code := self._kani_codes.get(kani_id)) is None:
+            kani_code = self._kani_codes[kani_id] = len(self.kanis)
+            self.kanis.append(kani_id)
+        self.f.write(INDEX_RECORD.pack(offset, type_code, kani_code))
+
+    def flush(self):
+        self.f.flush()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+class EventLogReader:
+    """
+    Random access into a saved event log, in either format.
+
+    .. code-block:: python
+
+        with EventLogReader("/path/to/save/") as reader:
+            print(len(reader))
+            event = reader[1000]
+            for event in reader.iter_kani(kani_id):
+                ...
+
+    If the event log has an up-to-date offset index, opening the reader only reads the index. Otherwise (or for any
+    events written after the index), the reader scans the event log once to build its index in memory.
+
+    The reader does not watch the log for new events; open a new reader to see events logged after it was opened.
+    """
+
+    def __init__(self, fp):
+        """
+        :param fp: The path to a save directory, or to the event log itself.
+        """
+        fp = Path(fp)
+        if fp.is_dir():
+            fp = fp / "events.jsonl" if (fp / "events.jsonl").exists() else fp / "events.bin"
+        self.fp = fp
+        self.is_binary = fp.name.endswith(".bin")
+        self.f: BinaryIO = open(fp, "rb")
+
+        self.offsets = array.array("Q")
+        """The byte offset of each event (or the frame containing it)."""
+        self.kani_postings: dict[str, array.array] = {}
+        """A mapping of kani ID to the indices of the events referring to that kani."""
+        self.type_postings: dict[str, array.array] = {}
+        """A mapping of event type to the indices of the events of that type."""
+
+        # binary frame cache: (offset, events)
+        self._frame = (None, [])
+        self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, n: int) -> dict:
+        return self.get(n)
+
+    def close(self):
+        self.f.close()
+
+    # ==== index ====
+    def _load_index(self):
+        n_bytes = os.fstat(self.f.fileno()).st_size
+        meta_fp = self.fp.with_name(f"{self.fp.name}.meta")
+        index_fp = self.fp.with_name(f"{self.fp.name}.idx")
+        offset = 0
+        try:
+            meta = json.loads(meta_fp.read_text(encoding="utf-8"))
+            n_events = meta["n_events"]
+            index_data = index_fp.read_bytes()[: n_events * INDEX_RECORD.size]
+            if meta["n_bytes"] <= n_bytes and len(index_data) == n_events * INDEX_RECORD.size:
+                types, kanis = meta["types"], meta["kanis"]
+                for idx, (event_offset, type_code, kani_code) in enumerate(INDEX_RECORD.iter_unpack(index_data)):
+                    kani_id = kanis[kani_code] if kani_code != NO_KANI else None
+                    self._add(idx, event_offset, types[type_code], kani_id)
+                offset = meta["n_bytes"]
+            else:
+                log.info(f"Offset index for {self.fp} is out of date, scanning event log...")
+        except FileNotFoundError:
+            log.info(f"Offset index for {self.fp} does not exist, scanning event log...")
+        except (ValueError, KeyError, TypeError, IndexError):
+            log.warning(f"Offset index for {self.fp} is invalid, scanning event log...")
+            self.offsets = array.array("Q")
+            self.kani_postings.clear()
+            self.type_postings.clear()
+
+        # index anything past what's on disk
+        if offset < n_bytes:
+            for event_offset, event in scan_event_log(self.fp, offset):
+                self._add(len(self.offsets), event_offset, event["type"], event.get("id"))
+
+    def _add(self, idx: int, offset: int, event_type: str, kani_id: str | None):
+        self.offsets.append(offset)
+        self.type_postings.setdefault(event_type, array.array("I")).append(idx)
+        if kani_id is not None:
+            self.kani_postings.setdefault(kani_id, array.array("I")).append(idx)
+
+    # ==== reading ====
+    def get(self, n: int) -> dict:
+        """Get the n-th event in the log (0-indexed)."""
+        if n < 0:
+            n += len(self.offsets)
+        if not 0 <= n < len(self.offsets):
+            raise IndexError("event index out of range")
+        offset = self.offsets[n]
+        if not self.is_binary:
+            self.f.seek(offset)
+            return json.loads(self.f.readline())
+        # binary: find the event's position within its frame
+        first = bisect.bisect_left(self.offsets, offset, hi=n)
+        return self._read_frame(offset)[n - first]
+
+    def iter_events(self, start: int = 0, stop: int = None) -> Iterable[dict]:
+        """Iterate over the events from index *start* (inclusive) to *stop* (exclusive) without reading the rest."""
+        stop = len(self.offsets) if stop is None else min(stop, len(self.offsets))
+        if start >= stop:
+            return
+        offset = self.offsets[start]
+        if not self.is_binary:
+            self.f.seek(offset)
+            for _ in range(stop - start):
+                yield json.loads(self.f.readline())
+            return
+        # binary: read frames sequentially and skip the events in the first frame before start
+        skip = start - bisect.bisect_left(self.offsets, offset, hi=start)
+        remaining = stop - start
+        self.f.seek(offset)
+        for _, flags, payload in iter_frames(self.f):
+            events = decode_frame(flags, payload)[skip:]
+            skip = 0
+            yield from events[:remaining]
+            remaining -= len(events)
+            if remaining <= 0:
+                return
+
+    def iter_raw(self, start: int = 0, stop: int = None) -> Iterable[bytes]:
+        """
+        Like :meth:`iter_events`, but yield each event as a line of UTF-8 encoded JSON (including the trailing newline).
+        For JSONL logs, the lines are copied straight from the log without decoding them.
+        """
+        stop = len(self.offsets) if stop is None else min(stop, len(self.offsets))
+        if start >= stop:
+            return
+        if self.is_binary:
+            for event in self.iter_events(start, stop):
+                yield json.dumps(event, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+            return
+        self.f.seek(self.offsets[start])
+        for _ in range(stop - start):
+            yield self.f.readline()
+
+    def bisect_timestamp(self, timestamp: float) -> int:
+        """
+        Return the index of the first event whose timestamp is at least *timestamp* (or ``len(self)`` if there are none)
+        by binary search, reading only O(log n) events. Assumes that events are logged in timestamp order.
+        """
+        lo, hi = 0, len(self.offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get(mid)["timestamp"] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_kani(self, kani_id: str) -> Iterable[dict]:
+        """Iterate over all the events referring to the kani with the given ID."""
+        for n in self.kani_postings.get(kani_id, ()):
+            yield self.get(n)
+
+    def iter_type(self, event_type: str) -> Iterable[dict]:
+        """Iterate over all the events of the given type."""
+        for n in self.type_postings.get(event_type, ()):
+            yield self.get(n)
+
+    def _read_frame(self, offset: int) -> list[dict]:
+        if self._frame[0] != offset:
+            self.f.seek(offset)
+            _, flags, payload = next(iter_frames(self.f))
+            self._frame = (offset, decode_frame(flags, payload))
+        return self._frame[1]
@@ -1,74 +1,397 @@
+import asyncio
 import json
 import logging
+import os
 import pathlib
+import queue
+import threading
 import time
 from collections import Counter
 from functools import cached_property
-from typing import TYPE_CHECKING
+from typing import BinaryIO, Literal, TYPE_CHECKING
 
 from . import events
+from .binlog import BinaryLogWriter
 from .config import DEFAULT_LOG_DIR
-from .utils import read_jsonl
+from .eventindex import EventIndexWriter, INDEX_RECORD, scan_event_log
+from .state import KaniState
 
 if TYPE_CHECKING:
     from .app import ReDel
+    from .base_kani import BaseKani
 
 
 log = logging.getLogger(__name__)
 
 
+LogFormat = Literal["jsonl", "binary"]
+LogDurability = Literal["none", "flush", "fsync"]
+
+EVENT_LOG_FILENAMES = {"jsonl": "events.jsonl", "binary": "events.bin"}
+
+
+def get_sidecar_paths(aof_path: pathlib.Path) -> list[pathlib.Path]:
+    """Get the paths of the sidecar files the logger keeps alongside the event log at the given path."""
+    return [aof_path.with_name(f"{aof_path.name}.meta"), aof_path.with_name(f"{aof_path.name}.idx")]
+
+
 class EventLogger:
-    def __init__(self, app: "ReDel", session_id: str, log_dir: pathlib.Path = None, clear_existing_log: bool = False):
+    def __init__(
+        self,
+        app: "ReDel",
+        session_id: str,
+        log_dir: pathlib.Path = None,
+        clear_existing_log: bool = False,
+        log_format: LogFormat = "jsonl",
+        log_compression: bool = False,
+        durability: LogDurability = "flush",
+        commit_interval: float = 0.1,
+        commit_size: int = 512,
+    ):
+        """
+        :param app: The app whose events are being logged.
+        :param session_id: The ID of the session being logged.
+        :param log_dir: The directory to write the event log and state to.
+        :param clear_existing_log: Whether to overwrite any existing event log rather than appending to it.
+        :param log_format: The format of the event log (``"jsonl"`` or ``"binary"``).
+        :param log_compression: Whether to compress the binary event log in blocks.
+        :param durability: What to do each time a batch of events is committed to the event log: ``"none"`` leaves
+            them in the file buffer, ``"flush"`` flushes them to the OS, and ``"fsync"`` also forces them to disk.
+        :param commit_interval: The maximum time, in seconds, to wait for more events before committing a batch.
+        :param commit_size: The maximum number of events to commit in a single batch.
+        """
+        if durability not in ("none", "flush", "fsync"):
+            raise ValueError(f"durability must be one of ('none', 'flush', 'fsync'), not {durability!r}")
+        if log_format not in EVENT_LOG_FILENAMES:
+            raise ValueError(f"log_format must be one of {tuple(EVENT_LOG_FILENAMES)}, not {log_format!r}")
         self.app = app
         self.session_id = session_id
         self.last_modified = time.time()
         self.log_dir = log_dir or (DEFAULT_LOG_DIR / session_id)
         self.clear_existing_log = clear_existing_log
+        self.log_format = log_format
+        self.log_compression = log_compression
+        self.durability = durability
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
 
-        self.aof_path = self.log_dir / "events.jsonl"
+        self.aof_path = self.log_dir / EVENT_LOG_FILENAMES[log_format]
+        self.meta_path, self.index_path = get_sidecar_paths(self.aof_path)
         self.state_path = self.log_dir / "state.json"
 
         self.event_count = Counter()
 
+        # state snapshots
+        self._state_lock = asyncio.Lock()
+        self._state_cache: dict[str, tuple[tuple, str]] = {}  # kani id -> (fingerprint, serialized KaniState)
+
     @cached_property
-    def event_file(self):
+    def event_file(self) -> "JSONLLogWriter | BinaryLogWriter":
         # we use a cached property here to only lazily create the log dir if we need it
         self.log_dir.mkdir(exist_ok=True)
 
-        if self.clear_existing_log:
-            return open(self.aof_path, "w", buffering=1, encoding="utf-8")
+        if self.aof_path.exists() and not self.clear_existing_log:
+            self.event_count, self.event_index = self._load_existing_log()
+        else:
+            self.event_index = EventIndexWriter(self.index_path)
+
+        mode = "wb" if self.clear_existing_log else "ab"
+        if self.log_format == "binary":
+            return BinaryLogWriter(open(self.aof_path, mode), compression=self.log_compression)
+        return JSONLLogWriter(open(self.aof_path, mode))
 
-        if self.aof_path.exists():
-            existing_events = read_jsonl(self.aof_path)
-            self.event_count = Counter(event["type"] for event in existing_events)
-        return open(self.aof_path, "a", buffering=1, encoding="utf-8")
+    def _load_existing_log(self) -> tuple[Counter, EventIndexWriter]:
+        """
+        Count the events of each type in the existing event log and open its offset index for appending.
+
+        The counts are read from the sidecar metadata file that the log writer keeps up to date, so this is O(1) as
+        long as the sidecar and index are valid. If the event log has grown since the sidecar was written, only the new
+        events are read; if the sidecar or index is missing or invalid, the whole log is read and reindexed.
+        """
+        n_bytes = self.aof_path.stat().st_size
+        try:
+            meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+            counts = Counter(meta["counts"])
+            offset = meta["n_bytes"]
+            n_events = meta["n_events"]
+            types, kanis = meta["types"], meta["kanis"]
+        except FileNotFoundError:
+            counts, offset, n_events, types, kanis = Counter(), 0, 0, [], []
+        except (ValueError, KeyError, TypeError):
+            log.warning(f"Event log metadata at {self.meta_path} is invalid, reindexing event log...")
+            counts, offset, n_events, types, kanis = Counter(), 0, 0, [], []
+
+        index_size = self.index_path.stat().st_size if self.index_path.exists() else 0
+        if offset > n_bytes or index_size < n_events * INDEX_RECORD.size:
+            log.warning(f"Event log metadata at {self.meta_path} is out of sync with the log, reindexing event log...")
+            counts, offset, n_events, types, kanis = Counter(), 0, 0, [], []
+
+        index = EventIndexWriter(self.index_path, types=types, kanis=kanis, n_events=n_events)
+        if offset < n_bytes:
+            for event_offset, event in scan_event_log(self.aof_path, offset):
+                counts[event["type"]] += 1
+                index.add(event_offset, event["type"], event.get("id"))
+            index.flush()
+        return counts, index
+
+    @cached_property
+    def writer(self) -> "LogWriterThread":
+        """The background thread that commits events to the event file. Started lazily on the first logged event."""
+        writer = LogWriterThread(self, self.event_file, self.event_index, counts=self.event_count)
+        writer.start()
+        return writer
 
     async def log_event(self, event: events.BaseEvent):
         if not event.__log_event__:
             return
         self.last_modified = time.time()
-        # since this is a synch operation we don't need a lock here (though it is thread-unsafe)
-        self.event_file.write(event.model_dump_json())
-        self.event_file.write("\n")
+        # serialize here so the logged event reflects its state when it was handled, then hand off the IO
+        if self.log_format == "binary":
+            record = event.model_dump(mode="json")
+        else:
+            record = event.model_dump_json() + "\n"
+        self.writer.submit(event.type, getattr(event, "id", None), record)
         self.event_count[event.type] += 1
 
+    async def flush(self):
+        """Wait until all events logged so far have been written and flushed to the event file."""
+        if "writer" not in self.__dict__:
+            return
+        await self.writer.sync()
+
     async def write_state(self):
-        """Write the full state of the app to the state file, with a basic checksum against the AOF to check validity"""
-        self.log_dir.mkdir(exist_ok=True)
-        state = [ai.get_save_state().model_dump(mode="json") for ai in self.app.kanis.values()]
-        data = {
-            "id": self.session_id,
-            "title": self.app.title,
-            "last_modified": self.last_modified,
-            "n_events": self.event_count.total(),
-            "state": state,
-        }
-        with open(self.state_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        """
+        Write the full state of the app to the state file, with a basic checksum against the AOF to check validity.
+
+        Only kanis whose state changed since the last write are re-serialized; the rest are reused from the previous
+        write. Serialization and file IO happen in a worker thread, and the state file is atomically replaced so a
+        crash mid-write never leaves a corrupt state file behind.
+        """
+        async with self._state_lock:
+            self.log_dir.mkdir(exist_ok=True)
+            # snapshot the kanis that changed on the event loop, so we don't race with the running app
+            kani_ids = []
+            dirty = {}
+            for ai in self.app.kanis.values():
+                kani_ids.append(ai.id)
+                fingerprint = _state_fingerprint(ai)
+                cached = self._state_cache.get(ai.id)
+                if cached is None or cached[0] != fingerprint:
+                    dirty[ai.id] = (fingerprint, ai.get_save_state())
+            # dormant kanis restored from a save don't change until they're hydrated
+            for kani_state in self.app.dormant_kanis.values():
+                kani_ids.append(kani_state.id)
+                if kani_state.id not in self._state_cache:
+                    dirty[kani_state.id] = (None, kani_state)
+            meta = {
+                "id": self.session_id,
+                "title": self.app.title,
+                "last_modified": self.last_modified,
+                "n_events": self.event_count.total(),
+            }
+            # make sure the events counted above are on disk so that the state is consistent with the event log
+            await self.flush()
+            await asyncio.get_running_loop().run_in_executor(None, self._write_state_file, meta, kani_ids, dirty)
+
+    def _write_state_file(self, meta: dict, kani_ids: list[str], dirty: dict[str, tuple[tuple, KaniState]]):
+        # serialize the changed kanis and drop any kanis that no longer exist
+        for kani_id, (fingerprint, kani_state) in dirty.items():
+            self._state_cache[kani_id] = (fingerprint, kani_state.model_dump_json())
+        for kani_id in self._state_cache.keys() - set(kani_ids):
+            del self._state_cache[kani_id]
+
+        # splice the serialized kanis into the state file, and replace the existing file
+        # the metadata goes first so that save indexers can read it without parsing the state
+        header = json.dumps(meta)
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(header[:-1])
+            f.write(', "state": [')
+            f.write(",".join(self._state_cache[kani_id][1] for kani_id in kani_ids))
+            f.write("]}")
+            if self.durability == "fsync":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
 
     async def close(self):
         # if we haven't done anything, don't write anything
         if not self.event_count.total():
             return
         await self.write_state()
-        self.event_file.close()
+        await self.writer.stop()
+
+
+class JSONLLogWriter:
+    """Writes events to a JSONL event log. Not thread-safe."""
+
+    def __init__(self, f: BinaryIO):
+        """
+        :param f: A file opened in binary write or append mode.
+        """
+        self.f = f
+        self.position = self.f.seek(0, os.SEEK_END)
+        """The byte offset at which the next event will be written."""
+
+    def write(self, line: str) -> int:
+        """Write a single serialized event (including its trailing newline). Returns the byte offset of the event."""
+        data = line.encode("utf-8")
+        offset = self.position
+        self.f.write(data)
+        self.position += len(data)
+        return offset
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+
+def _state_fingerprint(ai: "BaseKani") -> tuple:
+    """
+    A cheap summary of the parts of a kani's state that can change while it runs. If a kani's fingerprint is the same
+    as when it was last saved, its saved state is still valid.
+    """
+    return (
+        id(ai.chat_history),
+        len(ai.chat_history),
+        id(ai.chat_history[-1]) if ai.chat_history else None,
+        tuple(map(id, ai.always_included_messages)),
+        ai.state,
+        tuple(ai.children),
+        tuple(ai.functions),
+        ai.name,
+    )
+
+
+class LogWriterThread(threading.Thread):
+    """
+    Writes logged events to the event file in a background thread, so the event loop never blocks on file IO.
+
+    Events are committed in groups: once an event is submitted, the thread waits up to the logger's
+    ``commit_interval`` for more events (or until it has ``commit_size`` events), writes them all, then applies the
+    logger's durability policy once for the whole batch.
+
+    Each time a batch is committed, the thread adds the events to the event log's offset index. Each time a batch is
+    flushed, the thread also updates the event log's sidecar metadata file with the per-type event counts, byte length
+    of the log, and index code tables, so that reopening the log doesn't require reading it.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, logger: EventLogger, f, index: EventIndexWriter, counts: Counter):
+        """
+        :param logger: The logger this thread is writing for.
+        :param f: The event file to write to. The thread takes ownership of the file and closes it when stopped.
+        :param index: The offset index of the event file. The thread takes ownership of it as well.
+        :param counts: The number of events of each type already in the event file.
+        """
+        super().__init__(name=f"redel-log-writer-{logger.session_id}", daemon=True)
+        self.logger = logger
+        self.f = f
+        self.index = index
+        self.q = queue.SimpleQueue()
+        self.committed_counts = Counter(counts)
+
+    def submit(self, event_type: str, kani_id: str | None, record):
+        """Queue a serialized event to be written. Thread-safe."""
+        self.q.put((event_type, kani_id, record))
+
+    async def sync(self):
+        """Wait until all previously submitted events have been written and flushed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.q.put(_SyncBarrier(loop, future))
+        await future
+
+    async def stop(self):
+        """Commit all previously submitted events, close the file, and stop the thread."""
+        self.q.put(self._CLOSE)
+        await asyncio.get_running_loop().run_in_executor(None, self.join)
+
+    def run(self):
+        while True:
+            batch = self._get_batch()
+            records = [item for item in batch if not isinstance(item, _SyncBarrier) and item is not self._CLOSE]
+            barriers = [item for item in batch if isinstance(item, _SyncBarrier)]
+            closing = batch[-1] is self._CLOSE
+            # noinspection PyBroadException
+            try:
+                self._commit(records, force_flush=bool(barriers) or closing)
+                if closing:
+                    self.f.close()
+                    self.index.close()
+            except Exception:
+                log.exception("Exception when writing events to the event log:")
+            for barrier in barriers:
+                barrier.release()
+            if closing:
+                return
+
+    def _get_batch(self) -> list:
+        """Block until at least one item is submitted, then gather a batch until a threshold is hit."""
+        batch = [self.q.get()]
+        deadline = time.monotonic() + self.logger.commit_interval
+        # commit immediately if someone is waiting on us
+        while len(batch) < self.logger.commit_size and not self._is_barrier(batch[-1]):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _is_barrier(self, item) -> bool:
+        return item is self._CLOSE or isinstance(item, _SyncBarrier)
+
+    def _commit(self, records: list[tuple[str, str | None, object]], force_flush: bool = False):
+        for event_type, kani_id, record in records:
+            offset = self.f.write(record)
+            self.index.add(offset, event_type, kani_id)
+            self.committed_counts[event_type] += 1
+        if self.logger.durability == "none" and not force_flush:
+            return
+        self.f.flush()
+        self.index.flush()
+        if self.logger.durability == "fsync":
+            os.fsync(self.f.fileno())
+            os.fsync(self.index.fileno())
+        if records:
+            self._write_meta()
+
+    def _write_meta(self):
+        """Atomically update the sidecar metadata file to match the flushed event file."""
+        n_events = self.committed_counts.total()
+        meta = {
+            "n_events": n_events,
+            "last_seq": n_events - 1,
+            "n_bytes": os.fstat(self.f.fileno()).st_size,
+            "counts": self.committed_counts,
+            "types": self.index.types,
+            "kanis": self.index.kanis,
+        }
+        tmp_path = self.logger.meta_path.with_name(f"{self.logger.meta_path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.logger.meta_path)
+
+
+class _SyncBarrier:
+    """Submitted to a LogWriterThread to be notified once all the events submitted before it are flushed."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, future: asyncio.Future):
+        self.loop = loop
+        self.future = future
+
+    def release(self):
+        self.loop.call_soon_threadsafe(self._set_result)
+
+    def _set_result(self):
+        if not self.future.done():
+            self.future.set_result(None)
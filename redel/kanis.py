@@ -6,8 +6,10 @@ import logging
 from kani import AIFunction, ChatMessage
 
 from .base_kani import BaseKani
+from .budget import WRAP_UP_PROMPT
 from .delegation import DelegationBase
 from .namer import Namer
+from .state import KaniState
 from .tool_config import ToolConfigType
 from .tools import ToolBase
 
@@ -72,9 +74,37 @@ class ReDelKani(BaseKani):
         """Get the tool from this kani's list of tools, or None if this kani does not have the given tool class."""
         return next((t for t in self.tools if type(t) is cls), None)
 
-    async def create_delegate_kani(self, instructions: str):
+    async def create_delegate_kani(self, instructions: str, name: str = None):
+        return await self._create_delegate_kani(name=name)
+
+    async def restore_delegate_kani(self, state: KaniState) -> "ReDelKani":
+        """
+        Recreate a dormant delegate of this kani from its saved state. Used when loading a saved session; prefer
+        :meth:`.ReDel.hydrate_kani`, which also hydrates the delegate's ancestors.
+        """
+        kani_inst = await self._create_delegate_kani(
+            id=state.id, name=state.name, chat_history=list(state.chat_history), dispatch_creation=False
+        )
+        del self.app.dormant_kanis[state.id]
+        self.dormant_children.remove(state.id)
+        kani_inst.restore_dormant_children(state)
+        return kani_inst
+
+    def restore_dormant_children(self, state: KaniState):
+        """Register the dormant children in this kani's saved state with this kani and its delegation scheme."""
+        for child_id in state.children:
+            # children that had finished and were released before the save was written won't be in it
+            if (child_state := self.app.dormant_kanis.get(child_id)) is None:
+                continue
+            self.dormant_children.append(child_id)
+            # new delegates must not reuse a restored delegate's name
+            self.namer.reserve(child_state.name)
+            if self.delegator:
+                self.delegator.restore_delegate(child_state)
+
+    async def _create_delegate_kani(self, name: str = None, dispatch_creation: bool = True, **kwargs):
         # create the new instance
-        name = self.namer.get_name()
+        name = name or self.namer.get_name()
         kani_inst = ReDelKani(
             self.app.delegate_engine,
             # app args
@@ -84,6 +114,7 @@ class ReDelKani(BaseKani):
             dispatch_creation=False,
             # kani args
             system_prompt=self.app.delegate_system_prompt,
+            **kwargs,
             **self.app.delegate_kani_kwargs,
         )
 
@@ -104,7 +135,7 @@ class ReDelKani(BaseKani):
         if delegation_scheme_inst:
             await delegation_scheme_inst.setup()
         await asyncio.gather(*(t.setup() for t in tool_insts))
-        self.app.on_kani_creation(kani_inst)
+        self.app.on_kani_creation(kani_inst, dispatch=dispatch_creation)
         return kani_inst
 
     # overrides
@@ -112,7 +143,10 @@ class ReDelKani(BaseKani):
         # if we have a system prompt, update it with any time/name templates
         if self.system_prompt is not None:
             self.always_included_messages[0] = ChatMessage.system(get_system_prompt(self))
-        return await super().get_prompt()
+        prompt = await super().get_prompt()
+        if self.app.budget_tracker.should_wrap_up(self):
+            prompt = [*prompt, ChatMessage.system(WRAP_UP_PROMPT)]
+        return prompt
 
     async def cleanup(self):
         if self.delegator:
@@ -133,6 +167,7 @@ async def create_root_kani(
     delegation_scheme: type[DelegationBase] | None,
     tool_configs: ToolConfigType,
     root_has_tools: bool,
+    dispatch_creation: bool = True,
     **kwargs,
 ) -> ReDelKani:
     """Create the root kani for the kani delegation tree."""
@@ -153,7 +188,7 @@ async def create_root_kani(
     if delegation_scheme_inst:
         await delegation_scheme_inst.setup()
     await asyncio.gather(*(t.setup() for t in tool_insts))
-    app.on_kani_creation(kani_inst)
+    app.on_kani_creation(kani_inst, dispatch=dispatch_creation)
     return kani_inst
 
 
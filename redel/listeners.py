@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import enum
+import logging
+from typing import Any, Awaitable, Callable, Collection, TYPE_CHECKING
+
+from . import events
+
+if TYPE_CHECKING:
+    from .app import ReDel
+
+log = logging.getLogger(__name__)
+
+ListenerCallback = Callable[[events.BaseEvent], Awaitable[Any]]
+
+DEFAULT_LISTENER_QUEUE_SIZE = 1024
+
+
+class BackpressurePolicy(enum.Enum):
+    """
+    What a listener should do when an event is dispatched but its queue is full.
+
+    * ``BackpressurePolicy.BLOCK``: Wait until the listener has room in its queue. No events are lost, but this holds
+      up delivery to all other listeners until the slow listener catches up.
+    * ``BackpressurePolicy.DROP_OLDEST``: Discard the oldest event in the listener's queue to make room.
+    * ``BackpressurePolicy.DROP_UNLOGGED``: Discard events that are not logged (e.g. :class:`.events.StreamDelta`) to
+      make room. If the queue is full of logged events, wait for room like ``BLOCK``.
+    * ``BackpressurePolicy.DISCONNECT``: Remove the listener from the app.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_UNLOGGED = "drop_unlogged"
+    DISCONNECT = "disconnect"
+
+
+class Listener:
+    """
+    A listener registered with :meth:`.ReDel.add_listener`.
+
+    Each listener has its own bounded queue of events and a worker task that calls the listener's callback with each
+    event in order, so a slow listener does not hold up delivery to the others (unless its policy is ``BLOCK``).
+    """
+
+    def __init__(
+        self,
+        app: "ReDel",
+        callback: ListenerCallback,
+        *,
+        event_types: Collection[type[events.BaseEvent]] = None,
+        kani_ids: Collection[str] = None,
+        loggable_only: bool = False,
+        max_queue_size: int = DEFAULT_LISTENER_QUEUE_SIZE,
+        policy: BackpressurePolicy = BackpressurePolicy.BLOCK,
+    ):
+        """
+        :param app: The app this listener is registered to.
+        :param callback: The async function to call with each event.
+        :param event_types: If set, only deliver events that are instances of one of these types.
+        :param kani_ids: If set, only deliver events whose ``id`` is one of these kani IDs.
+        :param loggable_only: If true, only deliver events that are logged (i.e., not stream deltas).
+        :param max_queue_size: The maximum number of events to queue for this listener before applying the
+            backpressure policy. If this is 0, the queue is unbounded.
+        :param policy: What to do when an event is dispatched but the queue is full.
+        """
+        self.app = app
+        self.callback = callback
+        self.event_types = tuple(event_types) if event_types is not None else None
+        self.kani_ids = frozenset(kani_ids) if kani_ids is not None else None
+        self.loggable_only = loggable_only
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+
+        self.n_dropped = 0
+        """The number of events this listener has dropped due to its backpressure policy."""
+
+        # internals
+        self._queue = collections.deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+        self._closed = False
+
+    def __repr__(self):
+        return f"<{type(self).__name__} callback={self.callback!r} policy={self.policy.value} depth={self.queue_depth}>"
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of events currently waiting to be delivered to this listener."""
+        return len(self._queue)
+
+    @property
+    def is_full(self) -> bool:
+        return bool(self.max_queue_size) and len(self._queue) >= self.max_queue_size
+
+    # ==== filters ====
+    def accepts_type(self, event_type: type[events.BaseEvent]) -> bool:
+        """Whether this listener wants events of the given type (ignoring the kani ID filter)."""
+        if self.loggable_only and not event_type.__log_event__:
+            return False
+        if self.event_types is not None and not issubclass(event_type, self.event_types):
+            return False
+        return True
+
+    def accepts(self, event: events.BaseEvent) -> bool:
+        """Whether this listener wants the given event."""
+        if not self.accepts_type(type(event)):
+            return False
+        if self.kani_ids is not None and getattr(event, "id", None) not in self.kani_ids:
+            return False
+        return True
+
+    # ==== lifecycle ====
+    def start(self):
+        """Start the worker task that delivers events to the callback. Must be called from within an event loop."""
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._worker(), name=f"redel-listener-{self.callback!r}")
+
+    def stop(self):
+        """Stop delivering events to this listener. Any queued events are discarded."""
+        self._closed = True
+        self._queue.clear()
+        self._idle.set()
+        self._not_empty.set()
+        self._not_full.set()
+        # if a listener removes itself, let it finish gracefully
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def join(self):
+        """Wait until all queued events have been delivered."""
+        await self._idle.wait()
+
+    # ==== queue ====
+    async def put(self, event: events.BaseEvent):
+        """Add an event to this listener's queue, applying the backpressure policy if it is full."""
+        if self._closed:
+            return
+        if self.is_full:
+            if self.policy == BackpressurePolicy.DROP_OLDEST:
+                self._queue.popleft()
+                self.n_dropped += 1
+            elif self.policy == BackpressurePolicy.DROP_UNLOGGED:
+                if not event.__log_event__:
+                    self.n_dropped += 1
+                    return
+                # make room by dropping the oldest unlogged event in the queue, if there is one
+                for idx, queued in enumerate(self._queue):
+                    if not queued.__log_event__:
+                        del self._queue[idx]
+                        self.n_dropped += 1
+                        break
+                else:
+                    await self._wait_not_full()
+            elif self.policy == BackpressurePolicy.DISCONNECT:
+                log.warning(f"Listener {self.callback!r} fell too far behind and was disconnected.")
+                self.app.remove_listener(self.callback)
+                return
+            else:
+                await self._wait_not_full()
+            # we might have been stopped while waiting
+            if self._closed:
+                return
+        self._queue.append(event)
+        self._idle.clear()
+        self._not_empty.set()
+
+    async def _wait_not_full(self):
+        while self.is_full and not self._closed:
+            self._not_full.clear()
+            await self._not_full.wait()
+
+    async def _worker(self):
+        while not self._closed:
+            if not self._queue:
+                self._idle.set()
+                self._not_empty.clear()
+                await self._not_empty.wait()
+                continue
+            event = self._queue.popleft()
+            self._not_full.set()
+            # noinspection PyBroadException
+            try:
+                await self.callback(event)
+            except Exception:
+                log.exception(f"Exception in listener {self.callback!r} when handling event:")
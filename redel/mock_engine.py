@@ -0,0 +1,211 @@
+"""
+An engine that imitates an LLM without calling one, for testing and load-testing ReDel offline.
+
+A :class:`MockEngine` generates filler text, ``delegate()``/``wait()`` tool calls, token counts, and artificial latency,
+either from a script of responses or from a random policy that builds delegation trees of a given width and depth. It
+makes no network requests, so the time a system takes to run with a mock engine is the framework's own overhead (plus
+any latency you configure).
+"""
+
+import asyncio
+import itertools
+import json
+import random
+from typing import AsyncIterable, Callable, Iterable
+
+from kani import AIFunction, ChatMessage, ChatRole
+from kani.engines.base import BaseCompletion, BaseEngine, Completion
+from kani.models import ToolCall
+
+from .scheduler import current_kani
+
+# the approximate number of characters per token, to count tokens without a tokenizer
+CHARS_PER_TOKEN = 4
+# the tokens each message uses on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_WORDS = (
+    "the quick brown fox jumps over a lazy dog while helpers search for pages about recursive delegation and report"
+    " their results back to the root so that every agent in the tree can finish its part of the task"
+).split()
+
+ScriptStep = ChatMessage | str
+ScriptFunction = Callable[[list[ChatMessage], list[AIFunction] | None], ScriptStep]
+
+
+class MockEngine(BaseEngine):
+    """
+    An engine that generates responses without calling an LLM.
+
+    By default, it follows a random policy that builds a delegation tree: each kani shallower than *depth* delegates to
+    *width* helpers (if it has a ``delegate()`` function), waits for them (if it has a ``wait()`` function), then
+    answers with filler text. Kanis at *depth* answer right away.
+
+    .. code-block:: python
+
+        engine = MockEngine(width=3, depth=2, latency=0.5)
+        ai = ReDel(root_engine=engine, delegate_engine=engine)
+
+    Alternatively, pass a *script*: either a list of responses to return in order, or a function that takes the
+    messages and functions of a request and returns the response. A response can be a :class:`kani.ChatMessage` (e.g.
+    with tool calls) or a string.
+
+    The random policy is seeded by *seed* and the request, so the same system given the same queries always builds the
+    same tree, regardless of the order its kanis run in.
+    """
+
+    def __init__(
+        self,
+        *,
+        script: Iterable[ScriptStep] | ScriptFunction = None,
+        width: int | tuple[int, int] = 2,
+        depth: int = 1,
+        delegate_prob: float = 1.0,
+        response_tokens: int = 32,
+        latency: float = 0,
+        token_latency: float = 0,
+        seed: int = 0,
+        max_context_size: int = 128000,
+    ):
+        """
+        :param script: A list of responses to return in order, or a function that returns a response for each request.
+            If not set, responses are generated by the random policy.
+        :param width: The number of helpers each kani delegates to, or a (min, max) range to pick from at random.
+        :param depth: The depth of the delegation tree. Kanis at this depth answer without delegating.
+        :param delegate_prob: The probability that a kani shallower than *depth* delegates, rather than answering right
+            away.
+        :param response_tokens: The number of tokens of filler text in each answer.
+        :param latency: The time to wait before responding (or before the first token when streaming), in seconds.
+        :param token_latency: The time to wait between each token when streaming, in seconds.
+        :param seed: The seed for the random policy.
+        :param max_context_size: The context size to report.
+        """
+        self.width = (width, width) if isinstance(width, int) else tuple(width)
+        self.depth = depth
+        self.delegate_prob = delegate_prob
+        self.response_tokens = response_tokens
+        self.latency = latency
+        self.token_latency = token_latency
+        self.seed = seed
+        self.max_context_size = max_context_size
+
+        self._script_fn = None
+        self._script_iter = None
+        if callable(script):
+            self._script_fn = script
+        elif script is not None:
+            self._script_iter = iter(script)
+
+        self.n_requests = 0
+        """The number of requests this engine has responded to."""
+        self._call_ids = itertools.count()
+
+    # ==== token counting ====
+    def message_len(self, message: ChatMessage) -> int:
+        n_chars = len(message.text or "")
+        if message.tool_calls:
+            n_chars += sum(len(tc.function.name) + len(tc.function.arguments) for tc in message.tool_calls)
+        return n_chars // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+    def function_token_reserve(self, functions: list[AIFunction]) -> int:
+        if not functions:
+            return 0
+        n_chars = sum(len(f.name) + len(f.desc) + len(json.dumps(f.json_schema)) for f in functions)
+        return n_chars // CHARS_PER_TOKEN
+
+    # ==== policy ====
+    def next_response(self, messages: list[ChatMessage], functions: list[AIFunction] | None = None) -> ChatMessage:
+        """Get the response to the given request, from the script or the random policy."""
+        if self._script_fn is not None:
+            return _to_message(self._script_fn(messages, functions))
+        if self._script_iter is not None:
+            try:
+                return _to_message(next(self._script_iter))
+            except StopIteration:
+                raise RuntimeError("The MockEngine's script has run out of responses.") from None
+        return self.policy_response(messages, functions)
+
+    def policy_response(self, messages: list[ChatMessage], functions: list[AIFunction] | None = None) -> ChatMessage:
+        """Get the response to the given request from the random policy."""
+        function_names = {f.name for f in functions or ()}
+        # the messages since the last user message are the current round
+        round_start = 0
+        for idx, msg in enumerate(messages):
+            if msg.role == ChatRole.USER:
+                round_start = idx
+        query = messages[round_start].text if messages else ""
+        round_msgs = messages[round_start + 1 :]
+        rng = random.Random(f"{self.seed}|{len(messages)}|{query}")
+
+        kani = current_kani.get()
+        kani_depth = kani.depth if kani is not None else 0
+        assistant_msgs = [m for m in round_msgs if m.role == ChatRole.ASSISTANT]
+
+        # start of the round: maybe delegate
+        if not assistant_msgs:
+            if "delegate" in function_names and kani_depth < self.depth and rng.random() < self.delegate_prob:
+                width = rng.randint(*self.width)
+                name = kani.name if kani is not None else "root"
+                return ChatMessage.assistant(
+                    None,
+                    tool_calls=[
+                        self._tool_call("delegate", instructions=f"{name}, part {i + 1}: {self._filler(rng, 12)}")
+                        for i in range(width)
+                    ],
+                )
+        # after delegating: wait for the helpers, if they need to be waited on
+        elif (
+            len(assistant_msgs) == 1
+            and "wait" in function_names
+            and any(tc.function.name == "delegate" for tc in assistant_msgs[0].tool_calls or ())
+        ):
+            return ChatMessage.assistant(None, tool_calls=[self._tool_call("wait", until="all")])
+        # otherwise, answer
+        return ChatMessage.assistant(self._filler(rng, self.response_tokens))
+
+    def _tool_call(self, name: str, **kwargs) -> ToolCall:
+        return ToolCall.from_function(name, call_id_=f"call_{next(self._call_ids)}", **kwargs)
+
+    @staticmethod
+    def _filler(rng: random.Random, n_tokens: int) -> str:
+        return " ".join(rng.choice(_WORDS) for _ in range(n_tokens))
+
+    # ==== engine ====
+    async def predict(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> BaseCompletion:
+        message = self.next_response(messages, functions)
+        delay = self.latency + self.token_latency * self.message_len(message)
+        if delay:
+            await asyncio.sleep(delay)
+        return self._completion(message, messages, functions)
+
+    async def stream(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> AsyncIterable[str | BaseCompletion]:
+        message = self.next_response(messages, functions)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if message.text:
+            # one "token" per word
+            for idx, word in enumerate(message.text.split(" ")):
+                if self.token_latency:
+                    await asyncio.sleep(self.token_latency)
+                yield word if idx == 0 else f" {word}"
+        yield self._completion(message, messages, functions)
+
+    def _completion(
+        self, message: ChatMessage, messages: list[ChatMessage], functions: list[AIFunction] | None
+    ) -> Completion:
+        self.n_requests += 1
+        prompt_tokens = sum(self.message_len(m) for m in messages) + self.function_token_reserve(functions)
+        return Completion(message, prompt_tokens=prompt_tokens, completion_tokens=self.message_len(message))
+
+    def __repr__(self):
+        return f"{type(self).__name__}(width={self.width}, depth={self.depth})"
+
+
+def _to_message(step: ScriptStep) -> ChatMessage:
+    if isinstance(step, str):
+        return ChatMessage.assistant(step)
+    return step
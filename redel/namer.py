@@ -31,6 +31,16 @@ class Namer:
 
     def __init__(self):
         self.gen = itertools.cycle(self.all_names)
+        self.reserved = set()
+
+    def reserve(self, name: str):
+        """Mark a name as in use (e.g. by a restored delegate), so that :meth:`get_name` skips it."""
+        self.reserved.add(name)
 
     def get_name(self):
+        # skip reserved names, unless every name is reserved
+        for _ in range(len(self.all_names)):
+            name = next(self.gen)
+            if name not in self.reserved:
+                return name
         return next(self.gen)
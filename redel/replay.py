@@ -0,0 +1,141 @@
+"""
+Reconstruct the state of a saved session at any point in its event log.
+
+This mirrors the replay logic of the web viewer (``viz/src/redel/state.ts``), but runs on the server so that clients
+can jump to any point in a long replay without downloading and replaying every event before it.
+"""
+
+import bisect
+import logging
+import threading
+
+from .eventindex import EventLogReader
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_INTERVAL = 500
+
+
+class ReplayState:
+    """The state of every kani in a session, built by applying logged events (as dicts) in order."""
+
+    def __init__(self, kanis: dict[str, dict] = None):
+        self.kanis: dict[str, dict] = kanis if kanis is not None else {}
+        """A mapping of kani ID to the kani's state, as a dict in the form of a :class:`.KaniState`."""
+
+    def get_state(self) -> list[dict]:
+        """Get the state of each kani, in the order they were spawned."""
+        return list(self.kanis.values())
+
+    # ==== event handlers ====
+    def handle_event(self, event: dict):
+        """Update the state with a single logged event."""
+        event_type = event["type"]
+        if event_type == "kani_spawn":
+            self.on_kani_spawn(event)
+        elif event_type == "kani_state_change":
+            self.on_kani_state_change(event)
+        elif event_type == "kani_message":
+            self.on_kani_message(event)
+
+    def on_kani_spawn(self, event: dict):
+        kani = {k: v for k, v in event.items() if k not in ("type", "timestamp")}
+        # copy the mutable parts so that checkpoints can share the rest
+        kani["children"] = list(kani["children"])
+        kani["chat_history"] = list(kani["chat_history"])
+        self.kanis[kani["id"]] = kani
+        if kani["parent"] is None:
+            return
+        parent = self.kanis.get(kani["parent"])
+        if parent is None:
+            log.warning("Got kani_spawn event but parent kani does not exist!")
+            return
+        if kani["id"] not in parent["children"]:
+            parent["children"].append(kani["id"])
+
+    def on_kani_state_change(self, event: dict):
+        kani = self.kanis.get(event["id"])
+        if kani is None:
+            log.warning("Got kani_state_change event for nonexistent kani!")
+            return
+        kani["state"] = event["state"]
+
+    def on_kani_message(self, event: dict):
+        kani = self.kanis.get(event["id"])
+        if kani is None:
+            log.warning("Got kani_message event for nonexistent kani!")
+            return
+        kani["chat_history"].append(event["msg"])
+
+
+class _Checkpoint:
+    """
+    A snapshot of a :class:`ReplayState` after some number of events.
+
+    Chat histories are only ever appended to during a replay, so rather than copying each kani's chat history, a
+    checkpoint keeps a reference to the live history and its length at the time of the checkpoint. This makes a
+    checkpoint O(number of kanis) to store, regardless of how long the session is.
+    """
+
+    def __init__(self, n_events: int, state: ReplayState):
+        self.n_events = n_events
+        self.kanis = [
+            ({k: v for k, v in kani.items() if k != "chat_history"}, list(kani["children"]), kani["chat_history"])
+            for kani in state.kanis.values()
+        ]
+        self.history_lens = [len(kani["chat_history"]) for kani in state.kanis.values()]
+
+    def restore(self) -> ReplayState:
+        kanis = {}
+        for (kani, children, history), n_messages in zip(self.kanis, self.history_lens):
+            kanis[kani["id"]] = {**kani, "children": list(children), "chat_history": history[:n_messages]}
+        return ReplayState(kanis)
+
+
+class ReplayEngine:
+    """
+    Reconstructs the state of a saved session after any number of events.
+
+    The engine replays the event log once, storing a checkpoint every *checkpoint_interval* events. Afterwards, getting
+    the state at any point costs restoring the nearest checkpoint before it, plus replaying at most
+    *checkpoint_interval* events from the log (using the log's offset index to seek to them).
+
+    If the log grows, call :meth:`update` to replay the new events. Thread-safe.
+    """
+
+    def __init__(self, checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL):
+        """
+        :param checkpoint_interval: How many events to replay between checkpoints.
+        """
+        if checkpoint_interval < 1:
+            raise ValueError("checkpoint_interval must be at least 1")
+        self.checkpoint_interval = checkpoint_interval
+        self.n_events = 0
+        """The number of events replayed so far."""
+        self._state = ReplayState()
+        self._checkpoints = [_Checkpoint(0, self._state)]
+        self._lock = threading.Lock()
+
+    def update(self, reader: EventLogReader):
+        """Replay any events in the given log that have not been replayed yet, adding checkpoints along the way."""
+        with self._lock:
+            for event in reader.iter_events(self.n_events):
+                self._state.handle_event(event)
+                self.n_events += 1
+                if self.n_events % self.checkpoint_interval == 0:
+                    self._checkpoints.append(_Checkpoint(self.n_events, self._state))
+
+    def state_at(self, reader: EventLogReader, n_events: int = None) -> list[dict]:
+        """
+        Get the state of each kani after the first *n_events* events in the log (or after all the replayed events,
+        if not given). The returned dicts are in the form of a :class:`.KaniState`.
+        """
+        with self._lock:
+            if n_events is None or n_events > self.n_events:
+                n_events = self.n_events
+            idx = bisect.bisect_right(self._checkpoints, n_events, key=lambda checkpoint: checkpoint.n_events) - 1
+            checkpoint = self._checkpoints[idx]
+            state = checkpoint.restore()
+        for event in reader.iter_events(checkpoint.n_events, n_events):
+            state.handle_event(event)
+        return state.get_state()
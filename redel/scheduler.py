@@ -0,0 +1,266 @@
+"""
+Schedule LLM requests across a whole delegation tree under shared rate budgets.
+
+Without a scheduler, every kani calls its engine as soon as it wants to, so a wide delegation tree can fire dozens of
+requests at once, hit the provider's rate limits, and then make things worse as each request retries on its own. A
+:class:`RequestScheduler` admits requests one at a time according to request-per-minute, token-per-minute, and
+concurrency budgets, serving shallower kanis first: the root, and the kanis whose results the rest of their subtree
+is waiting on, are served before leaf-level work.
+"""
+
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+from typing import AsyncIterable, Callable, TYPE_CHECKING
+
+from kani import AIFunction, ChatMessage
+from kani.engines.base import BaseCompletion, BaseEngine, WrapperEngine
+
+if TYPE_CHECKING:
+    from .base_kani import BaseKani
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATELIMIT_BACKOFF = 5
+MAX_RATELIMIT_BACKOFF = 120
+
+current_kani: ContextVar["BaseKani | None"] = ContextVar("current_kani", default=None)
+"""The kani whose request to its engine is currently being made, if any. Set by :class:`.BaseKani`."""
+
+
+def depth_priority(kani: "BaseKani | None") -> int:
+    """The default request priority: a kani's depth in the tree (lower is served first)."""
+    return kani.depth if kani is not None else 0
+
+
+class _Ticket:
+    """An admitted request's share of the token budget, corrected to the actual usage once the request completes."""
+
+    def __init__(self, n_tokens: int):
+        self.entry = [time.monotonic(), n_tokens]
+
+    def record_usage(self, n_tokens: int):
+        self.entry[1] = n_tokens
+
+
+class RequestScheduler:
+    """
+    Admits LLM requests under shared budgets, in priority order.
+
+    Share one scheduler between all the engines that draw from the same provider quota, e.g. by passing it to each
+    :class:`.ReDel` instance as ``request_scheduler``, or by wrapping engines in a :class:`ScheduledEngine` yourself.
+
+    Requests wait in a priority queue (by default, ordered by the requesting kani's depth, then first-come
+    first-served). The request at the head of the queue is admitted once:
+
+    - fewer than *max_concurrency* requests are running,
+    - fewer than *rpm_limit* requests were admitted in the last *period* seconds, and
+    - fewer than *tpm_limit* tokens were used in the last *period* seconds (counting the estimated prompt length of
+      running requests, and the actual prompt and completion tokens of finished requests).
+
+    If a request is rate limited by the provider anyway, the scheduler stops admitting requests for a while (with
+    exponential backoff), so that retries don't pile on.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrency: int = None,
+        rpm_limit: int = None,
+        tpm_limit: int = None,
+        period: float = 60,
+        priority: Callable[["BaseKani | None"], int] = depth_priority,
+    ):
+        """
+        :param max_concurrency: The maximum number of requests to run at once (default unlimited).
+        :param rpm_limit: The maximum number of requests to admit per *period* (default unlimited).
+        :param tpm_limit: The maximum number of tokens to use per *period* (default unlimited).
+        :param period: The length of the rate limit window, in seconds (default 60).
+        :param priority: A function that takes the kani making a request (or None, if the request was not made by a
+            kani) and returns its priority. Requests with a lower priority are served first.
+        """
+        self.max_concurrency = max_concurrency
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.period = period
+        self.priority = priority
+
+        self.n_running = 0
+        # the start time of each request admitted in the current window
+        self._request_times = collections.deque()
+        # [start time, tokens] of each request admitted in the current window
+        self._token_entries = collections.deque()
+        # heap of (priority, seq, n_tokens, future)
+        self._queue = []
+        self._seq = itertools.count()
+        self._paused_until = 0
+        self._backoff = DEFAULT_RATELIMIT_BACKOFF
+        self._wakeup = None
+
+    @property
+    def n_waiting(self) -> int:
+        """The number of requests waiting to be admitted."""
+        return sum(1 for *_, future in self._queue if not future.done())
+
+    @contextlib.asynccontextmanager
+    async def request(self, n_tokens: int = 0, kani: "BaseKani | None" = None):
+        """
+        Wait until a request is admitted, then run the body of the ``async with`` statement as the request.
+
+        :param n_tokens: The estimated number of tokens the request will use, counted against the token budget until
+            the actual usage is recorded with ``ticket.record_usage()``.
+        :param kani: The kani making the request, used to prioritize it.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (self.priority(kani), next(self._seq), n_tokens, future))
+        self._dispatch()
+        try:
+            ticket = await future
+        except asyncio.CancelledError:
+            # if we were admitted as we were cancelled, give back our slot
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        try:
+            yield ticket
+        except Exception as e:
+            if is_ratelimit_error(e):
+                self._on_ratelimited()
+            raise
+        else:
+            self._backoff = DEFAULT_RATELIMIT_BACKOFF
+        finally:
+            self._release()
+
+    # ==== internals ====
+    def _release(self):
+        self.n_running -= 1
+        self._dispatch()
+
+    def _on_ratelimited(self):
+        log.warning(f"Rate limited by the provider; pausing all requests for {self._backoff} seconds.")
+        self._paused_until = max(self._paused_until, time.monotonic() + self._backoff)
+        self._backoff = min(self._backoff * 2, MAX_RATELIMIT_BACKOFF)
+
+    def _dispatch(self):
+        """Admit as many requests from the head of the queue as the budgets allow."""
+        while self._queue:
+            _, _, n_tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            wait = self._time_until_admissible(n_tokens)
+            if wait is None:
+                # waiting on a running request to finish, which will call _dispatch again
+                return
+            if wait > 0:
+                self._schedule_wakeup(wait)
+                return
+            heapq.heappop(self._queue)
+            self.n_running += 1
+            self._request_times.append(time.monotonic())
+            ticket = _Ticket(n_tokens)
+            self._token_entries.append(ticket.entry)
+            future.set_result(ticket)
+
+    def _time_until_admissible(self, n_tokens: int) -> float | None:
+        """
+        Returns 0 if a request using *n_tokens* can be admitted now, the number of seconds until the budgets might allow
+        it, or None if it must wait for a running request to finish.
+        """
+        now = time.monotonic()
+        window_start = now - self.period
+        while self._request_times and self._request_times[0] <= window_start:
+            self._request_times.popleft()
+        while self._token_entries and self._token_entries[0][0] <= window_start:
+            self._token_entries.popleft()
+
+        if self.max_concurrency is not None and self.n_running >= self.max_concurrency:
+            return None
+        wait = max(self._paused_until - now, 0)
+        if self.rpm_limit is not None and len(self._request_times) >= self.rpm_limit:
+            wait = max(wait, self._request_times[0] + self.period - now)
+        if self.tpm_limit is not None and self._token_entries:
+            # a request bigger than the whole budget can still go through once the window is empty
+            used = sum(n for _, n in self._token_entries)
+            if used + n_tokens > self.tpm_limit:
+                wait = max(wait, self._token_entries[0][0] + self.period - now)
+        return wait
+
+    def _schedule_wakeup(self, delay: float):
+        loop = asyncio.get_running_loop()
+        if self._wakeup is not None and self._wakeup.when() <= loop.time() + delay:
+            return
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = loop.call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+
+def is_ratelimit_error(e: Exception) -> bool:
+    """Whether the given exception (raised by an engine) means the provider rate limited the request."""
+    return getattr(e, "status_code", None) == 429 or "ratelimit" in type(e).__name__.lower()
+
+
+class ScheduledEngine(WrapperEngine):
+    """
+    A wrapper engine that makes each request to the wrapped engine through a :class:`RequestScheduler`.
+
+    .. code-block:: python
+
+        scheduler = RequestScheduler(rpm_limit=500, tpm_limit=200_000)
+        engine = ScheduledEngine(OpenAIEngine(model="gpt-4o"), scheduler)
+
+    This engine will pass-through attribute accesses to the wrapped engine.
+    """
+
+    def __init__(self, engine: BaseEngine, scheduler: RequestScheduler, *args, **kwargs):
+        """
+        :param engine: The engine to wrap.
+        :param scheduler: The scheduler to admit requests through. Share it between engines that draw from the same
+            quota.
+        """
+        super().__init__(engine, *args, **kwargs)
+        self.scheduler = scheduler
+
+    def _estimate_prompt_len(self, messages: list[ChatMessage], functions: list[AIFunction] | None) -> int:
+        n_tokens = sum(self.engine.message_len(m) for m in messages)
+        if functions:
+            n_tokens += self.engine.function_token_reserve(functions)
+        return n_tokens
+
+    async def predict(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> BaseCompletion:
+        n_tokens = self._estimate_prompt_len(messages, functions) if self.scheduler.tpm_limit is not None else 0
+        async with self.scheduler.request(n_tokens, current_kani.get()) as ticket:
+            completion = await self.engine.predict(messages, functions, **hyperparams)
+            _record_usage(ticket, completion, n_tokens)
+            return completion
+
+    async def stream(
+        self, messages: list[ChatMessage], functions: list[AIFunction] | None = None, **hyperparams
+    ) -> AsyncIterable[str | BaseCompletion]:
+        n_tokens = self._estimate_prompt_len(messages, functions) if self.scheduler.tpm_limit is not None else 0
+        async with self.scheduler.request(n_tokens, current_kani.get()) as ticket:
+            async for elem in self.engine.stream(messages, functions, **hyperparams):
+                if isinstance(elem, BaseCompletion):
+                    _record_usage(ticket, elem, n_tokens)
+                yield elem
+
+    def __repr__(self):
+        return f"{type(self).__name__}(engine={self.engine!r})"
+
+
+def _record_usage(ticket: _Ticket, completion: BaseCompletion, estimate: int):
+    # these are the same counts reported in TokensUsed events
+    prompt_tokens = completion.prompt_tokens if completion.prompt_tokens is not None else estimate
+    ticket.record_usage(prompt_tokens + (completion.completion_tokens or 0))
@@ -0,0 +1,222 @@
+"""
+A persistent catalog of the saves in a set of save directories, so that the server doesn't have to parse every save on
+startup.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from typing import Iterable
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from .indexer import load_save_meta, walk_saves
+from .models import SaveMeta
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+# how long to wait for another process's write to the catalog to finish, in seconds
+BUSY_TIMEOUT = 30
+# how many changed saves to write per transaction, so that writes never hold the database for long
+UPSERT_BATCH_SIZE = 64
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saves (
+    state_fp TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT,
+    last_modified REAL NOT NULL,
+    n_events INTEGER NOT NULL,
+    grouping_prefix TEXT NOT NULL,
+    event_fp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS saves_root ON saves (root);
+"""
+
+
+class SaveCatalog:
+    """
+    A SQLite database of save metadata, keyed by the path to each save's state file.
+
+    Each entry records the mtime and size of the state file when it was read. On :meth:`refresh`, the catalog walks
+    the save directories stat-ing each state file, and only reads the saves whose state file is new or has changed.
+
+    Each call opens its own database connection, so the catalog can be refreshed from a worker thread. Refreshes are
+    serialized across processes (e.g. the workers of a multi-process server) with a lock file next to the database, so
+    that only one process parses the changed saves and the others find the catalog already up to date.
+    """
+
+    def __init__(self, fp: Path):
+        """
+        :param fp: The path to the SQLite database. It will be created if it does not exist.
+        """
+        self.fp = fp
+
+    def _connect(self) -> sqlite3.Connection:
+        self.fp.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.fp, timeout=BUSY_TIMEOUT)
+        # let readers and a writer in other processes (e.g. other server workers) work at the same time, and wait for
+        # other writers instead of failing immediately
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+        # the catalog is a cache - if the schema changed, just start over
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS saves")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def refresh(self, roots: Iterable[Path]) -> dict[str, SaveMeta]:
+        """
+        Incrementally rescan the given save directories, update the catalog, and return all the saves found in them
+        (a mapping of save ID to save metadata).
+        """
+        with self._refresh_lock():
+            return self._refresh(roots)
+
+    @contextlib.contextmanager
+    def _refresh_lock(self):
+        """Hold an exclusive lock on the catalog's lock file, if the platform supports it."""
+        if fcntl is None:
+            yield
+            return
+        self.fp.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.fp.with_name(f"{self.fp.name}.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refresh(self, roots: Iterable[Path]) -> dict[str, SaveMeta]:
+        saves = {}
+        n_parsed = 0
+        conn = self._connect()
+        try:
+            for root in roots:
+                root_key = str(root)
+                known = {
+                    row[0]: row
+                    for row in conn.execute(
+                        "SELECT state_fp, mtime_ns, size, id, title, last_modified, n_events, grouping_prefix,"
+                        " event_fp FROM saves WHERE root = ?",
+                        (root_key,),
+                    )
+                }
+                seen = set()
+                # parse new and changed saves outside of any transaction, and write them in small batches, so that
+                # other processes refreshing the same catalog are never locked out for long
+                batch = []
+                for state_fp, stat in walk_saves(root):
+                    key = str(state_fp)
+                    seen.add(key)
+                    row = known.get(key)
+                    # unchanged since we last read it
+                    if row is not None and row[1] == stat.st_mtime_ns and row[2] == stat.st_size:
+                        save = _row_to_save(row)
+                        saves[save.id] = save
+                        continue
+                    # new or changed
+                    save = _read_save(state_fp)
+                    if save is None:
+                        continue
+                    n_parsed += 1
+                    saves[save.id] = save
+                    batch.append(_save_to_row(root, state_fp, stat, save))
+                    if len(batch) >= UPSERT_BATCH_SIZE:
+                        _write_rows(conn, batch)
+                        batch.clear()
+                _write_rows(conn, batch)
+                # forget saves that were deleted
+                with conn:
+                    conn.executemany("DELETE FROM saves WHERE state_fp = ?", ((k,) for k in known.keys() - seen))
+        finally:
+            conn.close()
+        log.debug(f"Refreshed save catalog - {len(saves)} saves found, {n_parsed} new or changed.")
+        return saves
+
+    def update(self, root: Path, state_fp: Path) -> SaveMeta | None:
+        """
+        Read the save with the given state file (found under the given save directory) and update its catalog entry.
+        Returns the save's metadata, or None if it could not be read.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                return self._upsert(conn, root, state_fp, state_fp.stat())
+        except FileNotFoundError:
+            return None
+        finally:
+            conn.close()
+
+    def remove(self, state_fp: Path) -> str | None:
+        """Remove the save with the given state file from the catalog. Returns the ID of the removed save, if any."""
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT id FROM saves WHERE state_fp = ?", (str(state_fp),)).fetchone()
+                conn.execute("DELETE FROM saves WHERE state_fp = ?", (str(state_fp),))
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    @staticmethod
+    def _upsert(conn: sqlite3.Connection, root: Path, state_fp: Path, stat: os.stat_result) -> SaveMeta | None:
+        save = _read_save(state_fp)
+        if save is None:
+            return None
+        _write_rows(conn, [_save_to_row(root, state_fp, stat, save)])
+        return save
+
+
+def _read_save(state_fp: Path) -> SaveMeta | None:
+    try:
+        return load_save_meta(state_fp)
+    except (OSError, ValueError, KeyError) as e:
+        log.warning(f"Could not read save at {state_fp}: {e}")
+        return None
+
+
+def _save_to_row(root: Path, state_fp: Path, stat: os.stat_result, save: SaveMeta) -> tuple:
+    return (
+        str(state_fp),
+        str(root),
+        stat.st_mtime_ns,
+        stat.st_size,
+        save.id,
+        save.title,
+        save.last_modified,
+        save.n_events,
+        json.dumps(save.grouping_prefix),
+        str(save.event_fp),
+    )
+
+
+def _write_rows(conn: sqlite3.Connection, rows: list[tuple]):
+    """Insert or replace the given catalog rows in their own transaction."""
+    if not rows:
+        return
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def _row_to_save(row: tuple) -> SaveMeta:
+    state_fp, _, _, save_id, title, last_modified, n_events, grouping_prefix, event_fp = row
+    return SaveMeta(
+        grouping_prefix=json.loads(grouping_prefix),
+        state_fp=Path(state_fp),
+        event_fp=Path(event_fp),
+        id=save_id,
+        title=title,
+        last_modified=last_modified,
+        n_events=n_events,
+    )
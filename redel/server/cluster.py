@@ -0,0 +1,321 @@
+"""
+Serve a :class:`.VizServer` from multiple worker processes.
+
+Each worker is a fork of the configured server, listening on a Unix socket. A front process serves the web interface
+and routes each interactive session's REST and websocket traffic to the worker that owns it, so that CPU-heavy work in
+one session (e.g. serializing a large state) doesn't add latency to sessions on other workers. Read-only save
+endpoints are spread across the workers round-robin. All the workers share the same save catalog database, and take
+turns refreshing it (see :class:`.SaveCatalog`).
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+import zlib
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
+
+try:
+    import httpx
+    import websockets
+except ImportError:
+    raise ImportError(
+        "You are missing required dependencies to serve the web viewer from multiple processes. Please install ReDel"
+        ' using `pip install "redel[web]"`.'
+    ) from None
+
+if TYPE_CHECKING:
+    from .server import VizServer
+
+log = logging.getLogger("server.cluster")
+
+WORKER_STARTUP_TIMEOUT = 30
+# hop-by-hop headers are specific to each connection, so they must not be forwarded by the proxy
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+
+class ServerWorker:
+    """A forked :class:`.VizServer` process listening on a Unix socket."""
+
+    def __init__(self, server: "VizServer", idx: int, uds: str, **kwargs):
+        self.idx = idx
+        self.uds = uds
+        self.process = multiprocessing.get_context("fork").Process(
+            target=_run_worker, args=(server, uds), kwargs=kwargs, name=f"redel-worker-{idx}", daemon=True
+        )
+        self.client = None
+
+    def start(self):
+        self.process.start()
+
+    def stop(self, timeout: float = 10):
+        if not self.process.is_alive():
+            return
+        # uvicorn shuts down gracefully (closing the worker's sessions) on SIGINT
+        os.kill(self.process.pid, signal.SIGINT)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def wait_until_ready(self, timeout: float = WORKER_STARTUP_TIMEOUT):
+        """Block until the worker is accepting requests."""
+        deadline = time.monotonic() + timeout
+        with httpx.Client(transport=httpx.HTTPTransport(uds=self.uds)) as client:
+            while True:
+                if not self.process.is_alive():
+                    raise RuntimeError(f"Worker {self.idx} exited with code {self.process.exitcode} during startup.")
+                try:
+                    client.get("http://worker/api/states").raise_for_status()
+                    return
+                except httpx.TransportError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Worker {self.idx} did not start within {timeout} seconds.")
+                    time.sleep(0.1)
+
+
+def _run_worker(server: "VizServer", uds: str, **kwargs):
+    import uvicorn
+
+    uvicorn.run(server.fastapi, uds=uds, **kwargs)
+
+
+class ClusterRouter:
+    """
+    The front process of a multi-process server. Routes requests to a set of :class:`ServerWorker` processes.
+
+    Each interactive session is pinned to the worker that created it. New sessions are created on the worker with the
+    fewest sessions. Sessions the router hasn't seen (e.g., after the router restarts) are routed by a hash of their ID.
+    """
+
+    def __init__(self, workers: list[ServerWorker]):
+        self.workers = workers
+        self.session_workers: dict[str, ServerWorker] = {}
+        self._round_robin = itertools.cycle(workers)
+
+        # webserver
+        self.fastapi = FastAPI(lifespan=self._lifespan)
+        self.setup_app()
+
+    # ==== routing ====
+    def worker_for_session(self, session_id: str) -> ServerWorker:
+        """Get the worker that owns the given interactive session."""
+        worker = self.session_workers.get(session_id)
+        if worker is None:
+            worker = self.workers[zlib.crc32(session_id.encode()) % len(self.workers)]
+        return worker
+
+    def least_loaded_worker(self) -> ServerWorker:
+        """Get the worker with the fewest interactive sessions, to create a new session on."""
+        counts = {worker.idx: 0 for worker in self.workers}
+        for worker in self.session_workers.values():
+            counts[worker.idx] += 1
+        return min(self.workers, key=lambda worker: counts[worker.idx])
+
+    async def forward(self, worker: ServerWorker, request: Request, body: bytes = None) -> StreamingResponse:
+        """Forward an HTTP request to the given worker, streaming the response back."""
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+        if body is None:
+            body = await request.body()
+        worker_request = worker.client.build_request(
+            request.method, request.url.path, params=request.query_params, headers=headers, content=body
+        )
+        response = await worker.client.send(worker_request, stream=True)
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers={k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS},
+            background=BackgroundTask(response.aclose),
+        )
+
+    async def proxy_websocket(self, worker: ServerWorker, websocket: WebSocket):
+        """Connect to the given worker's websocket endpoint and relay frames in both directions until either closes."""
+        subprotocols = websocket.scope.get("subprotocols", [])
+        try:
+            upstream = await websockets.unix_connect(
+                worker.uds,
+                f"ws://worker{websocket.url.path}",
+                subprotocols=subprotocols or None,
+                max_size=None,
+                compression=None,
+            )
+        except websockets.InvalidStatusCode:
+            # the worker refused the connection (i.e., no such session)
+            await websocket.close(1008)
+            return
+        await websocket.accept(subprotocol=upstream.subprotocol)
+
+        async def client_to_worker():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("text") is not None:
+                    await upstream.send(message["text"])
+                elif message.get("bytes") is not None:
+                    await upstream.send(message["bytes"])
+
+        async def worker_to_client():
+            async for data in upstream:
+                if isinstance(data, bytes):
+                    await websocket.send_bytes(data)
+                else:
+                    await websocket.send_text(data)
+            # forward the worker's close code (e.g. a slow client being evicted)
+            code = upstream.close_code or 1000
+            await websocket.close(code, upstream.close_reason or "")
+
+        tasks = [asyncio.create_task(client_to_worker()), asyncio.create_task(worker_to_client())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await upstream.close()
+
+    # ==== fastapi ====
+    @asynccontextmanager
+    async def _lifespan(self, _: FastAPI):
+        for worker in self.workers:
+            # no read timeout - event streams can take a while
+            worker.client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=worker.uds), base_url="http://worker", timeout=None
+            )
+        yield
+        await asyncio.gather(*(worker.client.aclose() for worker in self.workers))
+
+    def setup_app(self):
+        """Set up the FastAPI routes, middleware, etc."""
+        from .server import VIZ_DIST
+
+        # noinspection PyTypeChecker
+        self.fastapi.add_middleware(
+            CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
+        )
+
+        # ===== routes =====
+        # ---- saves ----
+        @self.fastapi.get("/api/saves")
+        async def list_saves() -> list[dict]:
+            """List the saves seen by all the workers (including each worker's unsaved interactive sessions)."""
+            responses = await asyncio.gather(*(worker.client.get("/api/saves") for worker in self.workers))
+            saves = {}
+            for response in responses:
+                response.raise_for_status()
+                for save in response.json():
+                    saves[save["id"]] = save
+            return list(saves.values())
+
+        @self.fastapi.post("/api/saves/{save_id}/load")
+        async def load_save(save_id: str, request: Request):
+            """Load a save as an interactive session on the worker that would own it."""
+            worker = self.worker_for_session(save_id)
+            self.session_workers[save_id] = worker
+            return await self.forward(worker, request)
+
+        @self.fastapi.api_route("/api/saves/{save_id}", methods=["GET", "DELETE"])
+        @self.fastapi.api_route("/api/saves/{save_id}/{path:path}", methods=["GET"])
+        async def route_save(save_id: str, request: Request):
+            """
+            Saves are read from disk, so any worker can serve them - except for interactive sessions, which the other
+            workers might not have seen yet.
+            """
+            worker = self.session_workers.get(save_id) or next(self._round_robin)
+            return await self.forward(worker, request)
+
+        # ---- interactive ----
+        @self.fastapi.get("/api/states")
+        async def list_states_interactive() -> list[dict]:
+            """List the interactive sessions loaded by all the workers."""
+            responses = await asyncio.gather(*(worker.client.get("/api/states") for worker in self.workers))
+            sessions = []
+            for worker, response in zip(self.workers, responses):
+                response.raise_for_status()
+                for session in response.json():
+                    self.session_workers[session["id"]] = worker
+                    sessions.append(session)
+            return sessions
+
+        @self.fastapi.post("/api/states")
+        async def create_state_interactive(request: Request):
+            """Create a new interactive session on the least loaded worker."""
+            worker = self.least_loaded_worker()
+            body = await request.body()
+            response = await worker.client.post(
+                "/api/states", content=body, headers={"content-type": request.headers.get("content-type", "")}
+            )
+            if response.is_success:
+                self.session_workers[response.json()["id"]] = worker
+            return StreamingResponse(
+                iter((response.content,)),
+                status_code=response.status_code,
+                headers={k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS},
+            )
+
+        @self.fastapi.api_route("/api/states/{session_id}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+        async def route_state_interactive(session_id: str, request: Request):
+            """Forward requests about an interactive session to the worker that owns it."""
+            return await self.forward(self.worker_for_session(session_id), request)
+
+        @self.fastapi.websocket("/api/ws/{session_id}")
+        async def ws_interactive(websocket: WebSocket, session_id: str):
+            """Relay a session's websocket to the worker that owns it."""
+            await self.proxy_websocket(self.worker_for_session(session_id), websocket)
+
+        # ---- everything else ----
+        @self.fastapi.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+        async def route_other(request: Request):
+            return await self.forward(next(self._round_robin), request)
+
+        # viz static files
+        self.fastapi.mount("/", StaticFiles(directory=VIZ_DIST, html=True), name="viz")
+
+
+def serve_cluster(server: "VizServer", workers: int, host: str = "127.0.0.1", port: int = 8000, **kwargs):
+    """
+    Serve the given server from *workers* forked worker processes behind a routing front process. Blocks until
+    interrupted. Keyword arguments are passed to :func:`uvicorn.run` for each process.
+    """
+    import uvicorn
+
+    if not hasattr(os, "fork"):
+        raise RuntimeError("Serving from multiple workers requires a platform that supports fork().")
+    with tempfile.TemporaryDirectory(prefix="redel-") as socket_dir:
+        # fork before we start any event loops
+        worker_procs = [
+            ServerWorker(server, idx, str(Path(socket_dir, f"worker-{idx}.sock")), **kwargs) for idx in range(workers)
+        ]
+        for worker in worker_procs:
+            worker.start()
+        try:
+            for worker in worker_procs:
+                worker.wait_until_ready()
+            log.info(f"Started {workers} workers.")
+            router = ClusterRouter(worker_procs)
+            uvicorn.run(router.fastapi, host=host, port=port, **kwargs)
+        finally:
+            for worker in worker_procs:
+                worker.stop()
@@ -1,33 +1,127 @@
 """
 This module contains utilities for indexing a directory that might contain ReDel saves.
+
+Indexing is split into two steps: a cheap walk that only stats files (:func:`walk_saves`), and parsing the metadata of
+a single save (:func:`load_save_meta`), which the :class:`.SaveCatalog` only does for saves that changed.
 """
 
 import json
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Iterable
 
 from .models import SaveMeta
 
+# the save metadata is written before the (much larger) state, so we usually only need to read the start of the file
+HEADER_READ_SIZE = 16 * 1024
+SAVE_META_KEYS = {"id", "title", "last_modified", "n_events"}
+DEFAULT_WALK_WORKERS = 8
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+def walk_saves(fp: Path, max_workers: int = DEFAULT_WALK_WORKERS) -> Iterable[tuple[Path, os.stat_result]]:
+    """
+    Recursively yield the path and stat result of each save's state file, starting from a given root dir.
+
+    Directories are scanned in parallel in a thread pool. Save directories are descended into too, since saves can be
+    nested inside other saves' directories.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="redel-walk") as pool:
+        pending = {pool.submit(_scan_dir, fp)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                state, subdirs = future.result()
+                if state is not None:
+                    yield state
+                pending.update(pool.submit(_scan_dir, subdir) for subdir in subdirs)
+
+
+def _scan_dir(fp: Path) -> tuple[tuple[Path, os.stat_result] | None, list[Path]]:
+    """Returns the state file in the given directory (if any) and the directory's subdirectories."""
+    state = None
+    subdirs = []
+    try:
+        with os.scandir(fp) as it:
+            for entry in it:
+                if entry.name == "state.json" and entry.is_file():
+                    state = (Path(entry.path), entry.stat())
+                elif entry.is_dir():
+                    subdirs.append(Path(entry.path))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return state, subdirs
+
+
+def read_state_header(state_fp: Path) -> dict:
+    """
+    Read the metadata fields of a state file (everything but the ``state`` key) without parsing the saved state, if
+    the metadata comes first in the file (which it does for all saves written by ReDel).
+    """
+    with open(state_fp, "rb") as f:
+        prefix = f.read(HEADER_READ_SIZE)
+    try:
+        # we might have cut a multibyte character in half at the end, but we never parse that far
+        header = _parse_header(prefix.decode("utf-8", errors="ignore"))
+        if SAVE_META_KEYS <= header.keys():
+            return header
+    except (ValueError, IndexError):
+        pass
+    # the metadata was too long or in an unexpected place, just read the whole thing
+    with open(state_fp, encoding="utf-8") as f:
+        data = json.load(f)
+    data.pop("state", None)
+    return data
+
+
+def _parse_header(text: str) -> dict:
+    """Parse the keys of a JSON object up to the "state" key. Raises ValueError if it isn't reached in the text."""
+    decoder = json.JSONDecoder()
+    header = {}
+    idx = _WHITESPACE.match(text, 0).end()
+    if text[idx] != "{":
+        raise ValueError("state file is not a JSON object")
+    while True:
+        idx = _WHITESPACE.match(text, idx + 1).end()
+        if text[idx] == "}":
+            return header
+        key, idx = decoder.raw_decode(text, idx)
+        idx = _WHITESPACE.match(text, idx).end()
+        if text[idx] != ":":
+            raise ValueError("expected ':'")
+        if key == "state":
+            return header
+        idx = _WHITESPACE.match(text, idx + 1).end()
+        header[key], idx = decoder.raw_decode(text, idx)
+        idx = _WHITESPACE.match(text, idx).end()
+        if text[idx] == "}":
+            return header
+        if text[idx] != ",":
+            raise ValueError("expected ','")
+
+
+def load_save_meta(state_fp: Path) -> SaveMeta:
+    """Read the metadata of the save with the given state file."""
+    fp = state_fp.parent
+    event_fp = fp / "events.jsonl"
+    if not event_fp.exists() and (fp / "events.bin").exists():
+        event_fp = fp / "events.bin"
+    data = read_state_header(state_fp)
+    return SaveMeta(
+        grouping_prefix=fp.parent.parts,
+        state_fp=state_fp,
+        event_fp=event_fp,
+        id=data["id"],
+        title=data["title"],
+        last_modified=data["last_modified"],
+        n_events=data["n_events"],
+    )
+
 
 def find_saves(fp: Path) -> Iterable[SaveMeta]:
     """Recursively yield saves starting from a given root dir."""
-    state_fp = fp / "state.json"
-    event_fp = fp / "events.jsonl"
-    if state_fp.exists():
-        with open(state_fp, encoding="utf-8") as f:
-            data = json.load(f)
-            yield SaveMeta(
-                grouping_prefix=fp.parent.parts,
-                state_fp=state_fp,
-                event_fp=event_fp,
-                id=data["id"],
-                title=data["title"],
-                last_modified=data["last_modified"],
-                n_events=data["n_events"],
-            )
-
-    # recurse
-    for subdir in fp.iterdir():
-        if not subdir.is_dir():
-            continue
-        yield from find_saves(subdir)
+    for state_fp, _ in walk_saves(fp):
+        yield load_save_meta(state_fp)
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal
 
 from pydantic import BaseModel
 
@@ -20,3 +21,9 @@ class SaveMeta(SessionMeta):
 
 class SessionState(SessionMeta):
     state: list[KaniState]
+
+
+class SessionStateSnapshot(SessionState):
+    """Sent over a websocket in place of the events a client missed, if it fell too far behind to catch up."""
+
+    type: Literal["session_state"] = "session_state"
@@ -1,12 +1,25 @@
 import asyncio
+import collections
 import logging
+import threading
+import time
 from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Annotated, Awaitable, Callable, Collection
 
 try:
-    from fastapi import Body, FastAPI, HTTPException, WebSocket, WebSocketDisconnect, WebSocketException
+    from fastapi import (
+        Body,
+        FastAPI,
+        HTTPException,
+        Query,
+        Response,
+        WebSocket,
+        WebSocketDisconnect,
+        WebSocketException,
+    )
     from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import StreamingResponse
     from fastapi.staticfiles import StaticFiles
 except ImportError:
     raise ImportError(
@@ -15,14 +28,19 @@ except ImportError:
     ) from None
 
 from redel import ReDel
-from redel.config import DEFAULT_LOG_DIR
+from redel.config import DEFAULT_LOG_DIR, REDEL_CACHE_DIR
+from redel.eventindex import EventLogReader
+from redel.eventlogger import get_sidecar_paths
 from redel.events import Error, SendMessage
-from redel.utils import read_jsonl
-from .indexer import find_saves
+from redel.replay import ReplayEngine
+from redel.utils import read_events
+from .catalog import SaveCatalog
 from .models import SaveMeta, SessionMeta, SessionState
 from .session_manager import SessionManager
+from .watcher import SaveWatcher
 
 VIZ_DIST = Path(__file__).parent / "viz_dist"
+MAX_REPLAY_ENGINES = 16
 log = logging.getLogger("server")
 
 
@@ -34,6 +52,10 @@ class VizServer:
         *,
         save_dirs: Collection[Path] = (DEFAULT_LOG_DIR,),
         redel_factory: Callable[[], Awaitable[ReDel]] = None,
+        catalog_fp: Path = REDEL_CACHE_DIR / "save_catalog.sqlite3",
+        watch_saves: bool = True,
+        session_idle_timeout: float | None = 30 * 60,
+        session_memory_budget: int | None = None,
     ):
         """
         :param redel_proto: If passed, interactive sessions will use the same configuration as the given prototype.
@@ -42,6 +64,17 @@ class VizServer:
             ``~/.redel/instances/``.
         :param redel_factory: An asynchronous function that creates a new :class:`.ReDel` instance when called.
             If this is set, ``redel_proto`` must not be set.
+        :param catalog_fp: The path to the SQLite database used to cache save metadata between runs, so that only new
+            or changed saves need to be read on startup. Defaults to ``~/.cache/redel/save_catalog.sqlite3``.
+        :param watch_saves: Whether to watch the save dirs for saves being created, changed, or deleted while the
+            server is running (e.g. by batch runs writing to the same directory). Uses native file notifications if
+            ``watchfiles`` is installed, or polls the save dirs otherwise.
+        :param session_idle_timeout: Interactive sessions with no activity for this many seconds (and no connected
+            clients) are hibernated: they are saved, their kanis and tools are closed, and they are released from
+            memory. A hibernated session is transparently restored from its save the next time it is accessed. Set to
+            ``None`` to never hibernate idle sessions. (default: 30 minutes)
+        :param session_memory_budget: If set, hibernate the least recently active idle sessions whenever the estimated
+            memory used by the loaded interactive sessions exceeds this many bytes.
         """
         if redel_proto and redel_factory:
             raise ValueError("At most one of ('redel_proto', 'redel_factory') may be supplied.")
@@ -53,9 +86,20 @@ class VizServer:
         # saves
         self.save_dirs = save_dirs
         self.saves: dict[str, SaveMeta] = {}
+        self.catalog = SaveCatalog(catalog_fp)
+        self.watch_saves = watch_saves
+        self.watcher = SaveWatcher(self)
 
         # interactive session states
         self.interactive_sessions: dict[str, SessionManager] = {}
+        self.hibernated_sessions: dict[str, SaveMeta] = {}
+        self.session_idle_timeout = session_idle_timeout
+        self.session_memory_budget = session_memory_budget
+        self._rehydrate_lock = asyncio.Lock()
+
+        # replay engines for recently viewed saves, least recently used first
+        self.replay_engines: collections.OrderedDict[str, ReplayEngine] = collections.OrderedDict()
+        self._replay_engines_lock = threading.Lock()
 
         # webserver
         self.fastapi = FastAPI(lifespan=self._lifespan)
@@ -63,36 +107,216 @@ class VizServer:
 
     # ==== utils ====
     async def reindex_saves(self):
-        """Asynchronously walk the save_dirs and update self.saves."""
+        """
+        Asynchronously walk the save_dirs and update self.saves. Only saves that are new or changed since the last
+        index (according to the save catalog) are read.
+        """
+        await self.watcher.refresh()
+
+    @staticmethod
+    def resolve_event_range(
+        reader: EventLogReader, offset: int = 0, limit: int = None, after: float = None, before: float = None
+    ) -> tuple[int, int, int]:
+        """
+        Find the range of event indices to return for a request for a range of a save's events.
 
-        def _index():
-            new_saves = {}
-            for root in self.save_dirs:
-                for save in find_saves(root):
-                    new_saves[save.id] = save
-            self.saves = new_saves
-            log.info(f"Finished indexing saves - {len(self.saves)} files loaded.")
+        Returns a tuple (start, stop, total), where *total* is the number of events in the timestamp window (ignoring
+        *offset* and *limit*).
+        """
+        window_start = reader.bisect_timestamp(after) if after is not None else 0
+        window_stop = reader.bisect_timestamp(before) if before is not None else len(reader)
+        window_stop = max(window_start, window_stop)
+        start = min(window_start + offset, window_stop)
+        stop = window_stop if limit is None else min(start + limit, window_stop)
+        return start, stop, window_stop - window_start
+
+    def get_replay_engine(self, save_id: str, reader: EventLogReader) -> ReplayEngine:
+        """
+        Get the replay engine for the given save, replaying any new events in its event log. Blocks while replaying, so
+        this should be run in a worker thread.
+        """
+        with self._replay_engines_lock:
+            engine = self.replay_engines.get(save_id)
+            # if the log was overwritten, start over
+            if engine is None or engine.n_events > len(reader):
+                engine = ReplayEngine()
+            self.replay_engines[save_id] = engine
+            self.replay_engines.move_to_end(save_id)
+            while len(self.replay_engines) > MAX_REPLAY_ENGINES:
+                self.replay_engines.popitem(last=False)
+        engine.update(reader)
+        return engine
 
-        # most of the time is spent in IO with the filesystem so we can thread this
-        await asyncio.get_event_loop().run_in_executor(None, _index)
+    async def create_new_redel(self, **kwargs) -> ReDel:
+        """
+        Return a new ReDel instance given the server config.
 
-    async def create_new_redel(self) -> ReDel:
-        """Return a new ReDel instance given the server config."""
+        Keyword arguments override the configuration (e.g. to set the ``session_id`` and ``log_dir`` of a session
+        being restored).
+        """
         if self.redel_proto:
-            return ReDel(**self.redel_proto.get_config())
-        return await self.redel_factory()
+            return ReDel(**self.redel_proto.get_config(**kwargs))
+        redel = await self.redel_factory()
+        if kwargs:
+            return ReDel(**redel.get_config(**kwargs))
+        return redel
+
+    # ==== interactive sessions ====
+    async def get_session(self, session_id: str) -> SessionManager | None:
+        """
+        Get the manager of a loaded interactive session, restoring it from its save if it was hibernated. Returns None
+        if no such session is loaded.
+        """
+        if session_id in self.interactive_sessions:
+            return self.interactive_sessions[session_id]
+        if session_id not in self.hibernated_sessions:
+            return None
+        async with self._rehydrate_lock:
+            # someone else might have restored it while we were waiting
+            if session_id in self.interactive_sessions:
+                return self.interactive_sessions[session_id]
+            save = self.hibernated_sessions[session_id]
+            log.info(f"Restoring hibernated session {session_id}...")
+            try:
+                manager = await self.load_session(save)
+            except FileNotFoundError:
+                log.warning(f"Could not restore session {session_id}: its save was deleted.")
+                manager = None
+            del self.hibernated_sessions[session_id]
+            return manager
+
+    async def open_session(self, save_id: str) -> SessionManager | None:
+        """
+        Get the manager of an interactive session, loading it from the save with the given ID if it is not already
+        loaded. Returns None if there is no such session or save.
+        """
+        manager = await self.get_session(save_id)
+        if manager is not None:
+            return manager
+        if save_id not in self.saves:
+            return None
+        async with self._rehydrate_lock:
+            if save_id in self.interactive_sessions:
+                return self.interactive_sessions[save_id]
+            log.info(f"Loading save {save_id} as an interactive session...")
+            try:
+                return await self.load_session(self.saves[save_id])
+            except FileNotFoundError:
+                return None
+
+    async def load_session(self, save: SaveMeta) -> SessionManager:
+        """Load the given save as an interactive session, which continues logging to the same save."""
+        state = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: SessionState.model_validate_json(save.state_fp.read_text())
+        )
+        kwargs = dict(
+            session_id=save.id,
+            log_dir=save.state_fp.parent,
+            log_format="binary" if save.event_fp.suffix == ".bin" else "jsonl",
+        )
+        if save.title is not None:
+            kwargs["title"] = save.title
+        redel = await self.create_new_redel(**kwargs)
+        await redel.load_state(state.state)
+        manager = SessionManager(self, redel)
+        self.interactive_sessions[save.id] = manager
+        await manager.start()
+        return manager
+
+    async def hibernate_session(self, session_id: str, idle_since: float = None) -> bool:
+        """
+        Save and close the given interactive session, releasing its resources until it is next accessed. Returns whether
+        the session was hibernated.
+
+        :param idle_since: If the session is being hibernated because it is idle, the time (per :func:`time.monotonic`)
+            it was last active when it was chosen. If it has been active since then, or is busy, it is not hibernated.
+        """
+        # requests for the session while it's being hibernated wait on the lock, then restore it
+        async with self._rehydrate_lock:
+            manager = self.interactive_sessions.get(session_id)
+            if manager is None:
+                return False
+            # a client might have connected or sent a message while we were closing other sessions
+            if idle_since is not None and (manager.is_busy or manager.last_active > idle_since):
+                log.debug(f"Not hibernating session {session_id}: it became active.")
+                return False
+            log.info(f"Hibernating idle session {session_id}...")
+            # mark the session as hibernated before it leaves the interactive sessions, so it never looks missing
+            self.hibernated_sessions[session_id] = manager.get_save_meta()
+            del self.interactive_sessions[session_id]
+            await manager.close()
+            save = manager.get_save_meta()
+            self.hibernated_sessions[session_id] = save
+            self.saves[session_id] = save
+            return True
+
+    async def hibernate_idle_sessions(self):
+        """Hibernate sessions that have been idle for too long, or the least recently active ones if over budget."""
+        idle = sorted(
+            (manager for manager in self.interactive_sessions.values() if not manager.is_busy),
+            key=lambda manager: manager.last_active,
+        )
+        to_hibernate = []
+        if self.session_idle_timeout is not None:
+            cutoff = time.monotonic() - self.session_idle_timeout
+            to_hibernate.extend(manager for manager in idle if manager.last_active < cutoff)
+        if self.session_memory_budget is not None:
+            usage = sum(manager.estimate_memory() for manager in self.interactive_sessions.values())
+            usage -= sum(manager.estimate_memory() for manager in to_hibernate)
+            for manager in idle:
+                if usage <= self.session_memory_budget:
+                    break
+                if manager not in to_hibernate:
+                    to_hibernate.append(manager)
+                    usage -= manager.estimate_memory()
+        # each close yields to other requests, so the sessions are checked again before they are hibernated
+        last_active = {manager.redel.session_id: manager.last_active for manager in to_hibernate}
+        for session_id, idle_since in last_active.items():
+            await self.hibernate_session(session_id, idle_since=idle_since)
+
+    async def _hibernate_task(self):
+        interval = min(60, self.session_idle_timeout / 4) if self.session_idle_timeout else 60
+        while True:
+            await asyncio.sleep(interval)
+            # noinspection PyBroadException
+            try:
+                await self.hibernate_idle_sessions()
+            except Exception:
+                log.exception("Exception when hibernating idle sessions:")
+
+    def serve(self, host="127.0.0.1", port=8000, workers: int = 1, **kwargs):
+        """
+        Serve this server at the given IP and port. Blocks until interrupted.
 
-    def serve(self, host="127.0.0.1", port=8000, **kwargs):
-        """Serve this server at the given IP and port. Blocks until interrupted."""
+        :param workers: If more than 1, run interactive sessions in this many forked worker processes, with a front
+            process that routes each session's requests to the worker that owns it (see :mod:`redel.server.cluster`).
+            Requires a platform that supports ``fork()``.
+        """
         import uvicorn
 
+        if workers > 1:
+            from .cluster import serve_cluster
+
+            serve_cluster(self, workers, host=host, port=port, **kwargs)
+            return
         uvicorn.run(self.fastapi, host=host, port=port, **kwargs)
 
     # ==== fastapi ====
     @asynccontextmanager
     async def _lifespan(self, _: FastAPI):
-        _ = asyncio.create_task(self.reindex_saves())
+        if self.watch_saves:
+            index_task = asyncio.create_task(self.watcher.run())
+        else:
+            index_task = asyncio.create_task(self.reindex_saves())
+            index_task.add_done_callback(_log_task_exception)
+        if self.session_idle_timeout is not None or self.session_memory_budget is not None:
+            hibernate_task = asyncio.create_task(self._hibernate_task())
+        else:
+            hibernate_task = None
         yield
+        index_task.cancel()
+        if hibernate_task is not None:
+            hibernate_task.cancel()
         await asyncio.gather(*(session.close() for session in self.interactive_sessions.values()))
 
     def setup_app(self):
@@ -118,13 +342,79 @@ class VizServer:
             save = self.saves[save_id]
             return SessionState.model_validate_json(save.state_fp.read_text())
 
+        @self.fastapi.get("/api/saves/{save_id}/state")
+        async def get_save_state_at(save_id: str, at: Annotated[int, Query(ge=0)] = None) -> SessionState:
+            """
+            Get the state of a given save after its first ``at`` events (or after all events, if not given).
+
+            The server replays the save's event log once, keeping a checkpoint every few hundred events; after that,
+            any point can be reconstructed from the nearest checkpoint.
+            """
+            if save_id not in self.saves:
+                raise HTTPException(404, "save not found")
+            save = self.saves[save_id]
+
+            def _state_at():
+                with EventLogReader(save.event_fp) as reader:
+                    engine = self.get_replay_engine(save_id, reader)
+                    n_events = engine.n_events if at is None else min(at, engine.n_events)
+                    return n_events, engine.state_at(reader, n_events)
+
+            n_events, state = await asyncio.get_running_loop().run_in_executor(None, _state_at)
+            meta = self.saves[save_id]
+            return SessionState(
+                id=meta.id, title=meta.title, last_modified=meta.last_modified, n_events=n_events, state=state
+            )
+
         @self.fastapi.get("/api/saves/{save_id}/events")
-        async def get_save_events(save_id: str):
-            """Get all events in a given save (not interactive - this just loads from file)."""
+        async def get_save_events(
+            save_id: str,
+            response: Response,
+            offset: Annotated[int, Query(ge=0)] = 0,
+            limit: Annotated[int, Query(ge=0)] = None,
+            after: float = None,
+            before: float = None,
+            stream: bool = False,
+        ):
+            """
+            Get the events in a given save (not interactive - this just loads from file).
+
+            With no query parameters, returns all the events as a JSON list. Otherwise, the events are read
+            incrementally from disk using the save's offset index:
+
+            - ``after``/``before`` only return events with a timestamp in the window [after, before)
+            - ``offset``/``limit`` page through the events (in the timestamp window, if given)
+            - ``stream=true`` streams the events as newline-delimited JSON instead of returning a list
+
+            The ``X-Total-Count`` header is set to the number of events in the timestamp window.
+            """
             if save_id not in self.saves:
                 raise HTTPException(404, "save not found")
             save = self.saves[save_id]
-            return list(read_jsonl(save.event_fp))
+            if not (offset or limit is not None or after is not None or before is not None or stream):
+                return list(read_events(save.event_fp))
+
+            loop = asyncio.get_running_loop()
+            # opening the reader may need to scan the log if the index is missing, so don't block the event loop
+            reader = await loop.run_in_executor(None, EventLogReader, save.event_fp)
+            try:
+                start, stop, total = await loop.run_in_executor(
+                    None, self.resolve_event_range, reader, offset, limit, after, before
+                )
+            except BaseException:
+                reader.close()
+                raise
+            headers = {"X-Total-Count": str(total)}
+
+            if stream:
+                return _EventStreamResponse(
+                    reader, reader.iter_raw(start, stop), media_type="application/x-ndjson", headers=headers
+                )
+
+            with reader:
+                events = await loop.run_in_executor(None, lambda: list(reader.iter_events(start, stop)))
+            response.headers.update(headers)
+            return events
 
         @self.fastapi.delete("/api/saves/{save_id}")
         async def delete_save(save_id: str) -> SaveMeta:
@@ -135,6 +425,8 @@ class VizServer:
             try:
                 save.state_fp.unlink(missing_ok=True)
                 save.event_fp.unlink(missing_ok=True)
+                for sidecar_fp in get_sidecar_paths(save.event_fp):
+                    sidecar_fp.unlink(missing_ok=True)
                 del self.saves[save_id]
                 save.state_fp.parent.rmdir()
             except FileNotFoundError:
@@ -144,13 +436,26 @@ class VizServer:
                 log.warning(f"Could not fully delete save: {e}")
             return save
 
-        # todo: load save
+        @self.fastapi.post("/api/saves/{save_id}/load")
+        async def load_save(save_id: str) -> SessionState:
+            """
+            Load a save as an interactive session, continuing where it left off and logging to the same save. If the
+            session is already loaded, returns its current state.
+
+            Only the root kani is rebuilt immediately; the rest of the tree is rebuilt as it is used.
+            """
+            manager = await self.open_session(save_id)
+            if manager is None:
+                raise HTTPException(404, "save not found")
+            return manager.get_state()
 
         # ---- interactive ----
         @self.fastapi.get("/api/states")
         async def list_states_interactive() -> list[SessionMeta]:
-            """List the interactive sessions currently loaded by the server."""
-            return [manager.get_session_meta() for manager in self.interactive_sessions.values()]
+            """List the interactive sessions currently loaded by the server (including hibernated sessions)."""
+            return [manager.get_session_meta() for manager in self.interactive_sessions.values()] + [
+                SessionMeta.model_validate(save, from_attributes=True) for save in self.hibernated_sessions.values()
+            ]
 
         @self.fastapi.post("/api/states")
         async def create_state_interactive(start_content: Annotated[str, Body(embed=True)] = None) -> SessionState:
@@ -165,33 +470,33 @@ class VizServer:
             self.saves[redel.session_id] = manager.get_save_meta()
             await manager.start()
             if start_content:
-                await manager.msg_queue.put(SendMessage(content=start_content))
+                await manager.send_message(SendMessage(content=start_content))
             return manager.get_state()
 
         @self.fastapi.get("/api/states/{session_id}")
         async def get_state_interactive(session_id: str) -> SessionState:
             """Get the state of a specific interactive session loaded in the server."""
-            if session_id not in self.interactive_sessions:
+            manager = await self.get_session(session_id)
+            if manager is None:
                 raise HTTPException(404, "session is not initialized - load from archive or create new first")
-            manager = self.interactive_sessions[session_id]
             return manager.get_state()
 
         @self.fastapi.websocket("/api/ws/{session_id}")
         async def ws_interactive(websocket: WebSocket, session_id: str):
             """Stream events from a given session loaded in the server."""
-            if session_id not in self.interactive_sessions:
+            manager = await self.get_session(session_id)
+            if manager is None:
                 raise WebSocketException(
                     1008,  # policy violation
                     "session is not initialized - load from archive or create new first",
                 )
-            manager = self.interactive_sessions[session_id]
             await manager.connect(websocket)
             while True:
                 try:
                     data = await websocket.receive_text()
                     log.debug(f"got data from ws for session {session_id}: {data}")
                     event = SendMessage.model_validate_json(data)  # todo additional message types
-                    await manager.msg_queue.put(event)
+                    await manager.send_message(event)
                 except WebSocketDisconnect:
                     manager.disconnect(websocket)
                     break
@@ -207,3 +512,22 @@ class VizServer:
                 " https://redel.readthedocs.io/en/latest/install.html#building-web-interface for more information."
             )
         self.fastapi.mount("/", StaticFiles(directory=VIZ_DIST, html=True), name="viz")
+
+
+class _EventStreamResponse(StreamingResponse):
+    """Streams events from an event log reader, and closes the reader once done - even if the client disconnects."""
+
+    def __init__(self, reader: EventLogReader, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reader = reader
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.reader.close()
+
+
+def _log_task_exception(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Error while indexing the save directories:", exc_info=task.exception())
@@ -1,15 +1,39 @@
 import asyncio
+import collections
+import json
+import logging
+import time
+import zlib
 from typing import TYPE_CHECKING
 
 from fastapi import WebSocket
 
-from redel import ReDel
-from redel.events import BaseEvent, RoundComplete
-from .models import SaveMeta, SessionMeta, SessionState
+from redel import BackpressurePolicy, ReDel
+from redel.events import BaseEvent, RoundComplete, SendMessage
+from redel.replay import ReplayState
+from redel.state import RunState
+from .models import SaveMeta, SessionMeta, SessionState, SessionStateSnapshot
 
 if TYPE_CHECKING:
     from .server import VizServer
 
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECTION_QUEUE_SIZE = 256
+# if a client needs to be resynced more than this many times in the window, it is disconnected
+MAX_RESYNCS = 3
+RESYNC_WINDOW = 60
+# websocket subprotocols a client can request when connecting:
+# each frame is a JSON list of all the events produced in one tick of the event loop...
+WS_PROTOCOL_BATCH = "redel.batch.v1"
+# ...or the same list, zlib-compressed and sent as a binary frame
+WS_PROTOCOL_BATCH_ZLIB = "redel.batch.zlib.v1"
+WS_PROTOCOLS = (WS_PROTOCOL_BATCH, WS_PROTOCOL_BATCH_ZLIB)
+# the approximate memory used by a chat message on top of its text, in bytes
+MESSAGE_OVERHEAD = 512
+# the kani events that change the session state
+_STATE_EVENT_TYPES = ("kani_spawn", "kani_state_change", "kani_message")
+
 
 class SessionManager:
     """Responsible for a single session and all connections to it."""
@@ -17,10 +41,15 @@ class SessionManager:
     def __init__(self, server: "VizServer", redel: ReDel):
         self.server = server
         self.redel = redel
-        self.redel.add_listener(self.on_event)
+        # if the websockets can't keep up, stream deltas are the first to go
+        self.redel.add_listener(self.on_event, policy=BackpressurePolicy.DROP_UNLOGGED)
         self.task = None
         self.msg_queue = asyncio.Queue()
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+        # the session state as of the last event sent to the clients, to resync clients that fall behind
+        self.client_state = ReplayState({state.id: state.model_dump(mode="json") for state in redel.get_state()})
+        self.last_active = time.monotonic()
+        """The time (per :func:`time.monotonic`) of the last message, event, or connection in this session."""
 
     # ==== lifecycle ====
     async def start(self):
@@ -31,11 +60,32 @@ class SessionManager:
     async def close(self):
         if self.task is not None:
             self.task.cancel()
+        for connection in self.active_connections.values():
+            connection.stop()
         await self.redel.close()
 
+    @property
+    def is_busy(self) -> bool:
+        """Whether the session is handling a message, has messages waiting, or has any clients connected."""
+        return bool(
+            self.active_connections
+            or not self.msg_queue.empty()
+            or any(ai.state != RunState.STOPPED for ai in self.redel.kanis.values())
+        )
+
+    def estimate_memory(self) -> int:
+        """A rough estimate of the memory used by the session's kanis, in bytes, based on their chat histories."""
+        total = 0
+        histories = [ai.chat_history for ai in self.redel.kanis.values()]
+        histories.extend(state.chat_history for state in self.redel.dormant_kanis.values())
+        for history in histories:
+            for msg in history:
+                total += MESSAGE_OVERHEAD + (len(msg.text) if msg.text else 0)
+        return total
+
     # ==== state ====
     def get_state(self) -> SessionState:
-        kanis = [ai.get_save_state() for ai in self.redel.kanis.values()]
+        kanis = self.redel.get_state()
         return SessionState(
             id=self.redel.session_id,
             title=self.redel.title,
@@ -63,21 +113,198 @@ class SessionManager:
             event_fp=self.redel.logger.aof_path,
         )
 
+    def get_snapshot(self) -> str:
+        """Get the serialized state of the session as of the last event sent to the clients."""
+        return SessionStateSnapshot(
+            id=self.redel.session_id,
+            title=self.redel.title,
+            last_modified=self.redel.logger.last_modified,
+            n_events=self.redel.logger.event_count.total(),
+            state=self.client_state.get_state(),
+        ).model_dump_json()
+
     # ==== ws ====
+    async def send_message(self, event: SendMessage):
+        """Queue a message from the user to be handled by the session."""
+        self.last_active = time.monotonic()
+        await self.msg_queue.put(event)
+
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+        """
+        Accept a websocket connection to this session.
+
+        By default, each event is sent as its own JSON text frame. Clients can instead request one of the batched
+        protocols in ``WS_PROTOCOLS`` as a websocket subprotocol, in order of preference.
+        """
+        self.last_active = time.monotonic()
+        protocol = next((p for p in websocket.scope.get("subprotocols", ()) if p in WS_PROTOCOLS), None)
+        await websocket.accept(subprotocol=protocol)
+        connection = ClientConnection(self, websocket, protocol=protocol)
+        self.active_connections[websocket] = connection
+        connection.start()
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.last_active = time.monotonic()
+        connection = self.active_connections.pop(websocket, None)
+        if connection is not None:
+            connection.stop()
 
-    async def broadcast(self, data: str):
-        await asyncio.gather(
-            *(connection.send_text(data) for connection in self.active_connections), return_exceptions=True
-        )
+    def broadcast(self, data: str, loggable: bool = True):
+        """Queue the given serialized message to be sent to each connected client. Does not block."""
+        for connection in list(self.active_connections.values()):
+            connection.send(data, loggable)
 
     async def on_event(self, event: BaseEvent):
-        await self.broadcast(event.model_dump_json())
+        self.last_active = time.monotonic()
+        # serialize once, and share the payload between all the connections
+        data = event.model_dump_json()
+        if event.type in _STATE_EVENT_TYPES:
+            self.client_state.handle_event(json.loads(data))
+        self.broadcast(data, event.__log_event__)
         # update the server save info on each RoundComplete
         if isinstance(event, RoundComplete):
             self.server.saves[self.redel.session_id] = self.get_save_meta()
+
+
+class ClientConnection:
+    """
+    A single websocket connected to a session, with its own bounded queue of outgoing messages and a task that sends
+    them, so a slow client never holds up the session or the other clients.
+
+    If the queue fills up, unlogged messages (i.e., stream deltas) are dropped first. If it is full of logged events,
+    the queued events are discarded and the client is sent a snapshot of the whole session state instead. Clients that
+    need to be resynced too often are disconnected.
+
+    If the client negotiated a batched protocol, all the messages queued in one tick of the event loop are sent as a
+    single frame.
+    """
+
+    def __init__(
+        self,
+        manager: SessionManager,
+        websocket: WebSocket,
+        max_queue_size: int = DEFAULT_CONNECTION_QUEUE_SIZE,
+        protocol: str = None,
+    ):
+        self.manager = manager
+        self.websocket = websocket
+        self.max_queue_size = max_queue_size
+        self.protocol = protocol
+        self.n_dropped = 0
+        """The number of unlogged messages dropped because this client was too slow."""
+
+        # internals
+        self._queue: collections.deque[tuple[str, bool]] = collections.deque()  # (data, loggable)
+        self._not_empty = asyncio.Event()
+        self._needs_resync = False
+        self._n_missed = 0
+        self._resync_times = collections.deque()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def send(self, data: str, loggable: bool = True):
+        """Queue a serialized message to send to this client. Does not block."""
+        if self._needs_resync:
+            # the snapshot will include this event, but if the client still hasn't caught up, it's stuck
+            self._n_missed += 1
+            if self._n_missed > self.max_queue_size:
+                self._evict()
+            return
+        if len(self._queue) >= self.max_queue_size:
+            if not loggable:
+                self.n_dropped += 1
+                return
+            # make room by dropping the oldest unlogged message in the queue, if there is one
+            for idx, (_, queued_loggable) in enumerate(self._queue):
+                if not queued_loggable:
+                    del self._queue[idx]
+                    self.n_dropped += 1
+                    break
+            else:
+                self._resync()
+                return
+        self._queue.append((data, loggable))
+        self._not_empty.set()
+
+    def _resync(self):
+        now = time.monotonic()
+        while self._resync_times and self._resync_times[0] < now - RESYNC_WINDOW:
+            self._resync_times.popleft()
+        self._resync_times.append(now)
+        if len(self._resync_times) > MAX_RESYNCS:
+            self._evict()
+            return
+        log.info("Websocket client fell behind; resyncing it with a state snapshot.")
+        self._queue.clear()
+        self._needs_resync = True
+        self._n_missed = 0
+        self._not_empty.set()
+
+    def _evict(self):
+        log.warning("Websocket client is too slow to keep up with the session; disconnecting it.")
+        self.manager.disconnect(self.websocket)
+        # 1013: try again later
+        asyncio.create_task(self._close(1013, "client too slow"))
+
+    async def _close(self, code: int, reason: str):
+        # noinspection PyBroadException
+        try:
+            await asyncio.wait_for(self.websocket.close(code, reason), timeout=5)
+        except Exception:
+            pass
+
+    async def _writer(self):
+        try:
+            while True:
+                await self._not_empty.wait()
+                if self.protocol is None:
+                    if not await self._send_next():
+                        self._not_empty.clear()
+                else:
+                    # let the rest of this tick's events queue up
+                    await asyncio.sleep(0)
+                    if not await self._send_batch():
+                        self._not_empty.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the websocket was probably closed - the ws handler will clean up the connection
+            log.debug(f"Could not send to websocket client: {e}")
+
+    def _next_message(self) -> str | None:
+        if self._needs_resync:
+            # take the snapshot when we actually send it, so it includes everything the client missed
+            self._needs_resync = False
+            return self.manager.get_snapshot()
+        if self._queue:
+            return self._queue.popleft()[0]
+        return None
+
+    async def _send_next(self) -> bool:
+        """Send the next queued message as its own frame. Returns whether there was anything to send."""
+        data = self._next_message()
+        if data is None:
+            return False
+        await self.websocket.send_text(data)
+        return True
+
+    async def _send_batch(self) -> bool:
+        """Send all the queued messages as a single frame. Returns whether there was anything to send."""
+        messages = []
+        while (data := self._next_message()) is not None:
+            messages.append(data)
+        if not messages:
+            return False
+        # the messages are already serialized, so we can build the list without re-encoding them
+        frame = f"[{','.join(messages)}]"
+        if self.protocol == WS_PROTOCOL_BATCH_ZLIB:
+            await self.websocket.send_bytes(zlib.compress(frame.encode("utf-8")))
+        else:
+            await self.websocket.send_text(frame)
+        return True
@@ -0,0 +1,140 @@
+"""
+Keeps a :class:`.VizServer`'s list of saves up to date as saves are written by other processes.
+"""
+
+import asyncio
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+if TYPE_CHECKING:
+    from .server import VizServer
+
+log = logging.getLogger(__name__)
+
+
+class SaveWatcher:
+    """
+    Watches a server's save directories for ``state.json`` files being created, changed, or deleted, and updates the
+    server's saves (and save catalog) to match.
+
+    If `watchfiles <https://watchfiles.helpmanual.io/>`_ is installed (it is included in ``pip install "redel[web]"``),
+    this uses the OS's native file notifications (e.g. inotify). Otherwise, it falls back to periodically refreshing the
+    save catalog, which only stats the files in the save directories and reads the saves that changed.
+    """
+
+    def __init__(
+        self, server: "VizServer", poll_interval: float = 10, force_polling: bool = False, retry_delay: float = 5
+    ):
+        """
+        :param server: The server whose saves to keep up to date.
+        :param poll_interval: If polling, how often to rescan the save directories, in seconds.
+        :param force_polling: Whether to poll even if native file notifications are available.
+        :param retry_delay: How long to wait before indexing and watching again after an error, in seconds.
+        """
+        self.server = server
+        self.poll_interval = poll_interval
+        self.force_polling = force_polling
+        self.retry_delay = retry_delay
+        # the saves found on disk the last time we looked, so we know which ones were deleted
+        self._catalog_save_ids: set[str] = set()
+
+    async def run(self):
+        """
+        Index the server's saves, then watch for changes forever. If indexing or watching fails, the error is logged and
+        the saves are indexed again after a delay (so that changes missed in the meantime are picked up).
+        """
+        while True:
+            try:
+                await self._run()
+            except asyncio.CancelledError:
+                raise
+            # noinspection PyBroadException
+            except Exception:
+                log.exception(f"Error while indexing or watching the save dirs, retrying in {self.retry_delay}s.")
+                await asyncio.sleep(self.retry_delay)
+
+    async def _run(self):
+        await self.refresh()
+        # watchfiles reports absolute paths, but the catalog is keyed by the save dirs as given
+        roots = {root.resolve(): root for root in self.server.save_dirs if root.exists()}
+        if watchfiles is not None and not self.force_polling and roots:
+            await self._watch(roots)
+        else:
+            if watchfiles is None:
+                reason = "watchfiles is not installed"
+            elif self.force_polling:
+                reason = "force_polling is set"
+            else:
+                reason = "none of the save directories exist yet"
+            log.info(f"Polling the save directories for changes every {self.poll_interval}s ({reason}).")
+            await self._poll()
+
+    async def refresh(self):
+        """Incrementally rescan all the server's save dirs and update its saves."""
+        await self._refresh()
+        log.info(f"Finished indexing saves - {len(self.server.saves)} files loaded.")
+
+    async def _refresh(self):
+        new_saves = await asyncio.get_running_loop().run_in_executor(
+            None, self.server.catalog.refresh, self.server.save_dirs
+        )
+        for save_id in self._catalog_save_ids - new_saves.keys():
+            self._forget(save_id)
+        self.server.saves.update(new_saves)
+        self._catalog_save_ids = set(new_saves)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self._refresh()
+
+    async def _watch(self, roots: dict[Path, Path]):
+        log.info(f"Watching {len(roots)} save directories for changes.")
+        async for changes in watchfiles.awatch(*roots, watch_filter=_is_state_file, recursive=True):
+            for change, path in changes:
+                root, state_fp = _to_save_dir_path(roots, Path(path))
+                if change == watchfiles.Change.deleted:
+                    await self._on_delete(state_fp)
+                else:
+                    await self._on_change(root, state_fp)
+
+    async def _on_change(self, root: Path, state_fp: Path):
+        save = await asyncio.get_running_loop().run_in_executor(None, self.server.catalog.update, root, state_fp)
+        if save is None:
+            return
+        log.debug(f"Save {save.id} at {state_fp} was updated.")
+        self.server.saves[save.id] = save
+        self._catalog_save_ids.add(save.id)
+
+    async def _on_delete(self, state_fp: Path):
+        save_id = await asyncio.get_running_loop().run_in_executor(None, self.server.catalog.remove, state_fp)
+        if save_id is None:
+            return
+        log.debug(f"Save {save_id} at {state_fp} was deleted.")
+        self._catalog_save_ids.discard(save_id)
+        self._forget(save_id)
+
+    def _forget(self, save_id: str):
+        # don't forget interactive sessions that haven't been saved again yet
+        if save_id not in self.server.interactive_sessions:
+            self.server.saves.pop(save_id, None)
+
+
+def _is_state_file(_, path: str) -> bool:
+    return Path(path).name == "state.json"
+
+
+def _to_save_dir_path(roots: dict[Path, Path], fp: Path) -> tuple[Path, Path]:
+    """
+    Given an absolute path reported by watchfiles, return the most specific save dir containing it and the path
+    relative to that save dir (both as they were given to the server).
+    """
+    resolved = max((root for root in roots if fp.is_relative_to(root)), key=lambda root: len(root.parts))
+    root = roots[resolved]
+    return root, root / fp.relative_to(resolved)
@@ -61,7 +61,7 @@ class KaniState(BaseModel):
             id=ai.id,
             depth=ai.depth,
             parent=ai.parent.id if ai.parent else None,
-            children=list(ai.children),
+            children=[*ai.children, *ai.dormant_children],
             always_included_messages=ai.always_included_messages,
             chat_history=ai.chat_history,
             state=ai.state,
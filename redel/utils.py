@@ -4,6 +4,7 @@ import uuid
 from typing import Iterable, TYPE_CHECKING, TypeVar
 
 from kani import Kani
+from kani.engines.base import BaseEngine, WrapperEngine
 
 if TYPE_CHECKING:
     from .base_kani import BaseKani
@@ -45,6 +46,13 @@ async def generate_conversation_title(ai: "BaseKani"):
     return title.strip(' "')
 
 
+def unwrap_engine(engine: BaseEngine) -> BaseEngine:
+    """Get the innermost engine wrapped by the given engine (e.g. by a ScheduledEngine or CachedEngine)."""
+    while isinstance(engine, WrapperEngine):
+        engine = engine.engine
+    return engine
+
+
 def batched(iterable: Iterable[T], n: int) -> Iterable[tuple[T, ...]]:
     # batched('ABCDEFG', 3) --> ABC DEF G
     if n < 1:
@@ -65,3 +73,17 @@ def read_jsonl(fp) -> Iterable[dict]:
     with open(fp, encoding="utf-8") as f:
         for line in f:
             yield json.loads(line)
+
+
+def read_events(fp) -> Iterable[dict]:
+    """
+    Yield events from the event log at the given path, which can be in JSONL (``events.jsonl``) or binary
+    (``events.bin``) format.
+
+    The format is chosen by the file extension; anything other than ``.bin`` is read as JSONL.
+    """
+    if str(fp).endswith(".bin"):
+        from .binlog import read_binlog
+
+        return read_binlog(fp)
+    return read_jsonl(fp)
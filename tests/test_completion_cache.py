@@ -0,0 +1,30 @@
+"""Recording a delegation tree with a CachedEngine, then replaying it, must hit the cache for every request."""
+
+import asyncio
+
+from redel import MockEngine, ReDel
+from redel.completion_cache import CacheMode, CachedEngine
+
+
+async def _run_tree(cache_dir, log_dir, mode: CacheMode) -> tuple[list[str], CachedEngine]:
+    # a little latency, so the helpers finish in an order that can differ between runs
+    engine = CachedEngine(MockEngine(width=3, depth=2, latency=0.001), cache_dir=cache_dir, mode=mode)
+    ai = ReDel(root_engine=engine, delegate_engine=engine, title=None, log_dir=log_dir)
+    try:
+        answers = [
+            event.msg.text
+            async for event in ai.query("Compare cats and dogs.")
+            if event.type == "root_message" and event.msg.text
+        ]
+    finally:
+        await ai.close()
+    return answers, engine
+
+
+def test_replay_delegation_tree(tmp_path):
+    recorded, recorder = asyncio.run(_run_tree(tmp_path / "cache", tmp_path / "record", CacheMode.RECORD))
+    assert recorder.n_misses > 1
+    for idx in range(3):
+        replayed, replayer = asyncio.run(_run_tree(tmp_path / "cache", tmp_path / f"replay-{idx}", CacheMode.REPLAY))
+        assert replayed == recorded
+        assert replayer.n_hits == recorder.n_misses
@@ -40,8 +40,22 @@ export class API {
     return response.data;
   }
 
-  public static async getSaveEvents(saveId: string) {
-    const response = await axios.get<BaseEvent[]>(`${API_BASE}/saves/${saveId}/events`);
+  /**
+   * Get the state of a save after its first `at` events (or after all of them, if not given), reconstructed by the
+   * server.
+   */
+  public static async getSaveStateAt(saveId: string, at?: number) {
+    const params = at === undefined ? undefined : { at };
+    const response = await axios.get<SessionState>(`${API_BASE}/saves/${saveId}/state`, { params });
+    return response.data;
+  }
+
+  /**
+   * Get the events of a save. Pass `offset` and `limit` to get a single page of events instead of all of them.
+   */
+  public static async getSaveEvents(saveId: string, offset?: number, limit?: number) {
+    const params = offset === undefined && limit === undefined ? undefined : { offset, limit };
+    const response = await axios.get<BaseEvent[]>(`${API_BASE}/saves/${saveId}/events`, { params });
     return response.data;
   }
 
@@ -50,6 +64,11 @@ export class API {
     return response.data;
   }
 
+  public static async loadSave(saveId: string) {
+    const response = await axios.post<SessionState>(`${API_BASE}/saves/${saveId}/load`);
+    return response.data;
+  }
+
   ////////// INTERACTIVE //////////
   public static async listStatesInteractive() {
     const response = await axios.get<SessionState[]>(`${API_BASE}/states`);
@@ -1,8 +1,17 @@
 import { API, WS_BASE } from "@/redel/api";
-import type { BaseEvent, ChatMessage, RootMessage, SendMessage } from "@/redel/models";
+import type { BaseEvent, ChatMessage, RootMessage, SendMessage, SessionStateSnapshot } from "@/redel/models";
 import { ChatRole } from "@/redel/models";
 import { ReDelState } from "@/redel/state";
 
+// batched (and optionally compressed) event frames, in order of preference - see redel/server/session_manager.py
+const WS_PROTOCOLS =
+  typeof DecompressionStream === "undefined" ? ["redel.batch.v1"] : ["redel.batch.zlib.v1", "redel.batch.v1"];
+
+async function inflate(data: ArrayBuffer): Promise<string> {
+  const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream("deflate"));
+  return await new Response(stream).text();
+}
+
 /**
  * API client to handle interactive session with the backend.
  */
@@ -14,6 +23,8 @@ export class InteractiveClient {
   ws: WebSocket | null = null;
   isWSConnecting = false;
   isWSDisconnected = false;
+  // decompression is async, so chain message handling to keep events in order
+  recvChain: Promise<void> = Promise.resolve();
 
   // events
   events = new EventTarget();
@@ -31,12 +42,13 @@ export class InteractiveClient {
   // ==== lifecycle ====
   public connect() {
     this.ws?.close(1000);
-    this.ws = new WebSocket(`${WS_BASE}/${this.sessionId}`);
+    this.ws = new WebSocket(`${WS_BASE}/${this.sessionId}`, WS_PROTOCOLS);
+    this.ws.binaryType = "arraybuffer";
     this.isWSConnecting = true;
     this.ws.addEventListener("open", () => this.onWSOpen());
     this.ws.addEventListener("close", (event) => this.onWSClose(event));
     this.ws.addEventListener("error", (event) => console.warn("WebSocket error: ", event));
-    this.ws.addEventListener("message", (event) => this.onRawMessage(event.data));
+    this.ws.addEventListener("message", (event) => this.onWSMessage(event.data));
   }
 
   public close() {
@@ -84,15 +96,35 @@ export class InteractiveClient {
   }
 
   // ==== event handlers ====
+  onWSMessage(data: string | ArrayBuffer) {
+    this.recvChain = this.recvChain
+      .then(async () => this.onRawMessage(typeof data === "string" ? data : await inflate(data)))
+      .catch((e) => console.warn(e));
+  }
+
   onRawMessage(data: string) {
-    let message: BaseEvent;
+    let parsed: BaseEvent | BaseEvent[];
     try {
-      message = JSON.parse(data);
-      console.debug("RECV", message);
+      parsed = JSON.parse(data);
+      console.debug("RECV", parsed);
     } catch (e) {
       console.warn(e);
       return;
     }
+    // batched protocols send a list of events per frame
+    for (const message of Array.isArray(parsed) ? parsed : [parsed]) {
+      this.onMessage(message);
+    }
+  }
+
+  onMessage(message: BaseEvent) {
+    // we fell behind and the server sent the whole state instead of the events we missed
+    if (message.type === "session_state") {
+      this.state.loadSessionState(message as SessionStateSnapshot);
+      this.state.streamMap.clear();
+      this.events.dispatchEvent(new CustomEvent(message.type, { detail: message }));
+      return;
+    }
     this.state.handleEvent(message);
     this.events.dispatchEvent(new CustomEvent(message.type, { detail: message }));
   }
@@ -82,6 +82,8 @@ export interface WSError extends BaseEvent {
   msg: string;
 }
 
+export interface SessionStateSnapshot extends BaseEvent, SessionState {}
+
 export interface KaniSpawn extends BaseEvent, KaniState {}
 
 export interface KaniStateChange extends BaseEvent {
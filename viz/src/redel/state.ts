@@ -26,6 +26,7 @@ export class ReDelState {
 
   public loadSessionState(data: SessionState) {
     this.kaniMap.clear();
+    this.streamMap.clear();
     // hydrate the app state
     for (const kani of data.state) {
       this.kaniMap.set(kani.id, kani);